@@ -1,10 +1,35 @@
 # flake8: noqa
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+try:
+    # Written by setup.py at build or install time
+    from ._static_version import version as __version__
+except ImportError:
+    # Running from a source tree, ask versioneer when needed
+    pass
 
-from .utils import (n2sn_list_group_users_as_table,
-                    n2sn_list_user_search_as_table)
+# The public API is imported on first use so that the console scripts
+# do not pay for ldap3 and prettytable before parsing arguments.
+_lazy = {
+    'n2sn_list_group_users_as_table': '.utils',
+    'n2sn_list_user_search_as_table': '.utils',
+    'ADObjects': '.ldap',
+    'adquery': '.unix',
+}
 
-from .ldap import ADObjects
-from .unix import adquery
+
+def __getattr__(name):
+    if name == '__version__':
+        from ._version import get_versions
+        value = get_versions()['version']
+        globals()[name] = value
+        return value
+    if name in _lazy:
+        from importlib import import_module
+        value = getattr(import_module(_lazy[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}"
+                         .format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
@@ -0,0 +1,482 @@
+"""asyncio interface to Active Directory
+
+AsyncADObjects has the query and modify methods of ADObjects as
+coroutines, and its iterators as asynchronous iterators. It uses
+ldap3's ASYNC strategy, so requests are sent at once and identified by
+their message ID while ldap3's receiver thread reads the replies. The
+receiver wakes the waiting coroutine through the event loop, so any
+number of requests can be in flight on one connection without a thread
+each::
+
+    async with AsyncADObjects(server, group_search, user_search) as ad:
+        users = await asyncio.gather(
+            *[ad.get_user_by_samaccountname(n) for n in logins])
+"""
+import asyncio
+from collections import deque
+
+from ldap3 import ASYNC, BASE, SUBTREE, DEREF_NEVER, MODIFY_ADD, \
+    MODIFY_DELETE
+from ldap3.core.exceptions import LDAPException, LDAPInvalidDnError, \
+    LDAPOperationResult
+
+from .ldap import ADObjects, PAGED_RESULTS_OID, entry_values, \
+    _error_result
+from .filters import escape_filter_value, plan_user_search
+from .controls import sort_control, vlv_control, permissive_modify_control
+from .throttle import Throttle
+
+
+class AsyncADObjects(object):
+    """ADObjects for asyncio, use with ``async with``
+
+    An ADObjects holds the connection and its settings, only the
+    awaitable methods are offered. Binding (which may prompt for a
+    password) is done in a worker thread. timeout is the number of
+    seconds to wait for each reply. Recording and replaying sessions,
+    resilient mode and reusable connections are not supported.
+    """
+    # The class wrapped, replaced to talk to a stand in directory
+    _ADOBJECTS = ADObjects
+
+    def __init__(self, server,
+                 group_search=None,
+                 user_search=None,
+                 authenticate=False,
+                 username=None,
+                 ca_certs_file=None,
+                 client_strategy=ASYNC,
+                 timeout=None,
+                 write_window=None,
+                 write_rate=None):
+
+        # Searches are not memoized, so every answer is current
+        self._ad = self._ADOBJECTS(
+            server, group_search, user_search, authenticate=authenticate,
+            username=username, ca_certs_file=ca_certs_file,
+            client_strategy=client_strategy, cache_size=0,
+            write_window=write_window, write_rate=write_rate)
+
+        if self._ad.record is not None or self._ad.replay is not None:
+            raise RuntimeError("Recording and replaying sessions is not "
+                               "supported by AsyncADObjects")
+        # Not even when set in session_defaults
+        self._ad.resilient = False
+        self._ad.reusable = False
+
+        self.timeout = timeout
+        self._waiting = dict()
+        self._ready = set()
+
+    @property
+    def connection(self):
+        """The ldap3 connection, None until opened"""
+        return self._ad._connection
+
+    async def open(self):
+        """Connect and bind, prompting for a password if needed"""
+        self._loop = asyncio.get_running_loop()
+        await self._loop.run_in_executor(None, self._ad.open)
+        self._install_wake()
+
+    async def close(self):
+        """Unbind"""
+        await self._loop.run_in_executor(None, self._ad.close)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    def _install_wake(self):
+        """Have ldap3's receiver thread wake the waiting coroutines"""
+        strategy = self.connection.strategy
+        # The mock strategies answer as each request is sent
+        self._answered_on_send = strategy.no_real_dsa
+        if self._answered_on_send:
+            return
+
+        set_event = strategy.set_event_for_message
+        loop = self._loop
+
+        def set_event_and_wake(message_id):
+            set_event(message_id)
+            loop.call_soon_threadsafe(self._wake, message_id)
+
+        strategy.set_event_for_message = set_event_and_wake
+
+    def _wake(self, message_id):
+        future = self._waiting.pop(message_id, None)
+        if future is None:
+            self._ready.add(message_id)
+        elif not future.done():
+            future.set_result(None)
+
+    async def _response(self, message_id):
+        """Wait for the reply to a request, return (response, result)"""
+        if not self._answered_on_send:
+            if message_id in self._ready:
+                self._ready.discard(message_id)
+            else:
+                future = self._loop.create_future()
+                self._waiting[message_id] = future
+                try:
+                    await asyncio.wait_for(future, self.timeout)
+                finally:
+                    self._waiting.pop(message_id, None)
+
+        return self.connection.get_response(message_id)
+
+    async def _search(self, search_base, search_filter, attributes,
+                      controls=None, search_scope=SUBTREE, **kwargs):
+        with self._ad._span('ldap.search') as span:
+            message_id = self.connection.search(
+                search_base=search_base,
+                search_scope=search_scope,
+                attributes=attributes,
+                search_filter=search_filter,
+                controls=controls,
+                **kwargs
+            )
+            response, result = await self._response(message_id)
+            self._ad._search_done(span, search_filter, response, result)
+
+        return response, result
+
+    async def _iter_pages(self, search_base, search_filter, attributes,
+                          page_size=500):
+        cookie = None
+        while True:
+            response, result = await self._search(search_base,
+                                                  search_filter, attributes,
+                                                  paged_size=page_size,
+                                                  paged_cookie=cookie)
+            yield response
+
+            cookie = result.get('controls', {}).get(PAGED_RESULTS_OID, {}) \
+                .get('value', {}).get('cookie')
+            if not cookie:
+                break
+
+    async def _iter_paged_users(self, search_base, search_filter,
+                                page_size):
+        async for response in self._iter_pages(search_base, search_filter,
+                                               self._ad._USER_ATTRIBUTES,
+                                               page_size):
+            for user in self._ad._decode_users(response):
+                yield user
+
+    async def _get_group(self, search_filter):
+        attributes = self._ad._GROUP_ATTRIBUTES
+        response, _ = await self._search(self._ad._group_search,
+                                         search_filter, attributes)
+        return [entry_values(entry, attributes)
+                for entry in response if entry['type'] == 'searchResEntry']
+
+    async def _get_user(self, search_filter):
+        response, _ = await self._search(self._ad._user_search,
+                                         search_filter,
+                                         self._ad._USER_ATTRIBUTES)
+        return self._ad._decode_users(response)
+
+    async def _get_user_page(self, search_filter, offset, limit, sort_key):
+        vlv_context = self._ad._vlv_context
+        controls = [sort_control([sort_key]),
+                    vlv_control(offset, limit,
+                                vlv_context.get(search_filter))]
+        response, result = await self._search(
+            self._ad._user_search, search_filter,
+            self._ad._USER_ATTRIBUTES, controls)
+
+        if result['result'] == 12:
+            # unavailableCriticalExtension
+            vlv = None
+        elif result['result'] != 0:
+            raise RuntimeError("Sorted search failed : {}"
+                               .format(result['description']))
+        else:
+            vlv = self._ad._vlv_response(search_filter, result)
+
+        if vlv is None:
+            # The server can not sort or page, or did not, so do it here
+            users = sorted(await self._get_user(search_filter),
+                           key=lambda u: u[sort_key] or '')
+            return users[offset:offset + limit], len(users)
+
+        return self._ad._decode_users(response)[:limit], \
+            vlv['content_count']
+
+    async def get_user_by_id(self, id):
+        return await self._get_user('(employeeID={})'.format(
+            escape_filter_value(id)))
+
+    async def get_user_by_samaccountname(self, id):
+        return await self._get_user('(sAMAccountName={})'.format(
+            escape_filter_value(id)))
+
+    async def get_user_by_dn(self, id):
+        return await self._get_user('(distinguishedname={})'.format(
+            escape_filter_value(id)))
+
+    async def iter_users_by_attribute(self, attribute, values,
+                                      chunk_size=100):
+        """Iterate over the users whose attribute is one of values, with
+        one OR filter per chunk_size values"""
+        values = list(values)
+        for start in range(0, len(values), chunk_size):
+            ldap_filter = "(|{})".format(''.join(
+                '({}={})'.format(attribute, escape_filter_value(v))
+                for v in values[start:start + chunk_size]))
+            async for user in self._iter_paged_users(self._ad._user_search,
+                                                     ldap_filter, 500):
+                yield user
+
+    async def get_user_by_surname_and_givenname(self,
+                                                surname, givenname,
+                                                user_type, name=None):
+        plan = plan_user_search(surname, givenname, user_type, name)
+        return await self._get_user(plan.filter)
+
+    async def get_user_by_surname_and_givenname_dict(
+            self, surname, givenname, user_type, name=None):
+        users = await self.get_user_by_surname_and_givenname(
+            surname, givenname, user_type, name
+        )
+        return {u['userPrincipalName']: u for u in users}
+
+    async def iter_user_by_surname_and_givenname(
+            self, surname, givenname, user_type, name=None, page_size=500):
+        plan = plan_user_search(surname, givenname, user_type, name)
+        async for user in self._iter_paged_users(self._ad._user_search,
+                                                 plan.filter, page_size):
+            yield user
+
+    async def get_user_by_surname_and_givenname_page(
+            self, surname, givenname, user_type, name=None,
+            offset=0, limit=25, sort_key='displayName'):
+        plan = plan_user_search(surname, givenname, user_type, name)
+        return await self._get_user_page(plan.filter, offset, limit,
+                                         sort_key)
+
+    async def get_group_by_samaccountname(self, id):
+        return await self._get_group('(sAMAccountName={})'.format(
+            escape_filter_value(id)))
+
+    async def get_groups_by_samaccountname(self, ids, chunk_size=100):
+        """Get the groups whose sAMAccountName is one of ids, with one OR
+        filter per chunk_size ids"""
+        ids = list(ids)
+        groups = list()
+        for start in range(0, len(ids), chunk_size):
+            groups += await self._get_group("(|{})".format(''.join(
+                '(sAMAccountName={})'.format(escape_filter_value(i))
+                for i in ids[start:start + chunk_size])))
+        return groups
+
+    async def get_groups_by_member_dn(self, dn):
+        """Get the groups a user or group is in, including nested groups"""
+        return await self._get_group(
+            '(&(objectCategory=group)'
+            '(member:1.2.840.113556.1.4.1941:={}))'.format(
+                escape_filter_value(dn)))
+
+    async def iter_group_members(self, group_name, page_size=500):
+        ldap_filter = self._ad._member_filter(
+            group_name, await self.get_group_by_samaccountname(group_name))
+        if ldap_filter is None:
+            return
+
+        async for user in self._iter_paged_users(self._ad._group_search,
+                                                 ldap_filter, page_size):
+            yield user
+
+    async def get_group_members(self, group_name):
+        return [user async for user in self.iter_group_members(group_name)]
+
+    async def get_group_members_dict(self, groupname):
+        members = await self.get_group_members(groupname)
+        return {m['userPrincipalName']: m for m in members}
+
+    async def iter_direct_members(self, group_dn, user_dns=None,
+                                  page_size=500):
+        """Iterate over the users directly in a group, as
+        ADObjects.iter_direct_members()"""
+        if user_dns is not None and len(user_dns) == 0:
+            return
+
+        async for user in self._iter_paged_users(
+                self._ad._group_search,
+                self._ad._direct_member_filter(group_dn, user_dns),
+                page_size):
+            yield user
+
+    async def get_direct_memberships(self, user_dns, group_dns,
+                                     chunk_size=100, page_size=500):
+        """Get which of groups each of users is directly in, as
+        ADObjects.get_direct_memberships()"""
+        group_dns = set(dn.lower() for dn in group_dns)
+        memberships = dict()
+        for ldap_filter in self._ad._membership_filters(
+                user_dns, group_dns, chunk_size):
+            async for response in self._iter_pages(
+                    self._ad._group_search, ldap_filter,
+                    self._ad._MEMBERSHIP_ATTRIBUTES, page_size):
+                self._ad._add_memberships(memberships, response, group_dns)
+        return memberships
+
+    async def _iter_member_ids(self, ldap_filter, page_size):
+        attributes = self._ad._MEMBER_ID_ATTRIBUTES
+        async for response in self._iter_pages(self._ad._group_search,
+                                               ldap_filter, attributes,
+                                               page_size):
+            for entry in response:
+                if entry['type'] == 'searchResEntry':
+                    yield entry_values(entry, attributes)
+
+    async def iter_direct_member_ids(self, group_dn, page_size=1000):
+        """Iterate over the users directly in a group, identifiers only"""
+        async for user in self._iter_member_ids(
+                self._ad._direct_member_filter(group_dn), page_size):
+            yield user
+
+    async def iter_group_member_ids(self, group_name, page_size=1000):
+        """Iterate over the users in a group (including nested groups),
+        identifiers only"""
+        ldap_filter = self._ad._member_filter(
+            group_name, await self.get_group_by_samaccountname(group_name))
+        if ldap_filter is None:
+            return
+        async for user in self._iter_member_ids(ldap_filter, page_size):
+            yield user
+
+    async def _modify_response(self, message_id):
+        try:
+            return (await self._response(message_id))[1]
+        except LDAPOperationResult as e:
+            return _error_result(e)
+
+    async def iter_modify(self, requests):
+        """Make modifies, yielding their results in order
+
+        requests is an iterable of (dn, changes, controls). They are
+        paced by the ADObjects throttle, as ADObjects.iter_modify() does,
+        waiting on the event loop rather than blocking it.
+        """
+        ad = self._ad
+        if ad.throttle is None:
+            ad.throttle = Throttle(ad.write_window, ad.write_rate)
+        throttle = ad.throttle
+
+        queue = deque((n, request, 0) for n, request in enumerate(requests))
+        # (n, request, attempt, ticket, message ID, timer)
+        in_flight = deque()
+        replies = dict()
+        next_reply = 0
+        with ad._span('ldap.pipeline', requests=len(queue)) as span:
+            while queue or in_flight:
+                delay = throttle.delay(len(in_flight)) if queue else None
+                if delay == 0 or (delay is not None and not in_flight):
+                    await asyncio.sleep(delay)
+                    n, (dn, changes, controls), attempt = queue.popleft()
+                    ticket = throttle.sent()
+                    # Timed from the request to its reply
+                    timer = ad._span('ldap.modify').start()
+                    message_id = self.connection.modify(
+                        dn, changes, controls=controls)
+                    in_flight.append((n, (dn, changes, controls),
+                                      attempt, ticket, message_id, timer))
+                    continue
+
+                n, request, attempt, ticket, message_id, timer = \
+                    in_flight.popleft()
+                result = await self._modify_response(message_id)
+                timer.set(result=result['description'])
+                timer.end()
+                if throttle.done(ticket, result, attempt):
+                    queue.appendleft((n, request, attempt + 1))
+                    continue
+
+                replies[n] = result
+                while next_reply in replies:
+                    yield replies.pop(next_reply)
+                    next_reply += 1
+            span.set(window=throttle.window)
+
+    async def _member_result(self, group_dn, user_dns, operation, result):
+        """Raise the error of a member change, or make it on servers
+        without Permissive Modify"""
+        if result['result'] == 12:
+            # unavailableCriticalExtension
+            result = await self._change_member_read_first(
+                group_dn, user_dns, operation)
+        self._ad._member_result(group_dn, user_dns, operation, result)
+
+    async def _change_member_read_first(self, group_dn, user_dns,
+                                        operation):
+        response, result = await self._search(
+            group_dn, '(objectclass=*)', ['member'],
+            search_scope=BASE, dereference_aliases=DEREF_NEVER)
+        if result['description'] != 'success':
+            raise LDAPInvalidDnError(group_dn + ' not found')
+
+        members = [m.lower() for m in
+                   response[0]['attributes'].get('member', [])]
+        user_dns = [dn for dn in user_dns
+                    if (dn.lower() in members) != (operation == MODIFY_ADD)]
+        if not user_dns:
+            return result
+
+        with self._ad._span('ldap.modify', change=operation,
+                            values=len(user_dns)):
+            message_id = self.connection.modify(
+                group_dn, {'member': [(operation, user_dns)]})
+            return await self._modify_response(message_id)
+
+    async def change_group_members(self, changes):
+        """Add or remove members of groups, pipelining the modifies
+
+        As ADObjects.change_group_members(), yields None for each change
+        made and the LDAPException of each that failed, in order.
+        """
+        changes = list(self._ad._member_changes(changes))
+        requests = ((group_dn, {'member': [(operation, user_dns)]},
+                     [permissive_modify_control()])
+                    for group_dn, user_dns, operation in changes)
+        n = 0
+        async for result in self.iter_modify(requests):
+            try:
+                await self._member_result(*changes[n], result)
+            except LDAPException as e:
+                yield e
+            else:
+                yield None
+            n += 1
+
+    async def _change_member(self, group_dn, user_dns, operation):
+        """Add or remove group members with one modify
+
+        As ADObjects does, Permissive Modify makes adding a member or
+        removing a non member succeed. Servers without the control have
+        the group's members read first.
+        """
+        async for error in self.change_group_members(
+                [(group_dn, user_dns, operation)]):
+            if error is not None:
+                raise error
+
+    async def add_user_to_group_by_dn(self, group_name, username):
+        await self._change_member(group_name, username, MODIFY_ADD)
+
+    async def remove_user_from_group_by_dn(self, group_name, username):
+        await self._change_member(group_name, username, MODIFY_DELETE)
+
+    async def add_users_to_group_by_dn(self, group_name, usernames):
+        """Add several users to a group in one modify"""
+        await self._change_member(group_name, list(usernames), MODIFY_ADD)
+
+    async def remove_users_from_group_by_dn(self, group_name, usernames):
+        """Remove several users from a group in one modify"""
+        await self._change_member(group_name, list(usernames),
+                                  MODIFY_DELETE)
@@ -0,0 +1,118 @@
+"""A thread safe memo with LRU and TTL eviction
+
+Memo.get(key, compute) returns the cached value for key or calls
+compute() to make it. Callers asking for a key while it is being
+computed wait for that result instead of computing it again, so
+identical concurrent requests cost one directory search.
+
+Hits and misses are counted by the profiler as ``cache.<name>.hit`` and
+``cache.<name>.miss`` so they appear in the metrics.
+"""
+import collections
+import threading
+import time
+
+from .profiling import profiler
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.generation = None
+
+
+class Memo(object):
+    """Cache at most max_entries values, each for at most ttl seconds
+
+    ttl of None keeps values until they are evicted or invalidated.
+    """
+    def __init__(self, name, max_entries=1024, ttl=None,
+                 clock=time.monotonic):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._values = collections.OrderedDict()
+        self._calls = dict()
+        # Bumped by invalidate() so values computed before it are not
+        # stored after it
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, compute, cacheable=None):
+        """Get the value for key, calling compute() if it is not cached
+
+        If cacheable is given the value is only kept when
+        cacheable(value) is true.
+        """
+        with self._lock:
+            if key in self._values:
+                expires, value = self._values[key]
+                if expires is None or expires > self.clock():
+                    self._values.move_to_end(key)
+                    self.hits += 1
+                    profiler.count('cache.{}.hit'.format(self.name))
+                    return value
+                del self._values[key]
+
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = self._calls[key] = _Call()
+                call.generation = self._generation
+                self.misses += 1
+                profiler.count('cache.{}.miss'.format(self.name))
+            else:
+                self.coalesced += 1
+                profiler.count('cache.{}.hit'.format(self.name))
+
+        if not owner:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and \
+                   call.generation == self._generation and \
+                   (cacheable is None or cacheable(call.value)):
+                    self._store(key, call.value)
+            call.event.set()
+
+        return call.value
+
+    def _store(self, key, value):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self._values[key] = (expires, value)
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_entries:
+            self._values.popitem(last=False)
+
+    def invalidate(self, match=None):
+        """Drop values whose key match(key) is true, or all values"""
+        with self._lock:
+            self._generation += 1
+            if match is None:
+                self._values.clear()
+                return
+            for key in [k for k in self._values if match(k)]:
+                del self._values[key]
+
+    def stats(self):
+        return {'entries': len(self._values), 'hits': self.hits,
+                'misses': self.misses, 'coalesced': self.coalesced}
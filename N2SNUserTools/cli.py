@@ -3,14 +3,12 @@ import sys
 import random
 from os.path import expanduser, basename
 import argparse
-import yaml
-from ldap3.core.exceptions import LDAPInsufficientAccessRightsResult
+from contextlib import contextmanager
 
-from .utils import (n2sn_list_group_users_as_table,
-                    n2sn_list_user_search_as_table)
-from .ldap import ADObjects
-
-from . import __version__
+# ldap3, yaml and prettytable are imported where they are used so that
+# --help and --version return without loading them
+from .output import FORMATS
+from .filters import plan_user_search
 
 sys.tracebacklimit = 0
 
@@ -30,20 +28,45 @@ def default_instrument():
     return beamline.lower()
 
 
-def base_argparser(description, default_inst=True, auth=False):
+class VersionAction(argparse.Action):
+    """Print the version, found only when requested"""
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings, dest=dest,
+                         default=default, nargs=0,
+                         help="show program's version number and exit")
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(message='{} v{}\n'.format(parser.prog, get_version()))
+
+
+def get_version():
+    """Get the version, from git if running from a source tree"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if os.path.exists(os.path.join(root, '.git')):
+        from ._version import get_versions
+        return get_versions()['version']
+
+    from . import __version__
+    return __version__
+
+
+def base_argparser(description, default_inst=True, auth=False,
+                   instruments=False):
     parser = argparse.ArgumentParser(
         prog=basename(sys.argv[0]),
         description=description
     )
 
-    parser.add_argument('--version', action='version',
-                        version=('%(prog)s v' + __version__))
+    parser.add_argument('--version', action=VersionAction)
 
     if default_inst:
         parser.add_argument(
             '-i', '--instrument', '--beamline', dest='instrument',
-            action='store', help='Name of N2SN instrument',
-            default=default_instrument()
+            action='store', default=default_instrument(),
+            help='Name of N2SN instrument' if not instruments else
+                 'Names of N2SN instruments or instrument groups, comma '
+                 'separated'
         )
 
     if auth:
@@ -52,23 +75,179 @@ def base_argparser(description, default_inst=True, auth=False):
             action='store', help='Username to use for authentication',
             default=None
         )
+        parser.add_argument(
+            '--window', dest='window', action='store', type=int,
+            default=None, metavar='N',
+            help='Most changes to send before waiting for their replies; '
+                 '1 waits for each (default: 8)'
+        )
+        parser.add_argument(
+            '--rate', dest='rate', action='store', type=float,
+            default=None, metavar='N',
+            help='Most changes to start a second (default: no limit). '
+                 'Both limits are lowered while the server is busy or '
+                 'slow'
+        )
+
+    parser.add_argument(
+        '--resilient', dest='resilient', action='store_true',
+        help='Reconnect and carry on if the connection to the server is '
+             'lost, binding again with the Kerberos ticket or the '
+             'password typed, which is kept in memory until exit'
+    )
+
+    session = parser.add_argument_group('session recording')
+    session.add_argument(
+        '--record', dest='record', action='store', metavar='FILE',
+        help='Record LDAP requests and responses to FILE'
+    )
+    session.add_argument(
+        '--replay', dest='replay', action='store', metavar='FILE',
+        help='Answer LDAP requests from a recording instead of the server'
+    )
+    session.add_argument(
+        '--replay-latency', dest='replay_latency', action='store',
+        type=replay_latency, metavar='SCALE', default=None,
+        help="Wait as long as the recorded requests took ('recorded') or "
+             "scaled by SCALE"
+    )
+
+    parser.add_argument(
+        '--profile', dest='profile', action='store', nargs='?',
+        const='-', default=None, metavar='TRACE',
+        help='Time LDAP operations, adquery calls and output; print a '
+             'summary or write a Chrome trace to TRACE'
+    )
+    parser.add_argument(
+        '--metrics', dest='metrics', action='store', metavar='FILE',
+        default=None,
+        help='Write latency and error metrics in the OpenMetrics text '
+             'format to FILE on exit'
+    )
 
     return parser
 
 
-def read_config(parser, instrument=None, no_inst=False):
-    config = None
+def replay_latency(value):
+    if value == 'recorded':
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "must be 'recorded' or a number") from None
+
+
+def int_at_least(minimum):
+    """Get an argparse type for integers of at least minimum"""
+    def parse(value):
+        try:
+            value = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "must be an integer") from None
+        if value < minimum:
+            raise argparse.ArgumentTypeError(
+                "must be at least {}".format(minimum))
+        return value
+    return parse
+
+
+def parse_args(parser):
+    """Parse arguments and apply the options common to all commands"""
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        import atexit
+        from .profiling import profiler
+        profiler.enable()
+        atexit.register(report_profile, args.profile)
+
+    if args.metrics is not None:
+        import atexit
+        from . import metrics
+        atexit.register(metrics.enable().write, args.metrics)
+
+    if args.record is not None or args.replay is not None:
+        from .ldap import ADObjects
+        ADObjects.session_defaults.update(
+            record=args.record, replay=args.replay,
+            replay_latency=args.replay_latency)
+
+    if args.resilient:
+        if args.record is not None or args.replay is not None:
+            parser.error("--resilient can not be used with --record or "
+                         "--replay")
+        from .ldap import ADObjects
+        ADObjects.session_defaults['resilient'] = True
+
+    if getattr(args, 'window', None) is not None:
+        if args.window < 1:
+            parser.error("--window must be at least 1")
+        from .ldap import ADObjects
+        ADObjects.session_defaults['write_window'] = args.window
+
+    if getattr(args, 'rate', None) is not None:
+        if args.rate <= 0:
+            parser.error("--rate must be more than 0")
+        from .ldap import ADObjects
+        ADObjects.session_defaults['write_rate'] = args.rate
+
+    return args
+
+
+def report_profile(trace):
+    """Print the profile summary, or write it as a Chrome trace"""
+    from .profiling import profiler
+    if trace == '-':
+        print('\n' + profiler.summary(), file=sys.stderr)
+    else:
+        profiler.write_chrome_trace(trace)
+        print('\nProfile trace written to {}'.format(trace),
+              file=sys.stderr)
+
+
+def add_format_argument(parser):
+    parser.add_argument(
+        '-f', '--format', dest='format', action='store',
+        choices=FORMATS, default='table',
+        help='Output format (default: table)'
+    )
+
+
+def add_service_argument(parser):
+    parser.add_argument(
+        '--service', dest='service', action='store', metavar='URL',
+        default=os.environ.get('N2SN_SERVICE'),
+        help='Ask the query service at URL instead of the directory '
+             '(default: $N2SN_SERVICE)'
+    )
+
+
+def use_service(args):
+    """Point the listing functions at the query service, if one is set"""
+    if args.service:
+        from . import utils
+        utils.service_url = args.service
+
+
+def find_config():
+    """Load the first config file found"""
+    from .config import load_config
+    from .profiling import profiler
+
     for fn in config_files:
         try:
-            with open(fn) as f:
-                config = yaml.load(f, Loader=yaml.SafeLoader)
+            with profiler.span('config.load', file=fn):
+                return load_config(fn)
         except IOError:
             pass
-        else:
-            break
 
-    if config is None:
-        raise RuntimeError("Unable to open a config file")
+    raise RuntimeError("Unable to open a config file")
+
+
+def read_config(parser, instrument=None, no_inst=False):
+    config = find_config()
 
     if 'common' not in config:
         print(parser.error(
@@ -94,26 +273,71 @@ def read_config(parser, instrument=None, no_inst=False):
         return config['common'], None
 
 
+def read_instruments(parser, instruments=None):
+    """Get the common config and a list of (name, config) of instruments
+
+    instruments is a comma separated list of instruments and of the
+    instrument groups defined in the config file, which stand for their
+    instruments. Each instrument is listed once, in the order named.
+    """
+    config = find_config()
+
+    if 'common' not in config:
+        print(parser.error(
+            "Section 'common' missing from config file."))
+
+    if instruments is None:
+        if 'default_instrument' not in config['common']:
+            print(parser.error(
+                "'default_instrument' not defined in config file. "
+                "Please specify on command line"))
+
+        instruments = config['common']['default_instrument']
+
+    instrument_groups = config.get('instrument_groups', {})
+    names = list()
+    for name in str(instruments).split(','):
+        name = name.strip()
+        if name in config['instruments']:
+            members = [name]
+        elif name in instrument_groups:
+            members = instrument_groups[name]
+        else:
+            print(parser.error("instrument '{}' is not "
+                               "defined in the config file."
+                               .format(name)))
+        names += [m for m in members if m not in names]
+
+    return config['common'], \
+        [(name, config['instruments'][name]) for name in names]
+
+
 def n2sn_list(desc, message, group_name):
     parser = base_argparser(
         'List current enabled users for an instrument', True
     )
+    add_format_argument(parser)
+    add_service_argument(parser)
 
-    args = parser.parse_args()
+    args = parse_args(parser)
+    use_service(args)
 
     common_config, config = read_config(parser, args.instrument)
 
-    print("\n{} for instrument {}\n"
-          .format(message, config['name'].upper()))
+    from .utils import n2sn_write_group_users
+
+    if args.format == 'table':
+        print("\n{} for instrument {}\n"
+              .format(message, config['name'].upper()))
 
     groups = config['rights']
 
-    print(n2sn_list_group_users_as_table(
-          common_config['server'],
-          common_config['group_search'],
-          common_config['user_search'],
-          common_config.get('ldap_ca_cert', None),
-          groups))
+    n2sn_write_group_users(
+        common_config['servers'],
+        common_config['group_search'],
+        common_config['user_search'],
+        common_config.get('ldap_ca_cert', None),
+        groups, fmt=args.format)
 
 
 def n2sn_list_users():
@@ -124,10 +348,52 @@ def n2sn_list_users():
     )
 
 
+@contextmanager
+def change_session(common_config, username, resolve, *args, **kwargs):
+    """Open the authenticated connection for a change
+
+    Yields the ADObjects and the result of resolve(ad, *args,
+    **kwargs), which makes the lookups for the change. These are public,
+    so they run on an anonymous connection while the password is typed
+    and the authenticated connection only makes the changes. A recording
+    is made of one synchronous connection, so when recording they are
+    made on that instead. Otherwise the connection is asynchronous so
+    its changes can be pipelined.
+    """
+    from ldap3 import ASYNC, SYNC
+    from .ldap import ADObjects, WRITE_WINDOW
+    from .utils import prefetch
+
+    future = None
+    if ADObjects.session_defaults.get('record') is None:
+        future = prefetch(
+            common_config['servers'],
+            common_config['group_search'],
+            common_config['user_search'],
+            common_config.get('ldap_ca_cert', None),
+            resolve, *args, **kwargs)
+
+    window = ADObjects.session_defaults.get('write_window') or WRITE_WINDOW
+    strategy = ASYNC if future is not None and window > 1 else SYNC
+
+    with ADObjects(common_config['servers'],
+                   authenticate=True,
+                   username=username,
+                   ca_certs_file=common_config.get('ldap_ca_cert', None),
+                   group_search=common_config['group_search'],
+                   user_search=common_config['user_search'],
+                   client_strategy=strategy) as ad:
+
+        if future is not None:
+            yield ad, future.result()
+        else:
+            yield ad, resolve(ad, *args, **kwargs)
+
+
 def n2sn_change_user(operation):
     parser = base_argparser(
         'Add or remove attribute from user',
-        auth=True)
+        auth=True, instruments=True)
 
     user_group = parser.add_mutually_exclusive_group()
     user_group.add_argument(
@@ -138,6 +404,15 @@ def n2sn_change_user(operation):
         '-n', '--life-number', dest='life_number', action='store',
         help='Life number of guest number of user',
     )
+    user_group.add_argument(
+        '--from-file', dest='from_file', action='store', metavar='FILE',
+        help='Read the users, and optionally their rights, from a roster '
+             '(a list or CSV file)',
+    )
+    user_group.add_argument(
+        '--from-stdin', dest='from_stdin', action='store_true',
+        help='Read the roster from standard input',
+    )
 
     if operation == 'remove':
         user_group.add_argument(
@@ -146,16 +421,39 @@ def n2sn_change_user(operation):
         )
 
     parser.add_argument('right', metavar='RIGHT',
-                        type=str,
-                        help='Right to add')
+                        type=str, nargs='?',
+                        help='Right to add (with a roster, for the rows '
+                             'naming none)')
+
+    roster = parser.add_argument_group('roster')
+    roster.add_argument(
+        '--results', dest='results', action='store', metavar='FILE',
+        default=None,
+        help='Write the result of each row to FILE instead of standard '
+             'output'
+    )
+    add_format_argument(roster)
+    roster.add_argument(
+        '--chunk-size', dest='chunk_size', action='store', type=int,
+        default=None,
+        help='Users to look up or change in one request (default: 100)'
+    )
 
-    args = parser.parse_args()
+    args = parse_args(parser)
 
-    common_config, inst_config = read_config(parser, args.instrument)
+    common_config, instruments = read_instruments(parser, args.instrument)
 
     if operation != 'remove':
         args.purge = False
 
+    if args.from_file is not None or args.from_stdin:
+        if len(instruments) > 1:
+            print(parser.error("A roster can only be applied to one "
+                               "instrument at a time"))
+        n2sn_change_roster(operation, args, common_config,
+                           instruments[0][1])
+        return
+
     if ((args.login is None) and
        (args.life_number is None) and
        (args.purge is False)):
@@ -163,122 +461,406 @@ def n2sn_change_user(operation):
         print(parser.error("You must specify the user by either"
                            " login (username) or life/guest number"))
 
-    att_names = list(inst_config['rights'].keys())
-
-    print(set([a.lower() for a in args.right.split(',')]))
-    print(set(att_names))
+    if args.right is None:
+        print(parser.error("You must specify a right"))
 
     rights = args.right.split(',')
 
-    if len(set(att_names) & set([a.lower() for a in rights])) \
-       != len(rights):
-        print(parser.error("You must specify a right from the options:"
-                           " {}".format((', '.join(att_names)).upper())))
-
-    with ADObjects(common_config['server'],
-                   authenticate=True,
-                   username=args.username,
-                   ca_certs_file=common_config.get('ldap_ca_cert', None),
-                   group_search=common_config['group_search'],
-                   user_search=common_config['user_search']) as ad:
-
-        for right in rights:
-            group_name = inst_config['rights'][right.lower()]
-
-            users = list()
-
-            # Find group to manipulate
-
-            group = ad.get_group_by_samaccountname(group_name)
-            if len(group) != 1:
-                raise RuntimeError("Unable to find correct group for users")
-            group = group[0]
-
-            if args.login is not None:
-                for _login in args.login.split(','):
-                    _user = ad.get_user_by_samaccountname(_login)
-                    if len(_user) == 0:
-                        raise RuntimeError("Unable to find user {}, "
-                                           "please check."
-                                           .format(_login))
-                    if len(_user) != 1:
-                        raise RuntimeError("Login (Username) {} "
-                                           "is not unique. "
-                                           "Please check.".format(_login))
-
-                    users.append(_user[0])
-
-            if args.life_number is not None:
-                for _life_number in args.life_number.split(','):
-                    _user = ad.get_user_by_id(_life_number)
-                    if len(_user) == 0:
-                        raise RuntimeError("Unable to find user "
-                                           "with life/guest "
-                                           "number {}, please check."
-                                           .format(_life_number))
-                    if len(_user) != 1:
-                        raise RuntimeError("Life/Guest number {} "
-                                           "is not unique. "
-                                           "Please check."
-                                           .format(_life_number))
-
-                    users.append(_user[0])
-
+    for name, inst_config in instruments:
+        att_names = list(inst_config['rights'].keys())
+
+        if len(set(att_names) & set([a.lower() for a in rights])) \
+           != len(rights):
+            print(parser.error("You must specify a right from the options:"
+                               " {}{}".format(
+                                   (', '.join(att_names)).upper(),
+                                   " for instrument {}".format(name)
+                                   if len(instruments) > 1 else '')))
+
+    from ldap3 import MODIFY_ADD, MODIFY_DELETE
+    from ldap3.core.exceptions import LDAPInsufficientAccessRightsResult
+    from .utils import resolve_change
+
+    # The groups of every instrument are looked up together, and changed
+    # on one authenticated connection
+    groups = {(name, right): inst_config['rights'][right.lower()]
+              for name, inst_config in instruments
+              for right in rights}
+
+    with change_session(
+            common_config, args.username, resolve_change, groups,
+            logins=args.login.split(',') if args.login else None,
+            life_numbers=(args.life_number.split(',')
+                          if args.life_number else None),
+            purge=args.purge) as (ad, changes):
+
+        # (instrument, right, [(user, change or None if there is nothing
+        # to do)]). Instruments sharing a group share its changes, which
+        # are made once.
+        todo = list()
+        made = dict()
+        for name, inst_config in instruments:
+            for right in rights:
+                change_set = changes[(name, right)]
+                group = change_set['group']
+                members = change_set['members']
+                users = list()
+                for user in change_set['users']:
+                    member = user['distinguishedName'].lower() in members
+                    change = None
+                    if operation == 'add' and not member:
+                        change = (group['distinguishedName'],
+                                  user['distinguishedName'], MODIFY_ADD)
+                    elif operation == 'remove' and member:
+                        change = (group['distinguishedName'],
+                                  user['distinguishedName'], MODIFY_DELETE)
+                    if change is not None:
+                        made.setdefault(change, len(made))
+                    users.append((user, change))
+                todo.append((inst_config, right, users))
+
+        # The changes are pipelined, their results read in order
+        errors = ad.change_group_members(list(made))
+        results = list()
+
+        for inst_config, right, users in todo:
             if args.purge:
-                user = ad.get_group_members(inst_config[group_name])
-
-            for user in users:
+                print('')
+
+            for user, change in users:
+                if operation == "remove" and args.purge:
+                    print("Removing user : {}".format(user['displayName']))
+
+                error = None
+                if change is not None:
+                    while len(results) <= made[change]:
+                        results.append(next(errors))
+                    error = results[made[change]]
+                if isinstance(error, LDAPInsufficientAccessRightsResult):
+                    raise RuntimeError(
+                        "Error {} group, check you have the correct "
+                        "permission.".format(
+                            "adding user to" if operation == "add"
+                            else "removing user from")) from None
+                elif error is not None:
+                    raise error
 
                 if operation == "add":
-                    try:
-                        ad.add_user_to_group_by_dn(group['distinguishedName'],
-                                                   user['distinguishedName'])
-                    except LDAPInsufficientAccessRightsResult:
-                        raise RuntimeError("Error adding user to group, "
-                                           "check you have the correct "
-                                           "permission.") from None
-
                     print("\nSuccessfully added right {} to user \"{}\""
                           " for instrument {}\n"
                           .format(right.upper(), user['displayName'],
                                   inst_config['name'].upper()))
 
-                if (operation == "remove") and (args.purge is False):
-                    try:
-                        ad.remove_user_from_group_by_dn(
-                            group['distinguishedName'],
-                            user['distinguishedName'])
-                    except LDAPInsufficientAccessRightsResult:
-                        raise RuntimeError("Error removing user from group, "
-                                           "check you have the correct "
-                                           "permission.") from None
-
-                    print("\nSuccessfully removed right {} from user \"{}\""
-                          " for instrument {}"
+                if operation == "remove" and not args.purge:
+                    print("\nSuccessfully removed right {} from user "
+                          "\"{}\" for instrument {}"
                           .format(right.upper(), user['displayName'],
                                   inst_config['name'].upper()))
 
-                if (operation == "remove") and (args.purge is True):
-                    user_dn = [(u['distinguishedName'], u['displayName'])
-                               for u in user]
+            if args.purge:
+                print("\nSuccessfully removed all users"
+                      " for instrument {} with right '{}'\n"
+                      .format(inst_config['name'].upper(),
+                              right.upper()))
+
+    if len(instruments) > 1:
+        unchanged = sum(1 for _, _, users in todo
+                        for _, change in users if change is None)
+        print("\n{} right{} {} for instruments {} : {} changes made, "
+              "{} already {}".format(
+                  "Added" if operation == "add" else "Removed",
+                  's' if len(rights) > 1 else '',
+                  ', '.join(right.upper() for right in rights),
+                  ', '.join(inst_config['name'].upper()
+                            for _, inst_config in instruments),
+                  len(made), unchanged,
+                  "held" if operation == "add" else "not held"))
+
+
+def n2sn_change_roster(operation, args, common_config, inst_config):
+    """Add or remove rights for the users of a roster"""
+    from .output import get_writer
+    from .roster import (read_roster, resolve_roster, apply_roster,
+                         CHUNK_SIZE, RESULT_FIELDS, RESULT_NAMES)
+
+    default_rights = args.right.split(',') if args.right else None
+    tty = None
+    if args.from_stdin:
+        rows = read_roster(sys.stdin, default_rights)
+        # Prompt for the username and password on the terminal
+        try:
+            tty = open('/dev/tty')
+        except OSError:
+            pass
+    else:
+        with open(args.from_file, newline='') as f:
+            rows = read_roster(f, default_rights)
+
+    chunk_size = args.chunk_size or CHUNK_SIZE
+
+    def progress(done, total):
+        print("\r{} {} of {} users".format(
+            'Added' if operation == 'add' else 'Removed', done, total),
+            end='\n' if done == total else '', file=sys.stderr, flush=True)
+
+    from ldap3.core.exceptions import LDAPInsufficientAccessRightsResult
+
+    stdin = sys.stdin
+    if tty is not None:
+        sys.stdin = tty
+    try:
+        with change_session(common_config, args.username, resolve_roster,
+                            rows, inst_config['rights'],
+                            chunk_size) as (ad, plan):
+            try:
+                results = apply_roster(ad, rows, plan, operation,
+                                       chunk_size, progress)
+            except LDAPInsufficientAccessRightsResult:
+                raise RuntimeError("Error changing group members, check "
+                                   "you have the correct permission.") \
+                    from None
+    finally:
+        if tty is not None:
+            sys.stdin = stdin
+            tty.close()
+
+    stream = None
+    if args.results is not None:
+        stream = open(args.results, 'w', newline='')
+    try:
+        with get_writer(args.format, RESULT_FIELDS, RESULT_NAMES,
+                        stream) as writer:
+            for result in results:
+                if result['right'] is not None:
+                    result = {**result, 'right': result['right'].upper()}
+                writer.write(result)
+    finally:
+        if stream is not None:
+            stream.close()
+
+    counts = dict()
+    for result in results:
+        counts[result['result']] = counts.get(result['result'], 0) + 1
+    print("{} rows : {}".format(len(rows), ', '.join(
+        '{} {}'.format(n, name) for name, n in sorted(counts.items()))),
+        file=sys.stderr)
+
+    if counts.get('error'):
+        sys.exit(1)
+
+
+def desired_state(value):
+    """Parse a RIGHT=FILE argument"""
+    right, sep, filename = value.partition('=')
+    if not sep or not right or not filename:
+        raise argparse.ArgumentTypeError("must be RIGHT=FILE")
+    return right.lower(), filename
+
+
+def n2sn_sync_rights():
+    parser = base_argparser(
+        'Make the rights of an instrument match desired state files',
+        auth=True)
+
+    parser.add_argument(
+        'states', metavar='RIGHT=FILE', type=desired_state, nargs='+',
+        help='The users who should hold RIGHT, as a roster (a list or '
+             'CSV file of logins or life/guest numbers)'
+    )
+    parser.add_argument(
+        '--dry-run', dest='dry_run', action='store_true',
+        help='Show the changes without making them'
+    )
+    parser.add_argument(
+        '--allow-empty', dest='allow_empty', action='store_true',
+        help='Allow a state file listing no users, removing every user '
+             'from the right'
+    )
+    parser.add_argument(
+        '--results', dest='results', action='store', metavar='FILE',
+        default=None,
+        help='Write the changes to FILE instead of standard output'
+    )
+    parser.add_argument(
+        '--chunk-size', dest='chunk_size', action='store', type=int,
+        default=None,
+        help='Users to look up or change in one request (default: 100)'
+    )
+    add_format_argument(parser)
+
+    args = parse_args(parser)
+
+    common_config, inst_config = read_config(parser, args.instrument)
+
+    from .output import get_writer
+    from .roster import read_roster, CHUNK_SIZE
+    from .sync import (plan_sync, apply_sync, sync_results,
+                       RESULT_FIELDS, RESULT_NAMES)
+
+    desired = dict()
+    for right, filename in args.states:
+        if right not in inst_config['rights']:
+            print(parser.error(
+                "You must specify a right from the options: {}".format(
+                    ', '.join(inst_config['rights']).upper())))
+        with open(filename, newline='') as f:
+            desired.setdefault(right, []).extend(read_roster(f))
+        if not desired[right] and not args.allow_empty:
+            print(parser.error(
+                "{} lists no users, use --allow-empty to remove every "
+                "user from right {}".format(filename, right.upper())))
+
+    chunk_size = args.chunk_size or CHUNK_SIZE
+
+    def progress(done, total):
+        print("\rChanged {} of {} users".format(done, total),
+              end='\n' if done == total else '', file=sys.stderr,
+              flush=True)
+
+    if args.dry_run:
+        from .utils import directory
+
+        with directory(common_config['servers'],
+                       common_config['group_search'],
+                       common_config['user_search'],
+                       common_config.get('ldap_ca_cert', None)) as ad:
+            results = sync_results(plan_sync(ad, desired,
+                                             inst_config['rights'],
+                                             chunk_size))
+    else:
+        from ldap3.core.exceptions import LDAPInsufficientAccessRightsResult
+
+        with change_session(common_config, args.username, plan_sync,
+                            desired, inst_config['rights'],
+                            chunk_size) as (ad, plan):
+            try:
+                results = apply_sync(ad, plan, chunk_size, progress)
+            except LDAPInsufficientAccessRightsResult:
+                raise RuntimeError("Error changing group members, check "
+                                   "you have the correct permission.") \
+                    from None
+
+    stream = None
+    if args.results is not None:
+        stream = open(args.results, 'w', newline='')
+    try:
+        with get_writer(args.format, RESULT_FIELDS, RESULT_NAMES,
+                        stream) as writer:
+            for result in results:
+                writer.write({**result, 'right': result['right'].upper()})
+    finally:
+        if stream is not None:
+            stream.close()
+
+    counts = dict()
+    for result in results:
+        key = '{} {}'.format(result['action'], result['result'])
+        counts[key] = counts.get(key, 0) + 1
+    summary = ', '.join('{} {}'.format(n, name)
+                        for name, n in sorted(counts.items()))
+    print("{} for instrument {} : {}".format(
+        'Dry run' if args.dry_run else 'Sync',
+        inst_config['name'].upper(), summary or 'no changes'),
+        file=sys.stderr)
+
+    if any(r['result'] == 'error' for r in results):
+        sys.exit(1)
+
+
+def n2sn_snapshot_rights():
+    parser = base_argparser(
+        'Write a snapshot of who holds the rights of every instrument',
+        False)
+
+    parser.add_argument(
+        'output', metavar='FILE',
+        help="File to write the snapshot to, '-' for standard output"
+    )
+    parser.add_argument(
+        '-i', '--instrument', '--beamline', dest='instruments',
+        action='append', default=None, metavar='INSTRUMENT',
+        help='Only include INSTRUMENT (may be given more than once; '
+             'default: all instruments)'
+    )
+
+    args = parse_args(parser)
+    config = find_config()
+    common_config = config['common']
+
+    instruments = config['instruments']
+    if args.instruments is not None:
+        unknown = set(args.instruments) - set(instruments)
+        if unknown:
+            print(parser.error("instrument '{}' is not defined in the "
+                               "config file.".format(unknown.pop())))
+        instruments = {name: instruments[name] for name in args.instruments}
+
+    from .snapshot import take_snapshot, write_snapshot
+    from .utils import directory
+
+    with directory(common_config['servers'],
+                   common_config['group_search'],
+                   common_config['user_search'],
+                   common_config.get('ldap_ca_cert', None)) as ad:
+        snapshot = take_snapshot(ad, instruments)
+
+    if args.output == '-':
+        write_snapshot(snapshot, sys.stdout.buffer)
+    else:
+        tmp = '{}.{}'.format(args.output, os.getpid())
+        with open(tmp, 'wb') as f:
+            write_snapshot(snapshot, f)
+        os.replace(tmp, args.output)
+
+    print("Snapshot of {} rights in {} groups taken at {}".format(
+        len(snapshot['rights']), len(snapshot['groups']),
+        snapshot['time']), file=sys.stderr)
+    for group in sorted(snapshot['missing']):
+        print("Group {} was not found".format(group), file=sys.stderr)
+
+
+def n2sn_diff_rights():
+    parser = base_argparser(
+        'Show who gained or lost rights between two snapshots', False)
+
+    parser.add_argument(
+        'old', metavar='OLD', help='The earlier snapshot'
+    )
+    parser.add_argument(
+        'new', metavar='NEW', help='The later snapshot'
+    )
+    parser.add_argument(
+        '-i', '--instrument', '--beamline', dest='instruments',
+        action='append', default=None, metavar='INSTRUMENT',
+        help='Only show INSTRUMENT (may be given more than once)'
+    )
+    add_format_argument(parser)
 
-                    try:
-                        print('')
-                        for u in user_dn:
-                            print("Removing user : {}".format(u[1]))
-                            ad.remove_user_from_group_by_dn(
-                                group['distinguishedName'], u[0]
-                            )
+    args = parse_args(parser)
 
-                    except LDAPInsufficientAccessRightsResult:
-                        raise RuntimeError("Error removing user from group, "
-                                           "check you have the correct "
-                                           "permission.") from None
+    from .output import get_writer
+    from .snapshot import (read_snapshot, diff_snapshots, missing_rights,
+                           DIFF_FIELDS, DIFF_NAMES)
 
-                    print("\nSuccessfully removed all users"
-                          " for instrument {} with right '{}'\n"
-                          .format(inst_config['name'].upper(),
-                                  right.upper()))
+    snapshots = list()
+    for filename in (args.old, args.new):
+        with open(filename, 'rb') as f:
+            snapshots.append(read_snapshot(f))
+
+    changes = diff_snapshots(*snapshots, instruments=args.instruments)
+    for name, right in missing_rights(*snapshots,
+                                      instruments=args.instruments):
+        print("Right {} of {} left out, its group was not found".format(
+            right.upper(), name.upper()), file=sys.stderr)
+
+    if args.format == 'table':
+        print("\nChanges from {} to {}\n".format(
+            snapshots[0]['time'], snapshots[1]['time']))
+
+    with get_writer(args.format, DIFF_FIELDS, DIFF_NAMES) as writer:
+        for change in changes:
+            writer.write({**change, 'instrument': change['instrument']
+                          .upper(), 'right': change['right'].upper()})
 
 
 def n2sn_add_user():
@@ -306,6 +888,36 @@ def n2sn_search_user():
         help='Given name (forename) of user',
     )
 
+    parser.add_argument(
+        '--name', dest='name', action='store',
+        help='Match name, login or e-mail of user (ambiguous name '
+             'resolution)',
+    )
+
+    parser.add_argument(
+        '--explain', dest='explain', action='store_true',
+        help='Show the LDAP search filter plan and exit',
+    )
+
+    parser.add_argument(
+        '--limit', dest='limit', action='store', type=int_at_least(1),
+        help='Show at most LIMIT users sorted by name',
+    )
+
+    parser.add_argument(
+        '--offset', dest='offset', action='store', type=int_at_least(0),
+        default=0,
+        help='Skip the first OFFSET users (with --limit)',
+    )
+
+    parser.add_argument(
+        '--more', dest='more', action='store_true',
+        help='Page through the users interactively (with --limit)',
+    )
+
+    add_format_argument(parser)
+    add_service_argument(parser)
+
     type_group = parser.add_mutually_exclusive_group()
     type_group.add_argument(
         '--guest', dest='type', action='store_const',
@@ -328,24 +940,125 @@ def n2sn_search_user():
         help='Limit to accounts that are CFN users'
     )
 
-    args = parser.parse_args()
-
-    common_config, inst_config = read_config(parser, no_inst=True)
+    args = parse_args(parser)
 
     if ((args.surname is None) and
        (args.givenname is None) and
+       (args.name is None) and
        (args.type is None)):
 
         # Thats a lot of users!
         print(parser.error("You must limit the search!"
                            " Do you really want ALL users?"))
 
-    table = n2sn_list_user_search_as_table(
-        common_config['server'],
+    if args.explain:
+        print(plan_user_search(args.surname, args.givenname,
+                               args.type, args.name).explain())
+        return
+
+    if (args.more or args.offset) and args.limit is None:
+        args.limit = 25
+
+    use_service(args)
+
+    common_config, inst_config = read_config(parser, no_inst=True)
+
+    from .utils import (n2sn_list_user_search_pages,
+                        n2sn_write_user_search, write_users)
+
+    if args.limit is not None:
+        pages = n2sn_list_user_search_pages(
+            common_config['servers'],
+            common_config['group_search'].strip('"'),
+            common_config['user_search'].strip('"'),
+            args.surname, args.givenname, args.type,
+            ca_certs_file=common_config.get('ldap_ca_cert', None),
+            name=args.name, offset=args.offset, limit=args.limit
+        )
+
+        for users, first, total in pages:
+            write_users(users, fmt=args.format, sort=False)
+            if args.format == 'table':
+                print("Users {} to {} of {}".format(
+                    first + 1, min(first + args.limit, total), total))
+
+            if not args.more or first + args.limit >= total:
+                break
+            if input("-- Enter for next page, q to quit -- ") \
+                    .strip().lower() == 'q':
+                break
+
+        pages.close()
+        return
+
+    n2sn_write_user_search(
+        common_config['servers'],
         common_config['group_search'].strip('"'),
         common_config['user_search'].strip('"'),
         args.surname, args.givenname, args.type,
         ca_certs_file=common_config.get('ldap_ca_cert', None),
+        name=args.name, fmt=args.format
+    )
+
+
+def n2sn_query_service():
+    parser = base_argparser(
+        'Serve read only directory queries as JSON over HTTP',
+        False
+    )
+
+    parser.add_argument(
+        '--host', dest='host', action='store', default='127.0.0.1',
+        help='Address to listen on (default: 127.0.0.1)'
+    )
+    parser.add_argument(
+        '--port', dest='port', action='store', type=int, default=None,
+        help='Port to listen on (default: 8389)'
+    )
+    parser.add_argument(
+        '--connections', dest='connections', action='store', type=int,
+        default=4, help='Most directory connections to hold (default: 4)'
+    )
+    parser.add_argument(
+        '--cache-ttl', dest='cache_ttl', action='store', type=float,
+        default=60, help='Seconds to keep answers (default: 60)'
+    )
+    parser.add_argument(
+        '--cache-size', dest='cache_size', action='store', type=int,
+        default=1024, help='Most answers to keep (default: 1024)'
     )
 
-    print(table)
+    args = parse_args(parser)
+    config = find_config()
+    common_config = config['common']
+
+    from . import metrics
+    from .cache import Memo
+    from .ldap import ADObjects
+    from .service import (ConnectionPool, QueryService, serve,
+                          DEFAULT_PORT)
+
+    metrics.enable()
+
+    def connect():
+        return ADObjects(
+            common_config['servers'],
+            common_config['group_search'].strip('"'),
+            common_config['user_search'].strip('"'),
+            ca_certs_file=common_config.get('ldap_ca_cert', None),
+            cache_size=0)
+
+    pool = ConnectionPool(connect, args.connections, timeout=60)
+    service = QueryService(
+        pool, Memo('service', args.cache_size, args.cache_ttl), config)
+    server = serve(service, args.host, args.port or DEFAULT_PORT)
+
+    print("Serving directory queries on http://{}:{}/"
+          .format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
@@ -0,0 +1,138 @@
+"""Load and cache the tools configuration file
+
+The YAML file is validated once and compiled into a normalized form
+which is cached with marshal, keyed by the file's path, size and mtime.
+Later loads of an unchanged file read the cache and never import yaml.
+
+The compiled config is the parsed file with:
+
+* instrument right names case folded
+* ``common['servers']``, the list of servers from ``common['server']``,
+  which the tools connect to the first answering of
+* ``groups``, a map of lower case group name to a list of
+  (instrument, right) pairs holding that group
+* ``instrument_groups``, a map of name to a list of instruments, from
+  lists or comma separated strings
+"""
+import marshal
+import os
+
+from .profiling import profiler
+
+CACHE_VERSION = 2
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'n2sn_tools')
+
+
+def _cache_file(filename):
+    key = os.path.abspath(filename).strip(os.sep).replace(os.sep, '%')
+    return os.path.join(cache_dir(), 'config-{}.marshal'.format(key))
+
+
+def parse_list(value):
+    """Get a list of names from a comma separated string, or a list"""
+    if value is None:
+        return list()
+    if isinstance(value, str):
+        value = value.split(',')
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def compile_config(config):
+    """Validate a parsed config file and return its normalized form"""
+    if not isinstance(config, dict):
+        raise RuntimeError("Config file must be a mapping")
+
+    common = config.get('common')
+    if common is not None:
+        if not isinstance(common, dict):
+            raise RuntimeError("Section 'common' must be a mapping")
+        common = dict(common)
+        common['servers'] = parse_list(common.get('server'))
+
+    instruments = dict()
+    groups = dict()
+    for name, inst in (config.get('instruments') or {}).items():
+        if not isinstance(inst, dict) or \
+           not isinstance(inst.get('rights'), dict):
+            raise RuntimeError("Instrument '{}' must define 'rights'"
+                               .format(name))
+        inst = dict(inst)
+        inst['rights'] = {str(right).lower(): group
+                          for right, group in inst['rights'].items()}
+        for right, group in inst['rights'].items():
+            groups.setdefault(str(group).lower(), []).append((name, right))
+        instruments[name] = inst
+
+    instrument_groups = config.get('instrument_groups') or {}
+    if not isinstance(instrument_groups, dict):
+        raise RuntimeError("Section 'instrument_groups' must be a mapping")
+    instrument_groups = {str(name): parse_list(members)
+                         for name, members in instrument_groups.items()}
+    for name, members in instrument_groups.items():
+        if not members:
+            raise RuntimeError("Instrument group '{}' is empty"
+                               .format(name))
+        for member in members:
+            if member not in instruments:
+                raise RuntimeError("Instrument group '{}' names undefined "
+                                   "instrument '{}'".format(name, member))
+
+    out = {k: v for k, v in config.items()
+           if k not in ('common', 'instruments', 'instrument_groups')}
+    out['instruments'] = instruments
+    out['groups'] = groups
+    out['instrument_groups'] = instrument_groups
+    if common is not None:
+        out['common'] = common
+    return out
+
+
+def _parse_yaml(f):
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(f, Loader=loader)
+
+
+def load_config(filename, use_cache=True):
+    """Load a config file, using the compiled cache if it is current
+
+    Raises OSError if the file can not be read.
+    """
+    st = os.stat(filename)
+    key = [os.path.abspath(filename), st.st_mtime_ns, st.st_size,
+           CACHE_VERSION]
+    cache = _cache_file(filename)
+
+    if use_cache:
+        try:
+            # marshal.load() reads a file in small pieces, read it whole
+            with open(cache, 'rb') as f:
+                cached = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            if isinstance(cached, dict) and cached.get('key') == key:
+                profiler.count('cache.config.hit')
+                return cached['config']
+        profiler.count('cache.config.miss')
+
+    with open(filename) as f:
+        config = compile_config(_parse_yaml(f))
+
+    if use_cache:
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            tmp = '{}.{}'.format(cache, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(marshal.dumps({'key': key, 'config': config}))
+            os.replace(tmp, cache)
+        except (OSError, ValueError):
+            # Not writable, or values marshal can not store
+            pass
+
+    return config
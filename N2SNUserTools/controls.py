@@ -0,0 +1,142 @@
+"""LDAP controls not provided by ldap3
+
+Server Side Sort (RFC 2891), Virtual List View
+(draft-ietf-ldapext-ldapv3-vlv) and Active Directory's Permissive Modify.
+"""
+from pyasn1.codec.ber import decoder
+from pyasn1.type.univ import (Sequence, SequenceOf, Choice, OctetString,
+                              Integer, Boolean, Enumerated)
+from pyasn1.type.namedtype import (NamedTypes, NamedType, OptionalNamedType,
+                                   DefaultedNamedType)
+from pyasn1.type.tag import (Tag, tagClassContext, tagFormatSimple,
+                             tagFormatConstructed)
+from ldap3.protocol.controls import build_control
+
+SORT_REQUEST_OID = '1.2.840.113556.1.4.473'
+SORT_RESPONSE_OID = '1.2.840.113556.1.4.474'
+VLV_REQUEST_OID = '2.16.840.1.113730.3.4.9'
+VLV_RESPONSE_OID = '2.16.840.1.113730.3.4.10'
+PERMISSIVE_MODIFY_OID = '1.2.840.113556.1.4.1413'
+
+
+def _context(tag, constructed=False):
+    return Tag(tagClassContext,
+               tagFormatConstructed if constructed else tagFormatSimple,
+               tag)
+
+
+class SortKey(Sequence):
+    # SortKey ::= SEQUENCE {
+    #     attributeType   AttributeDescription,
+    #     orderingRule    [0] MatchingRuleId OPTIONAL,
+    #     reverseOrder    [1] BOOLEAN DEFAULT FALSE }
+    componentType = NamedTypes(
+        NamedType('attributeType', OctetString()),
+        OptionalNamedType('orderingRule', OctetString().subtype(
+            implicitTag=_context(0))),
+        DefaultedNamedType('reverseOrder', Boolean(False).subtype(
+            implicitTag=_context(1))))
+
+
+class SortKeyList(SequenceOf):
+    componentType = SortKey()
+
+
+class SortResult(Sequence):
+    # SortResult ::= SEQUENCE {
+    #     sortResult      ENUMERATED,
+    #     attributeType   [0] AttributeDescription OPTIONAL }
+    componentType = NamedTypes(
+        NamedType('sortResult', Enumerated()),
+        OptionalNamedType('attributeType', OctetString().subtype(
+            implicitTag=_context(0))))
+
+
+class ByOffset(Sequence):
+    tagSet = Sequence.tagSet.tagImplicitly(_context(0, True))
+    componentType = NamedTypes(
+        NamedType('offset', Integer()),
+        NamedType('contentCount', Integer()))
+
+
+class VLVTarget(Choice):
+    componentType = NamedTypes(
+        NamedType('byOffset', ByOffset()),
+        NamedType('greaterThanOrEqual', OctetString().subtype(
+            implicitTag=_context(1))))
+
+
+class VLVRequest(Sequence):
+    # VirtualListViewRequest ::= SEQUENCE {
+    #     beforeCount    INTEGER (0..maxInt),
+    #     afterCount     INTEGER (0..maxInt),
+    #     target         CHOICE { byOffset [0] ..., greaterThanOrEqual [1] },
+    #     contextID      OCTET STRING OPTIONAL }
+    componentType = NamedTypes(
+        NamedType('beforeCount', Integer()),
+        NamedType('afterCount', Integer()),
+        NamedType('target', VLVTarget()),
+        OptionalNamedType('contextID', OctetString()))
+
+
+class VLVResponse(Sequence):
+    # VirtualListViewResponse ::= SEQUENCE {
+    #     targetPosition    INTEGER (0..maxInt),
+    #     contentCount      INTEGER (0..maxInt),
+    #     virtualListViewResult ENUMERATED,
+    #     contextID     OCTET STRING OPTIONAL }
+    componentType = NamedTypes(
+        NamedType('targetPosition', Integer()),
+        NamedType('contentCount', Integer()),
+        NamedType('virtualListViewResult', Enumerated()),
+        OptionalNamedType('contextID', OctetString()))
+
+
+def sort_control(attributes, criticality=True):
+    """Server side sort on a list of attributes (prefix '-' to reverse)"""
+    keys = SortKeyList()
+    for n, attribute in enumerate(attributes):
+        key = SortKey()
+        key['attributeType'] = attribute.lstrip('-')
+        if attribute.startswith('-'):
+            key['reverseOrder'] = True
+        keys[n] = key
+
+    return build_control(SORT_REQUEST_OID, criticality, keys)
+
+
+def vlv_control(offset, count, context_id=None, criticality=True):
+    """Virtual list view of count entries starting at offset (from 0)"""
+    target = VLVTarget()
+    target['byOffset']['offset'] = offset + 1
+    target['byOffset']['contentCount'] = 0
+
+    request = VLVRequest()
+    request['beforeCount'] = 0
+    request['afterCount'] = max(count - 1, 0)
+    request['target'] = target
+    if context_id:
+        request['contextID'] = context_id
+
+    return build_control(VLV_REQUEST_OID, criticality, request)
+
+
+def permissive_modify_control(criticality=True):
+    """Make adding a present value or deleting an absent one succeed"""
+    return build_control(PERMISSIVE_MODIFY_OID, criticality, None)
+
+
+def decode_sort_response(value):
+    resp, _ = decoder.decode(value, asn1Spec=SortResult())
+    return int(resp['sortResult'])
+
+
+def decode_vlv_response(value):
+    resp, _ = decoder.decode(value, asn1Spec=VLVResponse())
+    out = {'target_position': int(resp['targetPosition']),
+           'content_count': int(resp['contentCount']),
+           'result': int(resp['virtualListViewResult']),
+           'context_id': None}
+    if resp['contextID'].hasValue():
+        out['context_id'] = bytes(resp['contextID'])
+    return out
@@ -0,0 +1,143 @@
+"""Build LDAP search filters for directory queries.
+
+The planner drops terms that add no constraint, puts terms on attributes
+that Active Directory indexes by default ahead of those it has to
+evaluate by scanning, adds object class guards so the DC can use the
+``objectCategory`` index when no other term can and escapes user
+supplied values (RFC 4515).
+"""
+import re
+
+# Attributes indexed by a default Active Directory schema
+INDEXED_ATTRIBUTES = {'anr', 'cn', 'displayName', 'givenName', 'mail',
+                      'name', 'objectCategory', 'sAMAccountName', 'sn',
+                      'userPrincipalName'}
+
+USER_GUARD = [('objectCategory', 'person'), ('objectClass', 'user')]
+
+_ESCAPE = {'\\': '\\5c', '(': '\\28', ')': '\\29', '\x00': '\\00'}
+
+# An attribute description (and matching rule) at the start of an item
+_ATTRIBUTE = re.compile(r'\(\s*([\w.;-]+(?::[\w.]+)*)\s*(?=[~<>:]?=)')
+
+
+def normalize_filter(search_filter):
+    """Case fold the attribute names of a filter
+
+    Attribute names are case insensitive, values are left as they are.
+    Used to key cached searches.
+    """
+    return _ATTRIBUTE.sub(lambda m: '(' + m.group(1).lower(),
+                          search_filter.strip())
+
+
+def escape_filter_value(value, wildcard=False):
+    """Escape a value for use in an LDAP filter
+
+    If wildcard is True then '*' is passed through as a substring
+    wildcard, otherwise it is escaped and matched literally.
+    """
+    out = ''.join(_ESCAPE.get(c, c) for c in str(value))
+    if not wildcard:
+        out = out.replace('*', '\\2a')
+    return out
+
+
+class FilterTerm(object):
+    def __init__(self, attribute, value, wildcard=False):
+        self.attribute = attribute
+        self.value = value
+        self.wildcard = wildcard
+
+    @property
+    def kind(self):
+        if not self.wildcard or '*' not in self.value:
+            return 'equality'
+        if self.value.startswith('*'):
+            return 'substring'
+        return 'prefix'
+
+    @property
+    def indexed(self):
+        # A leading wildcard can not be answered from the index
+        return (self.attribute in INDEXED_ATTRIBUTES and
+                self.kind != 'substring')
+
+    def __str__(self):
+        return '({}={})'.format(
+            self.attribute, escape_filter_value(self.value, self.wildcard))
+
+
+class FilterPlan(object):
+    """An ordered AND of filter terms with notes on how it was built"""
+    def __init__(self, guard=None):
+        self.guard = [FilterTerm(a, v) for a, v in (guard or [])]
+        self.terms = list()
+        self.notes = list()
+
+    def add(self, attribute, value, wildcard=True):
+        """Add a term, dropping it if it does not constrain the search"""
+        if value is None or value.strip('*') == '':
+            self.notes.append('drop ({}={}): no constraint'.format(
+                attribute, '*' if value is None else value))
+            return
+
+        term = FilterTerm(attribute, value, wildcard)
+        self.terms.append(term)
+
+    @property
+    def ordered(self):
+        """The terms in the order they are sent: indexed terms, then the
+        terms the DC has to scan for, then the guard
+
+        The DC picks the index to read by how few entries it returns,
+        wherever the term is, and evaluates the other terms on each
+        candidate in order, so the guard, which nearly every candidate
+        passes, is checked last.
+        """
+        return [t for t in self.terms if t.indexed] + \
+            [t for t in self.terms if not t.indexed] + self.guard
+
+    @property
+    def filter(self):
+        terms = self.ordered
+        if len(terms) == 1:
+            return str(terms[0])
+        return '(&' + ''.join(str(t) for t in terms) + ')'
+
+    def explain(self):
+        lines = ['filter : {}'.format(self.filter)]
+        for term in self.ordered:
+            if term in self.guard:
+                lines.append('guard  {}{}'.format(
+                    term, ' (indexed)' if term.indexed else ''))
+                continue
+            lines.append('{:<6} {} ({}{})'.format(
+                'index' if term.indexed else 'scan', term, term.kind,
+                '' if term.attribute in INDEXED_ATTRIBUTES
+                else ', not indexed'))
+        for note in self.notes:
+            lines.append(note)
+        if not any(t.indexed for t in self.terms):
+            lines.append('warning: no indexed term, every object matching '
+                         'the guard is a candidate')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.filter
+
+
+def plan_user_search(surname=None, givenname=None, user_type=None,
+                     name=None):
+    """Plan a user search by name and account type
+
+    If name is given it is matched with Ambiguous Name Resolution (ANR)
+    which uses the indexes on the name, login and e-mail attributes.
+    """
+    plan = FilterPlan(USER_GUARD)
+    if name is not None:
+        plan.add('anr', name, wildcard=False)
+    plan.add('sn', surname)
+    plan.add('givenName', givenname)
+    plan.add('description', user_type)
+    return plan
@@ -1,12 +1,33 @@
-import ssl
+import atexit
+import threading
+import time
+import weakref
+from collections import deque
 from enum import IntEnum
 import datetime
 from getpass import getpass
-from ldap3 import (Server, Connection, Tls, NTLM,
-                   SASL, GSSAPI, SUBTREE)
+from ldap3 import (Server, ServerPool, Connection, NTLM, SASL, GSSAPI,
+                   BASE, SUBTREE, SYNC, FIRST, MODIFY_ADD, MODIFY_DELETE)
 from ldap3.core.exceptions import (LDAPAuthMethodNotSupportedResult,
                                    LDAPPackageUnavailableError,
-                                   LDAPInvalidCredentialsResult)
+                                   LDAPInvalidCredentialsResult,
+                                   LDAPBindError,
+                                   LDAPCommunicationError,
+                                   LDAPResponseTimeoutError,
+                                   LDAPServerPoolExhaustedError,
+                                   LDAPException,
+                                   LDAPOperationResult)
+from ldap3.utils.dn import safe_dn
+
+from .filters import escape_filter_value, plan_user_search, \
+    normalize_filter
+from .cache import Memo
+from .controls import (sort_control, vlv_control, decode_sort_response,
+                       decode_vlv_response, permissive_modify_control,
+                       SORT_RESPONSE_OID, VLV_RESPONSE_OID)
+from .profiling import profiler
+from .throttle import Throttle
+from .tls import shared_tls
 
 from ldap3.extend.microsoft.addMembersToGroups \
     import ad_add_members_to_groups
@@ -17,6 +38,26 @@ from ldap3.extend.microsoft.removeMembersFromGroups \
 
 mdci = datetime.datetime(1601, 1, 1, tzinfo=datetime.timezone.utc)
 
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+# Modify requests kept in flight on one connection by default
+WRITE_WINDOW = 8
+
+# Raised when the connection to the server is lost or stops answering
+CONNECTION_ERRORS = (LDAPCommunicationError, LDAPResponseTimeoutError,
+                     LDAPServerPoolExhaustedError)
+
+# Reusable connections idle this many seconds are closed, and those idle
+# CHECK_AFTER seconds have the rootDSE read before they are used again
+IDLE_TIMEOUT = 300
+CHECK_AFTER = 30
+
+# ADObjects.shared() instances by server and principal
+_shared = dict()
+_shared_lock = threading.Lock()
+# Reusable instances, closed at exit
+_reusable = weakref.WeakSet()
+
 
 def get_ad_time(adtime):
     if type(adtime) == datetime.datetime:
@@ -31,6 +72,43 @@ def get_ad_time(adtime):
         return a + b
 
 
+def entry_values(response_entry, attributes):
+    """Get attribute values from a search response entry
+
+    Values are returned as ldap3's Entry would, a single value as a
+    scalar, no values as None and several values as a list.
+    """
+    values = response_entry['attributes']
+    out = dict()
+    for key in attributes:
+        value = values.get(key)
+        if isinstance(value, list):
+            value = value[0] if len(value) == 1 else (value or None)
+        out[key] = value
+    return out
+
+
+def response_size(response):
+    """Get the number of bytes of attribute values in a search response"""
+    return sum(len(value)
+               for entry in response if entry['type'] == 'searchResEntry'
+               for values in entry['raw_attributes'].values()
+               # ldap3's mock gives None for an attribute left empty
+               for value in values or ())
+
+
+@atexit.register
+def _close_reusable():
+    for ad in list(_reusable):
+        ad._close_quietly()
+
+
+def _error_result(e):
+    """Get the result dict of an LDAPOperationResult"""
+    return {'result': e.result, 'description': e.description,
+            'dn': e.dn, 'message': e.message, 'type': e.type}
+
+
 class ADUserAccountControl(IntEnum):
     ADS_UF_SCRIPT = 0x00000001
     ADS_UF_ACCOUNTDISABLE = 0x00000002
@@ -64,41 +142,185 @@ class ADObjects(object):
                         'pwdLastSet', 'userAccountControl',
                         'lockoutTime']
     _LOCKOUT_TIME = datetime.timedelta(minutes=15)
+    # Resilient mode reconnects up to _RETRIES times for one operation,
+    # pausing _RETRY_BACKOFF seconds, doubling each time
+    _RETRIES = 4
+    _RETRY_BACKOFF = 0.5
+
+    # Defaults for options not given to __init__, set by the console
+    # scripts for every connection they make
+    session_defaults = dict()
 
     def __init__(self, server,
                  group_search=None,
                  user_search=None,
                  authenticate=False,
                  username=None,
-                 ca_certs_file=None):
+                 ca_certs_file=None,
+                 client_strategy=SYNC,
+                 record=None,
+                 replay=None,
+                 replay_latency=None,
+                 cache_size=256,
+                 cache_ttl=60,
+                 write_window=None,
+                 write_rate=None,
+                 throttle=None,
+                 resilient=False,
+                 reusable=False,
+                 idle_timeout=IDLE_TIMEOUT):
 
-        tls_conf = Tls(
-            ca_certs_file=ca_certs_file,
-            validate=ssl.CERT_REQUIRED,
-            version=ssl.PROTOCOL_TLSv1_2
-        )
+        if isinstance(server, str):
+            server = [server]
+        if isinstance(server, (list, tuple)):
+            # One SSL context per CA file, resuming TLS sessions
+            servers = [Server(name, use_ssl=True,
+                              tls=shared_tls(ca_certs_file))
+                       for name in server]
+            if len(servers) == 1:
+                self.server = servers[0]
+            else:
+                # Connect to the first server answering, in order, and
+                # raise if none does
+                self.server = ServerPool(servers, FIRST, active=1)
+        else:
+            # An ldap3 Server (or ServerPool) set up by the caller
+            self.server = server
 
-        self.server = Server(server, use_ssl=True, tls=tls_conf)
+        self.client_strategy = client_strategy
+        self.record = record or self.session_defaults.get('record')
+        self.replay = replay or self.session_defaults.get('replay')
+        self.replay_latency = replay_latency or \
+            self.session_defaults.get('replay_latency')
+        # Bulk writes are paced by a Throttle made on first use
+        self.write_window = write_window or \
+            self.session_defaults.get('write_window') or WRITE_WINDOW
+        self.write_rate = write_rate or \
+            self.session_defaults.get('write_rate')
+        self.throttle = throttle
+        # Reconnect and retry when the connection is lost, binding again
+        # as the first bind did
+        self.resilient = resilient or \
+            self.session_defaults.get('resilient', False)
+        self._credentials = None
+        # A reusable instance binds on first use and stays bound between
+        # with blocks until idle for idle_timeout seconds
+        self.reusable = reusable or \
+            self.session_defaults.get('reusable', False)
+        self.idle_timeout = idle_timeout
+        self._connection = None
+        # The host last bound to, a ServerPool may move to another
+        self._server_host = None
+        self._users = 0
+        self._last_used = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        if self.reusable:
+            _reusable.add(self)
         self.authenticate = authenticate
         self.username = username
         self.user_prefix = 'BNL\\'
         self._group_search = group_search
         self._user_search = user_search
+        self._vlv_context = dict()
+
+        # Searches are memoized per instance, cache_size of 0 turns
+        # this off
+        self._memo = None
+        if cache_size:
+            self._memo = Memo('ldap', cache_size, cache_ttl)
+
+    @classmethod
+    def shared(cls, server, group_search=None, user_search=None,
+               authenticate=False, username=None, **kwargs):
+        """Get the process wide reusable instance for a server and
+        principal
+
+        It is made on the first call, so later calls and with blocks use
+        its connection without a new handshake and bind. The principal
+        is username, the Kerberos ticket when authenticating without a
+        username, or anonymous. Instances are also kept apart by search
+        bases, client strategy and CA file, so each caller's certificates
+        are verified as it asked.
+        """
+        if isinstance(server, list):
+            server = tuple(server)
+        key = (cls, server if isinstance(server, (str, tuple))
+               else id(server),
+               group_search, user_search, authenticate, username,
+               kwargs.get('client_strategy', SYNC),
+               kwargs.get('ca_certs_file'))
+        with _shared_lock:
+            ad = _shared.get(key)
+            if ad is None:
+                ad = _shared[key] = cls(
+                    server, group_search, user_search,
+                    authenticate=authenticate, username=username,
+                    reusable=True, **kwargs)
+        return ad
+
+    @property
+    def connection(self):
+        """The ldap3 connection, bound on first use if reusable"""
+        if self._connection is None and self.reusable:
+            with self._lock:
+                if self._connection is None:
+                    if self._credentials is None:
+                        self.open()
+                    else:
+                        # Bound before, bind again without prompting
+                        self._rebind()
+        return self._connection
+
+    @connection.setter
+    def connection(self, connection):
+        self._connection = connection
 
     def __enter__(self):
+        if not self.reusable:
+            self.open()
+            return self
+
+        with self._lock:
+            self._users += 1
+            idle = time.monotonic() - self._last_used
+        if self._connection is not None and idle > CHECK_AFTER:
+            self._check()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not self.reusable:
+            self.close()
+            return
+
+        with self._lock:
+            self._users -= 1
+            self._last_used = time.monotonic()
+            if self._timer is None and self.idle_timeout is not None:
+                self._arm(self.idle_timeout)
+
+    def open(self):
+        """Connect and bind, prompting for a password if needed"""
+        if self.replay is not None:
+            # Answer from a recorded session, no server is contacted
+            from .replay import ReplayConnection
+            self.connection = ReplayConnection(self.replay,
+                                               self.replay_latency)
+            return
+
         if self.authenticate:
             _auth = False
 
             if self.username is None:
                 # We have no username and GSSAPI, try
                 # GSSAPI (Kerberos) first
-                self.connection = Connection(self.server,
-                                             authentication=SASL,
-                                             sasl_mechanism=GSSAPI,
-                                             auto_bind=False,
-                                             raise_exceptions=True)
+                credentials = dict(authentication=SASL,
+                                   sasl_mechanism=GSSAPI,
+                                   raise_exceptions=True)
+                self._connect(**credentials)
                 try:
-                    self.connection.bind()
+                    with self._span('ldap.bind', method='GSSAPI'):
+                        self.connection.bind()
                 except LDAPAuthMethodNotSupportedResult:
                     _auth = False
                 except LDAPPackageUnavailableError:
@@ -113,18 +335,21 @@ class ADObjects(object):
 
                 password = getpass("Password : ")
 
-                self.connection = Connection(
-                    self.server, user=self.user_prefix + self.username,
-                    password=password, authentication=NTLM,
-                    auto_bind=True, raise_exceptions=True)
+                credentials = dict(user=self.user_prefix + self.username,
+                                   password=password, authentication=NTLM,
+                                   raise_exceptions=True)
+                self._connect(**credentials)
                 try:
-                    self.connection.bind()
+                    self._bind()
                 except LDAPInvalidCredentialsResult:
                     _auth = False
                 else:
                     _auth = True
 
             if _auth:
+                if self.resilient or self.reusable:
+                    # Kept, with the password, for binding again
+                    self._credentials = credentials
                 whoami = self.connection.extend.standard.who_am_i()
                 print('\nAuthenticated as : {}'.format(str(whoami)))
             else:
@@ -132,50 +357,328 @@ class ADObjects(object):
                                    " Please check credentials") from None
         else:
             # Anonymous connection to LDAP server
-            self.connection = Connection(self.server,
-                                         auto_bind=True,
-                                         raise_exceptions=False)
+            self._credentials = dict(raise_exceptions=False)
+            self._connect(**self._credentials)
+            self._bind()
 
-        return self
+        self._note_server()
 
-    def __exit__(self, type, value, traceback):
-        self.connection.unbind()
+        if self.record is not None:
+            from .replay import RecordingConnection
+            self.connection = RecordingConnection(self.connection,
+                                                  self.record)
+
+    def close(self):
+        """Unbind, a reusable instance binds again on next use"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.unbind()
+
+    def _close_quietly(self):
+        try:
+            self.close()
+        except (LDAPException, OSError):
+            pass
+
+    def _arm(self, delay):
+        self._timer = threading.Timer(delay, self._close_idle)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _close_idle(self):
+        """Close the connection if it has been idle for idle_timeout"""
+        with self._lock:
+            self._timer = None
+            if self._connection is None:
+                return
+            idle = time.monotonic() - self._last_used
+            if self._users or idle < self.idle_timeout:
+                self._arm(self.idle_timeout - (0 if self._users else idle))
+                return
+            profiler.count('ldap.idle_close')
+            self._close_quietly()
+
+    def _check(self):
+        """Read the rootDSE, closing the connection if it fails so the
+        next use binds a new one"""
+        if self.record is not None or self.replay is not None:
+            return
+        connection = self._connection
+        try:
+            with self._span('ldap.check'):
+                status = connection.search('', '(objectClass=*)', BASE,
+                                           attributes=['currentTime'])
+                if not connection.strategy.sync:
+                    connection.get_response(status)
+            healthy = connection.bound and not connection.closed
+        except (LDAPException, OSError):
+            healthy = False
+        if not healthy:
+            profiler.count('ldap.check_failed')
+            self._close_quietly()
+
+    def _connect(self, **kwargs):
+        """Make the connection, unbound, with Connection's kwargs"""
+        self.connection = Connection(self.server,
+                                     client_strategy=self.client_strategy,
+                                     auto_bind=False, **kwargs)
+        self._instrument()
+
+    def _reconnect(self):
+        """Replace a lost connection, binding as the first bind did"""
+        try:
+            self._connection.unbind()
+        except LDAPException:
+            pass
+        self._rebind()
+
+    def _rebind(self):
+        """Open and bind a new connection as the first bind did"""
+        with self._span('ldap.reconnect'):
+            self._connect(**self._credentials)
+            if self._credentials.get('sasl_mechanism') == GSSAPI:
+                # Kerberos binds again from the credential cache
+                with self._span('ldap.bind', method='GSSAPI'):
+                    self.connection.bind()
+            else:
+                self._bind()
+        self._note_server()
+        # Sorted window contexts belong to the lost connection
+        self._vlv_context.clear()
+
+    def _note_server(self):
+        """Count a failover if bound to another server than last time"""
+        host = self._server_name()
+        if self._server_host not in (None, host):
+            profiler.count('ldap.failover')
+        self._server_host = host
+
+    def _recover(self, attempt, error):
+        """Reconnect after losing the connection on the attempt'th try,
+        or raise error if not resilient or out of tries"""
+        if not self.resilient or self._credentials is None or \
+                self.record is not None or attempt >= self._RETRIES:
+            raise error
+        profiler.count('ldap.retry')
+        time.sleep(self._RETRY_BACKOFF * 2 ** attempt)
+        try:
+            self._reconnect()
+        except CONNECTION_ERRORS:
+            # The server is still out of reach, the next try reconnects
+            pass
+
+    def _span(self, name, **values):
+        """Make a profiler span labelled with the server"""
+        span = profiler.span(name, **values)
+        if span.enabled:
+            span.set(server=self._server_name())
+        return span
+
+    def _server_name(self):
+        """Name the server connected to, or to be connected to by a
+        reusable instance not yet bound"""
+        server = getattr(self._connection, 'server', None) or self.server
+        if hasattr(server, 'servers'):
+            # A ServerPool, which picks its server on connecting
+            return ','.join(s.host for s in server.servers)
+        return getattr(server, 'host', str(server))
+
+    def _instrument(self):
+        """Count the LDAP operations sent while profiling"""
+        if not profiler.enabled:
+            return
+
+        send = self.connection.send
+
+        def counted_send(message_type, request, controls=None):
+            profiler.count('ldap.' + message_type)
+            return send(message_type, request, controls)
+
+        self.connection.send = counted_send
+
+    def _bind(self):
+        """Open and bind the connection as ldap3's auto_bind does
+
+        Each step is done separately so it can be timed.
+        """
+        with self._span('ldap.connect'):
+            if self.connection.closed:
+                self.connection.open(read_server_info=False)
+        with self._span('ldap.bind'):
+            self.connection.bind(read_server_info=False)
+            if not self.connection.bound:
+                error = self.connection.last_error
+                self.connection.unbind()
+                raise LDAPBindError('automatic bind not successful - {}'
+                                    .format(error))
+        with self._span('ldap.server_info'):
+            self.connection.refresh_server_info()
+
+    def _search(self, search_base, search_filter, attributes,
+                controls=None, **kwargs):
+        """Search, answering repeated questions from the memo
+
+        Searches with controls (sorted windows) are not memoized, nor
+        are the pages of paged searches: a page remembered without the
+        one before it would send its cookie to the server again, and
+        large listings would push every other answer out.
+        """
+        if self._memo is None or controls is not None or \
+           kwargs.get('paged_size'):
+            return self._search_directory(search_base, search_filter,
+                                          attributes, controls, **kwargs)
+
+        key = ('search', (search_base or '').lower(),
+               normalize_filter(search_filter),
+               tuple(sorted(a.lower() for a in attributes)),
+               tuple(sorted(kwargs.items())))
+        return self._memo.get(
+            key,
+            lambda: self._search_directory(search_base, search_filter,
+                                           attributes, **kwargs),
+            cacheable=lambda value: value[1]['result'] == 0)
+
+    def _invalidate_membership(self):
+        """Forget searches whose answers depend on group membership
+
+        A change to one group changes the nested membership of the
+        groups holding it, so every search matching on, or returning,
+        member or memberOf is dropped.
+        """
+        if self._memo is not None:
+            self._memo.invalidate(
+                lambda key: 'member' in key[2] or
+                any(a.startswith('member') for a in key[3]))
+
+    def _search_directory(self, search_base, search_filter, attributes,
+                          controls=None, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return self._search_once(search_base, search_filter,
+                                         attributes, controls, **kwargs)
+            except CONNECTION_ERRORS as e:
+                if kwargs.get('paged_cookie') or controls is not None:
+                    # Paged cookies and sorted window contexts belong
+                    # to the lost connection, _iter_pages() resumes
+                    raise
+                self._recover(attempt, e)
+                attempt += 1
+
+    def _search_once(self, search_base, search_filter, attributes,
+                     controls=None, **kwargs):
+        # Bind a reusable instance first, so the span times the search
+        connection = self.connection
+        with self._span('ldap.search') as span:
+            status = connection.search(
+                search_base=search_base,
+                search_scope=SUBTREE,
+                attributes=attributes,
+                search_filter=search_filter,
+                controls=controls,
+                **kwargs
+            )
+            if not connection.strategy.sync:
+                # ASYNC returns the message ID, wait for its reply
+                response, result = connection.get_response(status)
+            elif connection.strategy.thread_safe:
+                # SAFE_SYNC returns copies rather than setting
+                # connection.response, which other threads share
+                _, result, response, _ = status
+            else:
+                response = connection.response
+                result = connection.result
+            self._search_done(span, search_filter, response, result)
+
+        return response, result
+
+    def _search_done(self, span, search_filter, response, result):
+        if span.enabled:
+            span.set(filter=search_filter,
+                     result=(result or {}).get('description'),
+                     entries=len(response or []),
+                     bytes=response_size(response or []))
+
+    def _iter_pages(self, search_base, search_filter, attributes,
+                    page_size=500):
+        """Iterate over the responses of a paged search, one per page
+
+        In resilient mode a search losing its connection part way is
+        made again on a new one, as the cookie can not be used there,
+        and the entries already yielded are skipped.
+        """
+        cookie = None
+        seen = set() if self.resilient else None
+        restarted = False
+        attempt = 0
+        while True:
+            try:
+                response, result = self._search(search_base, search_filter,
+                                                attributes,
+                                                paged_size=page_size,
+                                                paged_cookie=cookie)
+            except CONNECTION_ERRORS as e:
+                if cookie is None:
+                    raise
+                self._recover(attempt, e)
+                attempt += 1
+                cookie = None
+                restarted = True
+                continue
+
+            if seen is not None:
+                before = len(seen)
+                if restarted:
+                    response = [entry for entry in response
+                                if entry['type'] != 'searchResEntry' or
+                                entry['dn'] not in seen]
+                seen.update(entry['dn'] for entry in response
+                            if entry['type'] == 'searchResEntry')
+                if len(seen) > before:
+                    # Only new entries count as getting further
+                    attempt = 0
+            yield response
+
+            cookie = result.get('controls', {}).get(PAGED_RESULTS_OID, {}) \
+                .get('value', {}).get('cookie')
+            if not cookie:
+                break
 
     def _get_group(self, search_filter):
-        self.connection.search(
-            search_base=self._group_search,
-            search_scope=SUBTREE,
-            attributes=self._GROUP_ATTRIBUTES,
-            search_filter=search_filter
-        )
+        response, _ = self._search(self._group_search, search_filter,
+                                   self._GROUP_ATTRIBUTES)
 
         # Make a dict of returned values
 
         rtn = list()
-        for entry in self.connection.entries:
-            rtn.append({key: entry[key].value
-                        for key in self._GROUP_ATTRIBUTES})
+        for entry in response:
+            if entry['type'] == 'searchResEntry':
+                rtn.append(entry_values(entry, self._GROUP_ATTRIBUTES))
 
         return rtn
 
-    def _calc_user_fields(self, entry):
+    def _calc_user_fields(self, user):
         """Calculate fields based on LDAP properties"""
         out = dict()
 
-        if 'pwdLastSet' in entry and 'userAccountControl' in entry:
-            pwd_last_set = get_ad_time(entry.pwdLastSet.value)
+        # Writers read set_passwd for every user, even one without these
+        out['set_passwd'] = False
+        if user.get('pwdLastSet') is not None and \
+           user.get('userAccountControl') is not None:
+            pwd_last_set = get_ad_time(user['pwdLastSet'])
 
-            user_account_control = int(entry.userAccountControl.value)
+            user_account_control = int(user['userAccountControl'])
             pwd_exp = bool(user_account_control &
                            ADUserAccountControl.ADS_UF_DONT_EXPIRE_PASSWD)
 
             if not pwd_exp and pwd_last_set == mdci:
                 out['set_passwd'] = True
-            else:
-                out['set_passwd'] = False
 
-        if 'lockoutTime' in entry:
-            lockout_time = entry.lockoutTime.value
+        if 'lockoutTime' in user:
+            lockout_time = user['lockoutTime']
             if lockout_time is None:
                 lockout_time = mdci
             else:
@@ -197,100 +700,492 @@ class ADObjects(object):
 
         return out
 
+    def _iter_users(self, response):
+        # Make a dict of returned values
+
+        for entry in response:
+            if entry['type'] == 'searchResEntry':
+                user = entry_values(entry, self._USER_ATTRIBUTES)
+                uf = self._calc_user_fields(user)
+                yield {**user, **uf}
+
+    def _decode_users(self, response):
+        with profiler.span('ldap.decode', entries=len(response)):
+            return list(self._iter_users(response))
+
+    def _iter_paged_users(self, search_base, search_filter, page_size):
+        for response in self._iter_pages(search_base, search_filter,
+                                         self._USER_ATTRIBUTES, page_size):
+            yield from self._decode_users(response)
+
     def _get_user(self, search_filter):
-        self.connection.search(
-            search_base=self._user_search,
-            search_scope=SUBTREE,
-            attributes=self._USER_ATTRIBUTES,
-            search_filter=search_filter
-        )
+        response, _ = self._search(self._user_search, search_filter,
+                                   self._USER_ATTRIBUTES)
 
-        # Make a dict of returned values
+        return self._decode_users(response)
 
-        rtn = list()
-        for entry in self.connection.entries:
-            uf = self._calc_user_fields(entry)
-            user = {key: entry[key].value
-                    for key in self._USER_ATTRIBUTES}
-            rtn.append({**user, **uf})
+    def _get_user_page(self, search_filter, offset, limit, sort_key):
+        controls = [sort_control([sort_key]),
+                    vlv_control(offset, limit,
+                                self._vlv_context.get(search_filter))]
+        response, result = self._search(self._user_search, search_filter,
+                                        self._USER_ATTRIBUTES, controls)
 
-        return rtn
+        if result['result'] == 12:
+            # unavailableCriticalExtension, the server can not sort or
+            # page so do it here
+            return self._sort_user_page(search_filter, offset, limit,
+                                        sort_key)
+
+        if result['result'] != 0:
+            raise RuntimeError("Sorted search failed : {}"
+                               .format(result['description']))
+
+        vlv = self._vlv_response(search_filter, result)
+        if vlv is None:
+            return self._sort_user_page(search_filter, offset, limit,
+                                        sort_key)
+
+        return self._decode_users(response)[:limit], \
+            vlv['content_count']
+
+    def _vlv_response(self, search_filter, result):
+        """Get the VLV response of a sorted search, or None if the server
+        ignored the controls or could not sort, leaving the entries in no
+        particular order"""
+        controls = result.get('controls') or {}
+        if SORT_RESPONSE_OID not in controls or \
+           VLV_RESPONSE_OID not in controls or \
+           decode_sort_response(controls[SORT_RESPONSE_OID]['value']):
+            profiler.count('ldap.unsorted')
+            return None
+
+        vlv = decode_vlv_response(controls[VLV_RESPONSE_OID]['value'])
+        self._vlv_context[search_filter] = vlv['context_id']
+        return vlv
+
+    def _sort_user_page(self, search_filter, offset, limit, sort_key):
+        """Get a window of users, sorting all of them here"""
+        users = sorted(self._get_user(search_filter),
+                       key=lambda u: u[sort_key] or '')
+        return users[offset:offset + limit], len(users)
 
     def get_user_by_id(self, id):
-        return self._get_user('(employeeID={})'.format(id))
+        return self._get_user('(employeeID={})'.format(
+            escape_filter_value(id)))
 
     def get_user_by_samaccountname(self, id):
-        return self._get_user('(sAMAccountName={})'.format(id))
+        return self._get_user('(sAMAccountName={})'.format(
+            escape_filter_value(id)))
 
     def get_user_by_dn(self, id):
-        return self._get_user('(distinguishedname={})'.format(id))
+        return self._get_user('(distinguishedname={})'.format(
+            escape_filter_value(id)))
 
-    def get_user_by_surname_and_givenname(self,
-                                          surname, givenname,
-                                          user_type):
-        if user_type is None:
-            user_type = '*'
-        if surname is None:
-            surname = '*'
-        if givenname is None:
-            givenname = '*'
+    def iter_users_by_attribute(self, attribute, values, chunk_size=100):
+        """Iterate over the users whose attribute is one of values
 
-        filter = '(&(sn={})(givenName={})(description={}))'.format(
-            surname, givenname, user_type)
+        Values are looked up chunk_size at a time with one OR filter per
+        chunk, rather than with a search each.
+        """
+        values = list(values)
+        for start in range(0, len(values), chunk_size):
+            ldap_filter = "(|{})".format(''.join(
+                '({}={})'.format(attribute, escape_filter_value(v))
+                for v in values[start:start + chunk_size]))
+            yield from self._iter_paged_users(self._user_search,
+                                              ldap_filter, 500)
 
-        return self._get_user(filter)
+    def get_user_by_surname_and_givenname(self,
+                                          surname, givenname,
+                                          user_type, name=None):
+        plan = plan_user_search(surname, givenname, user_type, name)
+        return self._get_user(plan.filter)
 
     def get_user_by_surname_and_givenname_dict(
-            self, surname, givenname, user_type):
+            self, surname, givenname, user_type, name=None):
         users = self.get_user_by_surname_and_givenname(
-            surname, givenname, user_type
+            surname, givenname, user_type, name
         )
         d = {u['userPrincipalName']: u for u in users}
         return d
 
+    def iter_user_by_surname_and_givenname(
+            self, surname, givenname, user_type, name=None, page_size=500):
+        """Iterate over users found by name, yielded as each page arrives"""
+        plan = plan_user_search(surname, givenname, user_type, name)
+        yield from self._iter_paged_users(self._user_search, plan.filter,
+                                          page_size)
+
+    def get_user_by_surname_and_givenname_page(
+            self, surname, givenname, user_type, name=None,
+            offset=0, limit=25, sort_key='displayName'):
+        """Get a window of users sorted by the server
+
+        Uses the Server Side Sort and Virtual List View controls so only
+        the requested users are transferred. Returns the list of users
+        and the number of users matching the search.
+        """
+        plan = plan_user_search(surname, givenname, user_type, name)
+        return self._get_user_page(plan.filter, offset, limit, sort_key)
+
     def get_group_by_samaccountname(self, id):
-        return self._get_group('(sAMAccountName={})'.format(id))
+        return self._get_group('(sAMAccountName={})'.format(
+            escape_filter_value(id)))
 
-    def get_group_members(self, group_name):
-        group = self.get_group_by_samaccountname(group_name)
+    def get_groups_by_samaccountname(self, ids, chunk_size=100):
+        """Get the groups whose sAMAccountName is one of ids
+
+        Groups are looked up chunk_size at a time with one OR filter per
+        chunk, rather than with a search each.
+        """
+        ids = list(ids)
+        groups = list()
+        for start in range(0, len(ids), chunk_size):
+            groups += self._get_group("(|{})".format(''.join(
+                '(sAMAccountName={})'.format(escape_filter_value(i))
+                for i in ids[start:start + chunk_size])))
+        return groups
 
+    def get_groups_by_member_dn(self, dn):
+        """Get the groups a user or group is in, including nested groups"""
+        return self._get_group(
+            '(&(objectCategory=group)'
+            '(member:1.2.840.113556.1.4.1941:={}))'.format(
+                escape_filter_value(dn)))
+
+    def _member_filter(self, group_name, group):
+        """Get the filter for users in a group, None if it was not found"""
         if len(group) > 1:
             raise RuntimeError(f"Group name '{group_name}' is not unique. "
                                f"Found groups: {group}")
         elif len(group) == 0:
-            return list()
+            return None
 
         group = group[0]
 
         ldap_filter = "(&(objectCategory=person)(objectClass=user)"
         ldap_filter += "(memberOf:1.2.840.113556.1.4.1941:="
-        ldap_filter += "{}))".format(group['distinguishedName'])
+        ldap_filter += "{}))".format(
+            escape_filter_value(group['distinguishedName']))
+        return ldap_filter
 
-        self.connection.search(
-            search_base=self._group_search,
-            search_scope=SUBTREE,
-            attributes=self._USER_ATTRIBUTES,
-            search_filter=ldap_filter
-        )
+    def iter_group_members(self, group_name, page_size=500):
+        """Iterate over the members of a group (including nested groups)
 
-        rtn = list()
-        for entry in self.connection.entries:
-            uf = self._calc_user_fields(entry)
-            user = {key: entry[key].value
-                    for key in self._USER_ATTRIBUTES}
-            rtn.append({**user, **uf})
+        Users are fetched with a paged search and yielded as each page
+        arrives.
+        """
+        ldap_filter = self._member_filter(
+            group_name, self.get_group_by_samaccountname(group_name))
+        if ldap_filter is None:
+            return
 
-        return rtn
+        yield from self._iter_paged_users(self._group_search, ldap_filter,
+                                          page_size)
+
+    def get_group_members(self, group_name):
+        return list(self.iter_group_members(group_name))
 
     def get_group_members_dict(self, groupname):
         members = self.get_group_members(groupname)
         d = {m['userPrincipalName']: m for m in members}
         return d
 
+    def _direct_member_filter(self, group_dn, user_dns=None):
+        ldap_filter = "(&(objectCategory=person)(objectClass=user)"
+        ldap_filter += "(memberOf={})".format(escape_filter_value(group_dn))
+        if user_dns is not None:
+            ldap_filter += "(|{})".format(''.join(
+                '(distinguishedName={})'.format(escape_filter_value(dn))
+                for dn in user_dns))
+        return ldap_filter + ")"
+
+    def iter_direct_members(self, group_dn, user_dns=None, page_size=500):
+        """Iterate over the users directly in a group
+
+        Users are matched on memberOf, so groups whose member attribute
+        the server returns in ranges are complete. With user_dns only
+        those users are looked for.
+        """
+        if user_dns is not None and len(user_dns) == 0:
+            return
+
+        yield from self._iter_paged_users(
+            self._group_search,
+            self._direct_member_filter(group_dn, user_dns), page_size)
+
+    _MEMBERSHIP_ATTRIBUTES = ['distinguishedName', 'memberOf']
+
+    def _membership_filters(self, user_dns, group_dns, chunk_size):
+        """Get the filters for users in any of groups, chunk_size users
+        and groups at a time"""
+        user_dns = list(user_dns)
+        group_dns = sorted(group_dns)
+        for g in range(0, len(group_dns), chunk_size):
+            for u in range(0, len(user_dns), chunk_size):
+                ldap_filter = "(&(objectCategory=person)(objectClass=user)"
+                ldap_filter += "(|{})".format(''.join(
+                    '(memberOf={})'.format(escape_filter_value(dn))
+                    for dn in group_dns[g:g + chunk_size]))
+                ldap_filter += "(|{}))".format(''.join(
+                    '(distinguishedName={})'.format(escape_filter_value(dn))
+                    for dn in user_dns[u:u + chunk_size]))
+                yield ldap_filter
+
+    def _add_memberships(self, memberships, response, group_dns):
+        for entry in response:
+            if entry['type'] != 'searchResEntry':
+                continue
+            user = entry_values(entry, self._MEMBERSHIP_ATTRIBUTES)
+            member_of = user['memberOf'] or []
+            if isinstance(member_of, str):
+                member_of = [member_of]
+            memberships.setdefault(user['distinguishedName'].lower(),
+                                   set()).update(
+                set(g.lower() for g in member_of) & group_dns)
+
+    def get_direct_memberships(self, user_dns, group_dns, chunk_size=100,
+                               page_size=500):
+        """Get which of groups each of users is directly in
+
+        Made with one search of the users in any of the groups, for each
+        chunk_size users and groups, rather than one per group. Returns a
+        dict mapping the lower case DN of each user in any of the groups
+        to the set of lower case DNs of those groups.
+        """
+        group_dns = set(dn.lower() for dn in group_dns)
+        memberships = dict()
+        for ldap_filter in self._membership_filters(user_dns, group_dns,
+                                                    chunk_size):
+            for response in self._iter_pages(self._group_search,
+                                             ldap_filter,
+                                             self._MEMBERSHIP_ATTRIBUTES,
+                                             page_size):
+                self._add_memberships(memberships, response, group_dns)
+        return memberships
+
+    _MEMBER_ID_ATTRIBUTES = ['distinguishedName', 'sAMAccountName',
+                             'employeeID']
+
+    def _iter_member_ids(self, ldap_filter, page_size):
+        for response in self._iter_pages(self._group_search, ldap_filter,
+                                         self._MEMBER_ID_ATTRIBUTES,
+                                         page_size):
+            for entry in response:
+                if entry['type'] == 'searchResEntry':
+                    yield entry_values(entry, self._MEMBER_ID_ATTRIBUTES)
+
+    def iter_direct_member_ids(self, group_dn, page_size=1000):
+        """Iterate over the users directly in a group, identifiers only
+
+        Yields dicts of distinguishedName, sAMAccountName and employeeID,
+        so the membership of a large group is read with little transfer
+        and no decoding of the other user attributes.
+        """
+        return self._iter_member_ids(self._direct_member_filter(group_dn),
+                                     page_size)
+
+    def iter_group_member_ids(self, group_name, page_size=1000):
+        """Iterate over the users in a group (including nested groups),
+        identifiers only, as iter_direct_member_ids()"""
+        ldap_filter = self._member_filter(
+            group_name, self.get_group_by_samaccountname(group_name))
+        if ldap_filter is None:
+            return iter(())
+        return self._iter_member_ids(ldap_filter, page_size)
+
+    def _modify(self, dn, changes, controls=None):
+        """Modify an entry and return the result"""
+        try:
+            status = self.connection.modify(dn, changes, controls=controls)
+            if not self.connection.strategy.sync:
+                return self._modify_response(status)
+        except LDAPOperationResult as e:
+            # Raised by connections with raise_exceptions
+            return _error_result(e)
+        if self.connection.strategy.thread_safe:
+            _, result, _, _ = status
+        else:
+            result = self.connection.result
+        return result
+
+    def _modify_response(self, message_id):
+        try:
+            return self.connection.get_response(message_id)[1]
+        except LDAPOperationResult as e:
+            return _error_result(e)
+
+    def iter_modify(self, requests, idempotent=False):
+        """Make modifies, yielding their results in order
+
+        requests is an iterable of (dn, changes, controls). They are
+        paced by the throttle, which starts at write_window requests in
+        flight and write_rate a second. With an asynchronous strategy
+        the requests in flight are sent before the reply to the first is
+        read, so their round trips overlap and only the server limits
+        the rate. Requests the server was too busy for are sent again
+        after a pause. A request failing does not stop the others.
+
+        If the requests are idempotent, so making one twice is harmless,
+        in resilient mode losing the connection reconnects and sends the
+        requests without replies again, in order.
+        """
+        if self.throttle is None:
+            self.throttle = Throttle(self.write_window, self.write_rate)
+        throttle = self.throttle
+        pipelined = not self.connection.strategy.sync
+
+        queue = deque((n, request, 0) for n, request in enumerate(requests))
+        # (n, request, attempt, ticket, message ID, timer), only with an
+        # asynchronous strategy
+        in_flight = deque()
+        replies = dict()
+        next_reply = 0
+        lost = 0
+        with self._span('ldap.pipeline', requests=len(queue)) as span:
+            while queue or in_flight:
+                delay = throttle.delay(len(in_flight)) if queue else None
+                sending = None
+                try:
+                    if delay == 0 or (delay is not None and not in_flight):
+                        time.sleep(delay)
+                        n, request, attempt = queue[0]
+                        dn, changes, controls = request
+                        ticket = throttle.sent()
+                        if pipelined:
+                            # Timed from the request to its reply
+                            sending = self._span('ldap.modify').start()
+                            status = self.connection.modify(
+                                dn, changes, controls=controls)
+                            queue.popleft()
+                            in_flight.append((n, request, attempt, ticket,
+                                              status, sending))
+                            continue
+
+                        # The reply is in, so the throttle learns from it
+                        # before the next request is sent
+                        with self._span('ldap.modify') as timer:
+                            result = self._modify(dn, changes, controls)
+                            timer.set(result=result['description'])
+                        queue.popleft()
+                    else:
+                        n, request, attempt, ticket, status, timer = \
+                            in_flight[0]
+                        result = self._modify_response(status)
+                        in_flight.popleft()
+                        timer.set(result=result['description'])
+                        timer.end()
+                except CONNECTION_ERRORS as e:
+                    for timer in [sending] + [timer for *_, timer in
+                                              in_flight]:
+                        if timer is not None:
+                            timer.end(type(e).__name__)
+                    if not idempotent:
+                        raise
+                    self._recover(lost, e)
+                    lost += 1
+                    throttle.lost()
+                    # Sent on the lost connection, but not answered
+                    queue.extendleft((n, request, attempt) for
+                                     n, request, attempt, *_ in
+                                     reversed(in_flight))
+                    in_flight.clear()
+                    continue
+
+                lost = 0
+                if throttle.done(ticket, result, attempt):
+                    queue.appendleft((n, request, attempt + 1))
+                    continue
+
+                replies[n] = result
+                while next_reply in replies:
+                    yield replies.pop(next_reply)
+                    next_reply += 1
+            span.set(window=throttle.window)
+
+    def _member_changes(self, changes):
+        """Normalize (group DN, user DN or DNs, operation) changes"""
+        check_names = getattr(self.connection, 'check_names', False)
+        for group_dn, user_dns, operation in changes:
+            if isinstance(user_dns, str):
+                user_dns = [user_dns]
+            if check_names:
+                group_dn = safe_dn(group_dn)
+                user_dns = [safe_dn(dn) for dn in user_dns]
+            yield group_dn, list(user_dns), operation
+
+    def _member_result(self, group_dn, user_dns, operation, result):
+        """Raise the error of a member change, or make it on servers
+        without Permissive Modify"""
+        if result['result'] == 12:
+            # unavailableCriticalExtension
+            helper = ad_add_members_to_groups \
+                if operation == MODIFY_ADD \
+                else ad_remove_members_from_groups
+            helper(self.connection, user_dns, group_dn, fix=True,
+                   raise_error=True)
+        elif result['description'] != 'success':
+            raise LDAPOperationResult(
+                result=result['result'],
+                description=result['description'],
+                dn=result.get('dn'), message=result.get('message'),
+                response_type='modifyResponse')
+
+    def _change_member(self, group_dn, user_dns, operation):
+        """Add or remove group members with one modify
+
+        Permissive Modify makes adding a member or removing a non member
+        succeed without reading the group's members first. Servers
+        without the control get ldap3's AD helpers, which read them.
+        """
+        (group_dn, user_dns, operation), = self._member_changes(
+            [(group_dn, user_dns, operation)])
+        try:
+            with self._span('ldap.modify', change=operation,
+                            values=len(user_dns)):
+                result = self._modify(
+                    group_dn, {'member': [(operation, user_dns)]},
+                    [permissive_modify_control()])
+                self._member_result(group_dn, user_dns, operation, result)
+        finally:
+            self._invalidate_membership()
+
+    def change_group_members(self, changes):
+        """Add or remove members of groups, pipelining the modifies
+
+        changes is a list of (group DN, user DN or list of DNs,
+        MODIFY_ADD or MODIFY_DELETE), one modify each, paced as
+        iter_modify() does. Yields None for each change made and the
+        LDAPException of each that failed, in order.
+        """
+        changes = list(self._member_changes(changes))
+        requests = ((group_dn, {'member': [(operation, user_dns)]},
+                     [permissive_modify_control()])
+                    for group_dn, user_dns, operation in changes)
+        try:
+            # Permissive Modify makes the changes safe to send again
+            for change, result in zip(changes, self.iter_modify(
+                    requests, idempotent=True)):
+                try:
+                    self._member_result(*change, result)
+                except LDAPException as e:
+                    yield e
+                else:
+                    yield None
+        finally:
+            self._invalidate_membership()
+
     def add_user_to_group_by_dn(self, group_name, username):
-        ad_add_members_to_groups(self.connection, username, group_name,
-                                 fix=True, raise_error=True)
+        self._change_member(group_name, username, MODIFY_ADD)
 
     def remove_user_from_group_by_dn(self, group_name, username):
-        ad_remove_members_from_groups(self.connection, username, group_name,
-                                      fix=True, raise_error=True)
+        self._change_member(group_name, username, MODIFY_DELETE)
+
+    def add_users_to_group_by_dn(self, group_name, usernames):
+        """Add several users to a group in one modify"""
+        self._change_member(group_name, list(usernames), MODIFY_ADD)
+
+    def remove_users_from_group_by_dn(self, group_name, usernames):
+        """Remove several users from a group in one modify"""
+        self._change_member(group_name, list(usernames), MODIFY_DELETE)
@@ -0,0 +1,251 @@
+"""Latency histograms and counters in the OpenMetrics text format
+
+The registry observes the profiler (see profiling.py), so it sees the
+same spans and counters as --profile without any further
+instrumentation. While it is not enabled nothing is made or counted.
+
+Exported metric families:
+
+* ``n2sn_operation_duration_seconds``, a histogram per operation
+  (``ldap.search``, ``ldap.modify``, ``ldap.bind``, ``adquery`` ...)
+  and server
+* ``n2sn_operation_errors_total``, operations which raised or returned
+  a result other than success
+* ``n2sn_ldap_requests_total``, LDAP messages sent by type
+* ``n2sn_retries_total`` and ``n2sn_failovers_total``
+* ``n2sn_cache_requests_total`` and ``n2sn_cache_hit_ratio`` per cache
+* ``n2sn_events_total`` for any other counter
+
+The registry can be written to a file (for example for the node
+exporter's textfile collector, from cron) or served over HTTP with
+serve().
+"""
+import threading
+
+from .profiling import profiler
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+OPERATIONS = {'ldap.connect', 'ldap.bind', 'ldap.server_info',
+              'ldap.search', 'ldap.modify', 'adquery'}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, _escape(v))
+                          for n, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = dict()
+
+    def inc(self, labels=(), n=1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name + '_total', \
+                _labels(self.labelnames, labels), value
+
+
+class Gauge(object):
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames, func):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Called at exposition, returns a map of labels to value
+        self.func = func
+
+    def samples(self):
+        for labels, value in sorted(self.func().items()):
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = dict()
+
+    def observe(self, labels, value):
+        counts, total = self.values.get(labels, (None, 0.0))
+        if counts is None:
+            counts = [0] * len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.values[labels] = (counts, total + value)
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = ('le', _number(bound))
+                yield self.name + '_bucket', \
+                    _labels(self.labelnames, labels, le), cumulative
+            yield self.name + '_sum', _labels(self.labelnames, labels), total
+            yield self.name + '_count', _labels(self.labelnames, labels), \
+                cumulative
+
+
+class Registry(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.families = list()
+
+        self.duration = self._add(Histogram(
+            'n2sn_operation_duration_seconds',
+            'Time taken by directory operations and adquery calls',
+            ['operation', 'server'], buckets))
+        self.errors = self._add(Counter(
+            'n2sn_operation_errors',
+            'Operations which failed or returned a result other than '
+            'success', ['operation', 'server']))
+        self.requests = self._add(Counter(
+            'n2sn_ldap_requests', 'LDAP messages sent', ['type']))
+        self.retries = self._add(Counter(
+            'n2sn_retries', 'Operations retried'))
+        self.failovers = self._add(Counter(
+            'n2sn_failovers', 'Connections moved to another server'))
+        self.cache = self._add(Counter(
+            'n2sn_cache_requests', 'Cache lookups', ['cache', 'result']))
+        self._add(Gauge(
+            'n2sn_cache_hit_ratio', 'Fraction of cache lookups which hit',
+            ['cache'], func=self._hit_ratios))
+        self.events = self._add(Counter(
+            'n2sn_events', 'Other counted events', ['event']))
+
+        # Export counters without labels as 0 until they are counted
+        self.retries.inc((), 0)
+        self.failovers.inc((), 0)
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+    def _hit_ratios(self):
+        totals = dict()
+        for (cache, result), n in self.cache.values.items():
+            hits, total = totals.get(cache, (0, 0))
+            totals[cache] = (hits + (n if result == 'hit' else 0),
+                             total + n)
+        return {(cache,): hits / total
+                for cache, (hits, total) in totals.items() if total}
+
+    def observe_span(self, span):
+        if span.name not in OPERATIONS:
+            return
+        labels = (span.name, span.values.get('server', 'local'))
+        with self._lock:
+            self.duration.observe(labels, span.duration)
+            if 'error' in span.values or \
+               span.values.get('result', 'success') != 'success':
+                self.errors.inc(labels)
+
+    def observe_count(self, name, n):
+        with self._lock:
+            if name.startswith('ldap.') and name.endswith('Request'):
+                self.requests.inc((name[5:],), n)
+            elif name == 'ldap.retry':
+                self.retries.inc((), n)
+            elif name == 'ldap.failover':
+                self.failovers.inc((), n)
+            elif name.startswith('cache.') and name.count('.') == 2:
+                _, cache, result = name.split('.')
+                self.cache.inc((cache, result), n)
+            else:
+                self.events.inc((name,), n)
+
+    def exposition(self):
+        """Return the metrics in the OpenMetrics text format"""
+        lines = list()
+        with self._lock:
+            for family in self.families:
+                lines.append('# TYPE {} {}'.format(family.name, family.type))
+                lines.append('# HELP {} {}'.format(family.name,
+                                                   _escape(family.help)))
+                for name, labels, value in family.samples():
+                    lines.append('{}{} {}'.format(name, labels,
+                                                  _number(value)))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Write the metrics to a file, replacing it atomically"""
+        import os
+        tmp = '{}.{}'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.exposition())
+        os.replace(tmp, filename)
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        """Serve the metrics over HTTP from a daemon thread
+
+        Returns the HTTP server, call its shutdown() method to stop.
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='n2sn-metrics', daemon=True)
+        thread.start()
+        return server
+
+
+registry = Registry()
+
+
+def enable():
+    """Start feeding the registry from the profiler"""
+    profiler.add_observer(registry)
+    return registry
+
+
+def disable():
+    profiler.remove_observer(registry)
@@ -0,0 +1,137 @@
+"""Writers for user listings
+
+The line oriented formats (csv, tsv and ndjson) and json write each
+record as soon as it is given so output can be piped to other tools.
+The table format has to know every column width so keeps the rendered
+strings of each row until it is closed.
+"""
+import csv
+import json
+import sys
+
+FORMATS = ['table', 'csv', 'tsv', 'json', 'ndjson']
+
+TICK = '✓'
+
+
+class UserWriter(object):
+    """Base class of writers taking records as dicts keyed by field"""
+    def __init__(self, fields, names, stream=None):
+        self.fields = fields
+        self.names = names
+        self.stream = sys.stdout if stream is None else stream
+
+    def write(self, record):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class CSVWriter(UserWriter):
+    delimiter = ','
+
+    def __init__(self, fields, names, stream=None):
+        super().__init__(fields, names, stream)
+        self._writer = csv.writer(self.stream, delimiter=self.delimiter,
+                                  lineterminator='\n')
+        self._writer.writerow(self.fields)
+
+    def write(self, record):
+        self._writer.writerow([_text(record.get(f)) for f in self.fields])
+        self.stream.flush()
+
+
+class TSVWriter(CSVWriter):
+    delimiter = '\t'
+
+
+class NDJSONWriter(UserWriter):
+    def write(self, record):
+        self.stream.write(json.dumps(record, default=str) + '\n')
+        self.stream.flush()
+
+
+class JSONWriter(UserWriter):
+    def __init__(self, fields, names, stream=None):
+        super().__init__(fields, names, stream)
+        self._first = True
+
+    def write(self, record):
+        self.stream.write('[\n' if self._first else ',\n')
+        self.stream.write(json.dumps(record, default=str))
+        self.stream.flush()
+        self._first = False
+
+    def close(self):
+        self.stream.write('[]\n' if self._first else '\n]\n')
+
+
+class TableWriter(UserWriter):
+    """Draw an ASCII table in the style of PrettyTable"""
+    left = ('name', 'username', 'email')
+
+    def __init__(self, fields, names, stream=None):
+        super().__init__(fields, names, stream)
+        self._rows = list()
+        self._widths = [len(n) for n in names]
+
+    def write(self, record):
+        row = [_symbol(f, record.get(f)) for f in self.fields]
+        for n, cell in enumerate(row):
+            if len(cell) > self._widths[n]:
+                self._widths[n] = len(cell)
+        self._rows.append(row)
+
+    def _line(self, row):
+        cells = list()
+        for field, cell, width in zip(self.fields, row, self._widths):
+            if field in self.left:
+                cells.append(cell.ljust(width))
+            else:
+                cells.append(cell.center(width))
+        return '| ' + ' | '.join(cells) + ' |'
+
+    def close(self):
+        rule = '+' + '+'.join('-' * (w + 2) for w in self._widths) + '+'
+        out = [rule, self._line(self.names), rule]
+        out.extend(self._line(row) for row in self._rows)
+        out.append(rule)
+        self.stream.write('\n'.join(out) + '\n')
+        self._rows = list()
+
+
+_WRITERS = {'table': TableWriter, 'csv': CSVWriter, 'tsv': TSVWriter,
+            'json': JSONWriter, 'ndjson': NDJSONWriter}
+
+
+def get_writer(fmt, fields, names, stream=None):
+    if fmt not in _WRITERS:
+        raise ValueError("Unknown output format '{}'".format(fmt))
+    return _WRITERS[fmt](fields, names, stream)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, list):
+        return ' '.join(value)
+    return str(value)
+
+
+def _symbol(field, value):
+    if value is None:
+        return 'ERROR' if field == 'login' else ''
+    if isinstance(value, bool):
+        return TICK if value else ''
+    if isinstance(value, list):
+        return ' '.join(value) if value else TICK
+    return str(value)
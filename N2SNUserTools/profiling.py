@@ -0,0 +1,191 @@
+"""Lightweight instrumentation of directory operations
+
+Code wraps work in ``profiler.span(name)`` and bumps counters with
+``profiler.count(name)``. While the profiler is disabled (the default)
+span() returns a shared no-op object and count() returns at once, so
+instrumented code pays one attribute lookup and a branch.
+
+When enabled, each span records its wall time, thread and any values
+set on it (such as entries and bytes). The results can be printed as a
+summary per span name or written as a Chrome trace (chrome://tracing,
+Perfetto).
+
+Observers (such as the metrics registry) see every finished span and
+counter increment. Spans are made while an observer is registered even
+if recording is off, but are then not kept.
+"""
+import threading
+import time
+
+
+class _NullSpan(object):
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def start(self):
+        return self
+
+    def end(self, error=None):
+        pass
+
+    def set(self, **values):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    enabled = True
+
+    def __init__(self, profiler, name, values):
+        self.profiler = profiler
+        self.name = name
+        self.values = values
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.end(type.__name__ if type is not None else None)
+
+    def start(self):
+        """Start timing, for spans which end out of order and so can not
+        be used with ``with``"""
+        self.started = time.perf_counter()
+        return self
+
+    def end(self, error=None):
+        """Stop timing, noting the name of the error if any"""
+        self.duration = time.perf_counter() - self.started
+        if error is not None:
+            self.values['error'] = error
+        self.profiler._add(self)
+
+    def set(self, **values):
+        """Set values, numbers are summed in the summary"""
+        self.values.update(values)
+
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.recording = False
+        self.observers = list()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.spans = list()
+        self.counters = dict()
+        self._origin = time.perf_counter()
+
+    def _update(self):
+        self.enabled = self.recording or bool(self.observers)
+
+    def enable(self):
+        """Start recording spans and counters"""
+        self.reset()
+        self.recording = True
+        self._update()
+
+    def disable(self):
+        self.recording = False
+        self._update()
+
+    def add_observer(self, observer):
+        """Call observer.observe_span(span) and observe_count(name, n)"""
+        if observer not in self.observers:
+            self.observers.append(observer)
+        self._update()
+
+    def remove_observer(self, observer):
+        if observer in self.observers:
+            self.observers.remove(observer)
+        self._update()
+
+    def span(self, name, **values):
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, values)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        if self.recording:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+        for observer in self.observers:
+            observer.observe_count(name, n)
+
+    def _add(self, span):
+        span.thread = threading.get_ident()
+        if self.recording:
+            with self._lock:
+                self.spans.append(span)
+        for observer in self.observers:
+            observer.observe_span(span)
+
+    def summary(self):
+        """Return a text table of time and values per span name"""
+        totals = dict()
+        for span in self.spans:
+            t = totals.setdefault(span.name, {'n': 0, 'total': 0.0,
+                                              'max': 0.0, 'values': {}})
+            t['n'] += 1
+            t['total'] += span.duration
+            t['max'] = max(t['max'], span.duration)
+            for key, value in span.values.items():
+                if isinstance(value, (int, float)) and \
+                   not isinstance(value, bool):
+                    t['values'][key] = t['values'].get(key, 0) + value
+
+        lines = ['{:<24} {:>6} {:>11} {:>11} {:>11}  {}'.format(
+            'span', 'count', 'total ms', 'mean ms', 'max ms', 'totals')]
+        for name, t in sorted(totals.items(),
+                              key=lambda item: -item[1]['total']):
+            lines.append('{:<24} {:>6} {:>11.2f} {:>11.2f} {:>11.2f}  {}'
+                         .format(name, t['n'], t['total'] * 1000,
+                                 t['total'] * 1000 / t['n'],
+                                 t['max'] * 1000,
+                                 ' '.join('{}={}'.format(k, v) for k, v in
+                                          sorted(t['values'].items()))))
+        if self.counters:
+            lines.append('')
+            lines.append('{:<24} {:>6}'.format('counter', 'count'))
+            for name, n in sorted(self.counters.items()):
+                lines.append('{:<24} {:>6}'.format(name, n))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Return the spans and counters in Chrome trace event format"""
+        import os
+        pid = os.getpid()
+        events = list()
+        for span in self.spans:
+            events.append({
+                'name': span.name, 'ph': 'X', 'pid': pid,
+                'tid': span.thread,
+                'ts': (span.started - self._origin) * 1e6,
+                'dur': span.duration * 1e6,
+                'args': {k: v if isinstance(v, (int, float, str, bool))
+                         else str(v) for k, v in span.values.items()}})
+        end = max([(s.started + s.duration - self._origin) * 1e6
+                   for s in self.spans] or [0])
+        for name, n in self.counters.items():
+            events.append({'name': name, 'ph': 'C', 'pid': pid,
+                           'ts': end, 'args': {'count': n}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename):
+        import json
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+profiler = Profiler()
@@ -0,0 +1,253 @@
+"""Record LDAP traffic from a real session and replay it offline
+
+RecordingConnection wraps an ldap3 Connection and writes each search
+and modify, with the raw attribute values, result (including controls
+such as paging cookies) and timing, to a file of JSON lines. Bind
+credentials are never written and the values of REDACTED_ATTRIBUTES are
+replaced by placeholders of the same length.
+
+ReplayConnection reads such a file and answers the same requests
+locally, formatting values with the offline Active Directory schema so
+ADObjects sees responses shaped like the real ones. Latency can be left
+out, replayed as recorded or scaled.
+"""
+import base64
+import collections
+import json
+import threading
+import time
+
+RECORD_VERSION = 1
+
+REDACTED_ATTRIBUTES = {'unicodepwd', 'userpassword', 'ntpwdhistory',
+                       'lmpwdhistory', 'supplementalcredentials',
+                       'dbcspwd', 'mslaps-password',
+                       'ms-mcs-admpwd'}
+
+
+def _encode(value):
+    """Make a value JSON serializable, keeping bytes as base64"""
+    if isinstance(value, bytes):
+        return {'b64': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, dict):
+        return {'dict': [[k, _encode(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if 'b64' in value:
+            return base64.b64decode(value['b64'])
+        return {k: _decode(v) for k, v in value['dict']}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def _redact(name, values):
+    if name.lower() not in REDACTED_ATTRIBUTES:
+        return values
+    return [b'*' * len(v) if isinstance(v, bytes) else '*' * len(str(v))
+            for v in values]
+
+
+def _control(control):
+    """Get (oid, criticality, value) of a request control"""
+    if isinstance(control, (list, tuple)):
+        return [str(control[0]), bool(control[1]), control[2]]
+    value = None
+    if control['controlValue'].hasValue():
+        value = bytes(control['controlValue'])
+    return [str(control['controlType']), bool(control['criticality']),
+            value]
+
+
+def _search_key(search_base, search_filter, attributes, controls,
+                paged_size, paged_cookie):
+    return json.dumps(_encode([
+        'search', search_base, search_filter,
+        sorted(a.lower() for a in attributes or []),
+        [_control(c) for c in controls or []],
+        paged_size, paged_cookie]))
+
+
+def _modify_key(dn, changes, controls):
+    out = dict()
+    for name, change in changes.items():
+        if not isinstance(change, list):
+            change = [change]
+        out[name] = list()
+        for op, values in change:
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            out[name].append([op, _redact(name, list(values))])
+    changes = out
+    return json.dumps(_encode([
+        'modify', dn, sorted(changes.items()),
+        [_control(c) for c in controls or []]]))
+
+
+class RecordingConnection(object):
+    """Wrap a connection, recording searches and modifies to a file"""
+    def __init__(self, connection, filename):
+        self._connection = connection
+        self._file = open(filename, 'w')
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._write({'version': RECORD_VERSION,
+                     'server': str(connection.server.host
+                                   if hasattr(connection.server, 'host')
+                                   else connection.server),
+                     'started': time.time()})
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def _record(self, key, start, status):
+        elapsed = time.perf_counter() - start
+        if self._connection.strategy.thread_safe:
+            status, result, entries, _ = status
+        else:
+            result = self._connection.result
+            entries = self._connection.response
+        response = list()
+        for entry in entries or []:
+            if entry['type'] == 'searchResEntry':
+                response.append({
+                    'type': entry['type'], 'dn': entry['dn'],
+                    'raw_attributes': {
+                        name: _encode(_redact(name, values))
+                        for name, values in entry['raw_attributes'].items()
+                    }})
+            else:
+                response.append({'type': entry['type'],
+                                 'uri': entry.get('uri')})
+
+        self._write({'key': key,
+                     'offset': start - self._start,
+                     'elapsed': elapsed,
+                     'status': status,
+                     'result': _encode(result),
+                     'response': response})
+
+    def search(self, search_base, search_filter, search_scope=None,
+               attributes=None, controls=None, paged_size=None,
+               paged_cookie=None, **kwargs):
+        key = _search_key(search_base, search_filter, attributes, controls,
+                          paged_size, paged_cookie)
+        start = time.perf_counter()
+        kwargs.update(search_base=search_base, search_filter=search_filter,
+                      attributes=attributes, controls=controls,
+                      paged_size=paged_size, paged_cookie=paged_cookie)
+        if search_scope is not None:
+            kwargs['search_scope'] = search_scope
+        status = self._connection.search(**kwargs)
+        self._record(key, start, status)
+        return status
+
+    def modify(self, dn, changes, controls=None):
+        key = _modify_key(dn, changes, controls)
+        start = time.perf_counter()
+        status = self._connection.modify(dn, changes, controls=controls)
+        self._record(key, start, status)
+        return status
+
+    def unbind(self, *args, **kwargs):
+        self._file.close()
+        return self._connection.unbind(*args, **kwargs)
+
+
+class _Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class ReplayConnection(object):
+    """Answer requests from a recording
+
+    latency is None to answer at once, 'recorded' to wait as long as
+    the original request took or a number to scale the recorded time.
+    """
+    def __init__(self, filename, latency=None):
+        from ldap3 import Server, OFFLINE_AD_2012_R2
+        self.server = Server('replay', get_info=OFFLINE_AD_2012_R2)
+        self.latency = 1.0 if latency == 'recorded' else latency
+        self.response = None
+        self.result = None
+        self.bound = True
+        self.closed = False
+        self.check_names = True
+        self.strategy = _Namespace(sync=True, thread_safe=False)
+        self._records = collections.defaultdict(collections.deque)
+        with open(filename) as f:
+            header = json.loads(f.readline())
+            if header.get('version') != RECORD_VERSION:
+                raise RuntimeError("Unsupported recording version {}"
+                                   .format(header.get('version')))
+            for line in f:
+                record = json.loads(line)
+                self._records[record['key']].append(record)
+
+        self.extend = _Namespace(standard=_Namespace(
+            who_am_i=lambda: 'u:REPLAY\\' + header.get('server', '')))
+
+    def _answer(self, key, attributes=None):
+        from ldap3.protocol.formatters.standard import \
+            format_attribute_values
+        from ldap3.utils.ciDict import CaseInsensitiveDict
+
+        if not self._records.get(key):
+            raise RuntimeError("Request not found in recording : {}"
+                               .format(key))
+        records = self._records[key]
+        record = records.popleft() if len(records) > 1 else records[0]
+
+        if self.latency:
+            time.sleep(record['elapsed'] * self.latency)
+
+        schema = self.server.schema
+        self.response = list()
+        for entry in record['response']:
+            if entry['type'] != 'searchResEntry':
+                self.response.append(entry)
+                continue
+            raw = CaseInsensitiveDict(
+                {name: _decode(values)
+                 for name, values in entry['raw_attributes'].items()})
+            formatted = CaseInsensitiveDict(
+                {name: format_attribute_values(schema, name, values, None)
+                 for name, values in raw.items()})
+            for name in attributes or []:
+                if name not in formatted:
+                    formatted[name] = list()
+            self.response.append({'type': entry['type'], 'dn': entry['dn'],
+                                  'raw_attributes': raw,
+                                  'attributes': formatted})
+        self.result = _decode(record['result'])
+        return record['status']
+
+    def search(self, search_base, search_filter, search_scope=None,
+               attributes=None, controls=None, paged_size=None,
+               paged_cookie=None, **kwargs):
+        return self._answer(_search_key(search_base, search_filter,
+                                        attributes, controls, paged_size,
+                                        paged_cookie), attributes)
+
+    def modify(self, dn, changes, controls=None):
+        return self._answer(_modify_key(dn, changes, controls))
+
+    def bind(self, *args, **kwargs):
+        return True
+
+    def unbind(self, *args, **kwargs):
+        self.closed = True
+        return True
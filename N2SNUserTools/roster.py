@@ -0,0 +1,269 @@
+"""Add or remove rights for a roster of users
+
+A roster is either a plain list, one login or life/guest number per
+line, or CSV. A CSV file may start with a header naming the columns
+``login``, ``life_number`` (or ``number``) and ``rights``. Without a
+header the first column is the user and any further columns are rights.
+Several rights in one column are separated by spaces or semicolons.
+Users given by a number are looked up as life/guest numbers. Blank lines
+and lines starting with ``#`` are skipped.
+
+Users are looked up a chunk at a time and the changes to each group are
+made with one modify per chunk of users, the modifies of every group
+pipelined on the connection. A chunk that fails is retried a user at a
+time so every row gets its own result.
+"""
+import csv
+import re
+
+from .profiling import profiler
+
+CHUNK_SIZE = 100
+
+RESULT_FIELDS = ['row', 'user', 'right', 'result', 'message']
+RESULT_NAMES = ['Row', 'User', 'Right', 'Result', 'Message']
+
+_LOGIN_COLUMNS = ('login', 'username', 'samaccountname')
+_NUMBER_COLUMNS = ('life_number', 'number', 'employeeid')
+_RIGHTS_COLUMNS = ('rights', 'right')
+
+
+def _split_rights(value):
+    return [r.lower() for r in re.split(r'[\s;]+', value or '') if r]
+
+
+def read_roster(stream, default_rights=None):
+    """Read a roster, returning a list of row dicts
+
+    Each row has the line number ``row``, one of ``login`` and
+    ``life_number``, and a list of lower case ``rights``, which are
+    default_rights when the row names none.
+    """
+    lines = [(n, line) for n, line in enumerate(stream, 1)
+             if line.strip() and not line.lstrip().startswith('#')]
+    cells = list(csv.reader(line for _, line in lines))
+
+    header = None
+    if cells and any(c.strip().lower() in
+                     _LOGIN_COLUMNS + _NUMBER_COLUMNS + _RIGHTS_COLUMNS
+                     for c in cells[0]):
+        header = [c.strip().lower() for c in cells[0]]
+        lines, cells = lines[1:], cells[1:]
+
+    rows = list()
+    for (n, _), row in zip(lines, cells):
+        row = [c.strip() for c in row]
+        out = {'row': n, 'login': None, 'life_number': None,
+               'rights': list()}
+
+        if header is None:
+            user, rights = row[0], row[1:]
+            if user.isdigit():
+                out['life_number'] = user
+            else:
+                out['login'] = user
+        else:
+            values = dict(zip(header, row))
+            rights = list()
+            for key, value in values.items():
+                if key in _LOGIN_COLUMNS and value:
+                    out['login'] = value
+                elif key in _NUMBER_COLUMNS and value:
+                    out['life_number'] = value
+                elif key in _RIGHTS_COLUMNS:
+                    rights.append(value)
+
+        for value in rights:
+            out['rights'] += _split_rights(value)
+        if not out['rights']:
+            out['rights'] = [r.lower() for r in default_rights or []]
+        rows.append(out)
+
+    return rows
+
+
+def row_user(row):
+    return row['login'] if row['login'] is not None else row['life_number']
+
+
+def row_key(row):
+    """Get the key of a row's user in the dict of find_users()"""
+    kind = 'login' if row['login'] is not None else 'life_number'
+    return (kind, row[kind].lower())
+
+
+def find_users(ad, rows, chunk_size=CHUNK_SIZE):
+    """Look up the users of roster rows chunk_size at a time
+
+    Returns a dict mapping ('login' or 'life_number', lower case value)
+    to the user, or to an error message when none or several were
+    found.
+    """
+    users = dict()
+    for kind, attribute in (('login', 'sAMAccountName'),
+                            ('life_number', 'employeeID')):
+        values = sorted(set(r[kind].lower() for r in rows
+                            if r[kind] is not None))
+        for value in values:
+            users[(kind, value)] = "Unable to find user"
+
+        found = dict()
+        for user in ad.iter_users_by_attribute(attribute, values,
+                                               chunk_size):
+            found.setdefault(str(user[attribute]).lower(), []).append(user)
+        for value, matches in found.items():
+            if len(matches) == 1:
+                users[(kind, value)] = matches[0]
+            else:
+                users[(kind, value)] = "User is not unique"
+
+    return users
+
+
+def resolve_roster(ad, rows, groups, chunk_size=CHUNK_SIZE):
+    """Find the users, groups and memberships a roster touches
+
+    groups maps the instrument's rights to group names. Returns a dict
+    with:
+
+    * ``users``, the users found by find_users()
+    * ``groups``, mapping each right used to its group
+    * ``members``, mapping each right to the lower case DNs of the
+      roster's users already directly in its group
+    * ``errors``, mapping row numbers to an error message for rows which
+      name no user, unknown rights or no rights
+    """
+    errors = dict()
+    for row in rows:
+        unknown = [r for r in row['rights'] if r not in groups]
+        if row_user(row) is None:
+            errors[row['row']] = "No user given"
+        elif unknown:
+            errors[row['row']] = "Unknown right {}".format(
+                ', '.join(r.upper() for r in unknown))
+        elif not row['rights']:
+            errors[row['row']] = "No right given"
+
+    users = find_users(ad, rows, chunk_size)
+    rights = sorted(set(r for row in rows if row['row'] not in errors
+                        for r in row['rights']))
+    dns = sorted(set(u['distinguishedName'] for u in users.values()
+                     if isinstance(u, dict)))
+
+    out_groups = dict()
+    members = dict()
+    for right in rights:
+        group = ad.get_group_by_samaccountname(groups[right])
+        if len(group) != 1:
+            raise RuntimeError("Unable to find correct group for users")
+        out_groups[right] = group[0]
+
+        members[right] = set()
+        for start in range(0, len(dns), chunk_size):
+            members[right].update(
+                m['distinguishedName'].lower() for m in
+                ad.iter_direct_members(group[0]['distinguishedName'],
+                                       dns[start:start + chunk_size]))
+
+    return {'users': users, 'groups': out_groups, 'members': members,
+            'errors': errors}
+
+
+def change_members(ad, changes, chunk_size=CHUNK_SIZE):
+    """Change the members of groups chunk_size users at a time
+
+    changes is a list of (group DN, user DNs, MODIFY_ADD or
+    MODIFY_DELETE). The modifies of all the chunks are pipelined by
+    ADObjects.change_group_members(). Yields (index of the change, dict
+    mapping the chunk's DNs to None or the error message of their
+    change) for each chunk. A chunk that fails is retried a user at a
+    time once the other chunks are done, so the retries keep to the
+    throttle's window too. Permission errors are raised.
+    """
+    from ldap3.core.exceptions import LDAPInsufficientAccessRightsResult
+
+    chunks = [(n, (group_dn, dns[start:start + chunk_size], operation))
+              for n, (group_dn, dns, operation) in enumerate(changes)
+              for start in range(0, len(dns), chunk_size)]
+
+    failed = list()
+    errors = ad.change_group_members([chunk for _, chunk in chunks])
+    for (n, (group_dn, chunk, operation)), error in zip(chunks, errors):
+        if isinstance(error, LDAPInsufficientAccessRightsResult):
+            raise error
+        if error is None:
+            yield n, {dn: None for dn in chunk}
+        elif len(chunk) == 1:
+            yield n, {chunk[0]: str(error)}
+        else:
+            failed.append((n, (group_dn, chunk, operation)))
+
+    if not failed:
+        return
+
+    # Find the users the failed chunks failed for, one pipeline for all
+    errors = ad.change_group_members(
+        [(group_dn, dn, operation)
+         for _, (group_dn, chunk, operation) in failed for dn in chunk])
+    for n, (_, chunk, _) in failed:
+        yield n, {dn: None if e is None else str(e)
+                  for dn, e in zip(chunk, errors)}
+
+
+def apply_roster(ad, rows, plan, operation, chunk_size=CHUNK_SIZE,
+                 progress=None):
+    """Make the changes of a roster, returning a result for each right
+    of each row
+
+    operation is 'add' or 'remove'. progress(done, total) is called
+    after each modify with the number of users changed so far.
+    """
+    from ldap3 import MODIFY_ADD, MODIFY_DELETE
+
+    modify = MODIFY_ADD if operation == 'add' else MODIFY_DELETE
+    done_result = 'added' if operation == 'add' else 'removed'
+
+    results = list()
+    # group DN -> {DN: [results of the rows changing it]}
+    pending = dict()
+    for row in rows:
+        base = {'row': row['row'], 'user': row_user(row)}
+        if row['row'] in plan['errors']:
+            results.append({**base, 'right': None, 'result': 'error',
+                            'message': plan['errors'][row['row']]})
+            continue
+
+        user = plan['users'][row_key(row)]
+        for right in row['rights']:
+            result = {**base, 'right': right, 'result': 'error',
+                      'message': None}
+            results.append(result)
+            if not isinstance(user, dict):
+                result['message'] = user
+                continue
+
+            dn = user['distinguishedName']
+            if (dn.lower() in plan['members'][right]) == \
+               (operation == 'add'):
+                result['result'] = 'unchanged'
+                continue
+            group_dn = plan['groups'][right]['distinguishedName']
+            pending.setdefault(group_dn, dict()).setdefault(
+                dn, list()).append(result)
+
+    pending = list(pending.items())
+    total = sum(len(users) for _, users in pending)
+    done = 0
+    with profiler.span('roster.apply', changes=total):
+        for n, outcome in change_members(
+                ad, [(group_dn, list(users), modify)
+                     for group_dn, users in pending], chunk_size):
+            for dn, error in outcome.items():
+                for result in pending[n][1][dn]:
+                    result['result'] = 'error' if error else done_result
+                    result['message'] = error
+            done += len(outcome)
+            if progress is not None:
+                progress(done, total)
+
+    return results
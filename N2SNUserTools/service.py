@@ -0,0 +1,357 @@
+"""A read only directory query service and its client
+
+QueryService answers the ADObjects queries used by the listing and
+search tools as JSON over HTTP, so many workstations can share one set
+of directory connections and one cache:
+
+* ``GET /groups/<name>/members``
+* ``GET /users/search?surname=&givenname=&type=&name=&offset=&limit=``
+* ``GET /users/<login>``
+* ``GET /users/<login>/rights``, the instrument rights of a user
+* ``GET /stats`` and ``GET /metrics`` (OpenMetrics)
+
+Answers are kept in a shared cache.Memo, so identical concurrent requests
+make one search, and searches run on a bounded pool of bound
+connections. ServiceADObjects is a client with the read only ADObjects
+methods the tools use.
+"""
+import datetime
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs, quote, unquote, urlencode
+
+DEFAULT_PORT = 8389
+
+_DATETIME_FIELDS = ('pwdLastSet', 'lockoutTime')
+
+
+def user_to_json(user):
+    """Make a user dict from ADObjects JSON serializable"""
+    out = dict()
+    for key, value in user.items():
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, datetime.timedelta):
+            value = value.total_seconds()
+        out[key] = value
+    return out
+
+
+def user_from_json(user):
+    """Reverse user_to_json()"""
+    user = dict(user)
+    for key in _DATETIME_FIELDS:
+        if isinstance(user.get(key), str):
+            user[key] = datetime.datetime.fromisoformat(user[key])
+    if user.get('lock_time') is not None:
+        user['lock_time'] = datetime.timedelta(seconds=user['lock_time'])
+    return user
+
+
+class ConnectionPool(object):
+    """Hold up to size bound ADObjects made by factory()
+
+    Connections are made when needed. A connection whose use raised an
+    LDAP or OS error is closed rather than returned to the pool. One
+    idle for more than check_after seconds (by default ldap.CHECK_AFTER)
+    has its rootDSE read before it is handed out, and is replaced if
+    that fails, as the server may have closed it.
+    """
+    def __init__(self, factory, size=4, timeout=None, check_after=None):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.created = 0
+        # (ADObjects, when it was returned)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        from ldap3.core.exceptions import LDAPException
+
+        ad = self._acquire()
+        try:
+            yield ad
+        except (LDAPException, OSError):
+            self._discard(ad)
+            raise
+        except BaseException:
+            self._release(ad)
+            raise
+        else:
+            self._release(ad)
+
+    def _release(self, ad):
+        self._idle.put((ad, time.monotonic()))
+
+    def _acquire(self):
+        while True:
+            ad = self._take()
+            if ad is not None:
+                return ad
+
+    def _take(self):
+        """Get a connection, or None if an idle one failed its check"""
+        try:
+            return self._checked(*self._idle.get_nowait())
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            try:
+                return self._checked(*self._idle.get(timeout=self.timeout))
+            except queue.Empty:
+                raise RuntimeError("No directory connection free") from None
+
+        try:
+            return self.factory().__enter__()
+        except BaseException:
+            with self._lock:
+                self.created -= 1
+            raise
+
+    def _checked(self, ad, since):
+        """Check a connection idle since since, discarding it if it is
+        closed"""
+        check_after = self.check_after
+        if check_after is None:
+            from .ldap import CHECK_AFTER as check_after
+        if time.monotonic() - since > check_after:
+            ad._check()
+            if ad._connection is None:
+                self._discard(ad)
+                return None
+        return ad
+
+    def _discard(self, ad):
+        with self._lock:
+            self.created -= 1
+        try:
+            ad.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                ad, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(ad)
+
+
+class QueryService(object):
+    """Answer directory queries from a cache in front of a pool
+
+    config is the compiled tools config, used to name the instrument
+    rights a user holds.
+    """
+    def __init__(self, pool, cache, config=None):
+        self.pool = pool
+        self.cache = cache
+        self.config = config or {}
+
+    def _query(self, key, func):
+        def compute():
+            with self.pool.connection() as ad:
+                return func(ad)
+        return self.cache.get(key, compute)
+
+    def group_members(self, name):
+        return self._query(
+            ('group_members', name.lower()),
+            lambda ad: [user_to_json(u) for u in
+                        ad.get_group_members(name)])
+
+    def user(self, login):
+        return self._query(
+            ('user', login.lower()),
+            lambda ad: [user_to_json(u) for u in
+                        ad.get_user_by_samaccountname(login)])
+
+    def user_search(self, surname=None, givenname=None, user_type=None,
+                    name=None, offset=0, limit=None):
+        if surname is None and givenname is None and user_type is None \
+           and name is None:
+            raise ValueError("The search must be limited")
+
+        users = self._query(
+            ('user_search', surname, givenname, user_type, name),
+            lambda ad: sorted(
+                (user_to_json(u) for u in
+                 ad.get_user_by_surname_and_givenname(
+                     surname, givenname, user_type, name)),
+                key=lambda u: u['displayName'] or ''))
+
+        end = None if limit is None else offset + limit
+        return {'users': users[offset:end], 'total': len(users)}
+
+    def user_rights(self, login):
+        """Get {instrument: [rights]} for a user"""
+        def rights(ad):
+            users = ad.get_user_by_samaccountname(login)
+            if len(users) != 1:
+                raise LookupError("User {} not found".format(login))
+            groups = ad.get_groups_by_member_dn(
+                users[0]['distinguishedName'])
+            out = dict()
+            for group in groups:
+                for inst, right in self.config.get('groups', {}).get(
+                        group['sAMAccountName'].lower(), []):
+                    out.setdefault(inst, []).append(right)
+            return {inst: sorted(r) for inst, r in out.items()}
+
+        return self._query(('user_rights', login.lower()), rights)
+
+    def stats(self):
+        return {'cache': self.cache.stats(),
+                'pool': {'size': self.pool.size,
+                         'created': self.pool.created}}
+
+    def handle(self, path, query):
+        """Return (status, body) for a GET of path"""
+        parts = [unquote(p) for p in path.split('/') if p]
+        args = {k: v[-1] for k, v in query.items()}
+        try:
+            if parts == ['stats']:
+                return 200, self.stats()
+            if len(parts) == 3 and parts[0] == 'groups' \
+               and parts[2] == 'members':
+                return 200, self.group_members(parts[1])
+            if parts == ['users', 'search']:
+                limit = args.get('limit')
+                return 200, self.user_search(
+                    args.get('surname'), args.get('givenname'),
+                    args.get('type'), args.get('name'),
+                    int(args.get('offset', 0)),
+                    None if limit is None else int(limit))
+            if len(parts) == 2 and parts[0] == 'users':
+                return 200, self.user(parts[1])
+            if len(parts) == 3 and parts[0] == 'users' \
+               and parts[2] == 'rights':
+                return 200, self.user_rights(parts[1])
+        except LookupError as e:
+            return 404, {'error': str(e)}
+        except (ValueError, RuntimeError) as e:
+            return 400, {'error': str(e)}
+        return 404, {'error': 'Unknown path {}'.format(path)}
+
+
+def serve(service, host='127.0.0.1', port=DEFAULT_PORT):
+    """Make an HTTP server for service, call serve_forever() to run it"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from . import metrics
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/metrics':
+                self._send(200, metrics.registry.exposition().encode(),
+                           metrics.CONTENT_TYPE)
+                return
+
+            try:
+                status, body = service.handle(url.path, parse_qs(url.query))
+            except Exception as e:
+                self.log_error('%s failed: %r', self.path, e)
+                status, body = 500, {'error': str(e)}
+            self._send(status, json.dumps(body).encode(),
+                       'application/json')
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+class ServiceADObjects(object):
+    """Read only ADObjects answered by a QueryService"""
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def _get(self, path, **params):
+        from urllib.request import urlopen
+        from urllib.error import HTTPError
+
+        url = self.url + path
+        params = {k: v for k, v in params.items() if v is not None}
+        if params:
+            url += '?' + urlencode(params)
+        try:
+            with urlopen(url, timeout=self.timeout) as f:
+                return json.load(f)
+        except HTTPError as e:
+            try:
+                message = json.load(e)['error']
+            except ValueError:
+                message = str(e)
+            raise RuntimeError("Query service error : {}"
+                               .format(message)) from None
+
+    def get_group_members(self, group_name):
+        return [user_from_json(u) for u in self._get(
+            '/groups/{}/members'.format(quote(group_name, safe='')))]
+
+    def iter_group_members(self, group_name, page_size=None):
+        yield from self.get_group_members(group_name)
+
+    def get_group_members_dict(self, groupname):
+        return {m['userPrincipalName']: m
+                for m in self.get_group_members(groupname)}
+
+    def get_user_by_samaccountname(self, id):
+        return [user_from_json(u) for u in self._get(
+            '/users/{}'.format(quote(id, safe='')))]
+
+    def get_user_rights(self, login):
+        return self._get('/users/{}/rights'.format(quote(login, safe='')))
+
+    def get_user_by_surname_and_givenname_page(
+            self, surname, givenname, user_type, name=None,
+            offset=0, limit=25, sort_key='displayName'):
+        if sort_key != 'displayName':
+            raise RuntimeError("The query service sorts by displayName")
+        result = self._get('/users/search', surname=surname,
+                           givenname=givenname, type=user_type, name=name,
+                           offset=offset, limit=limit)
+        return [user_from_json(u) for u in result['users']], \
+            result['total']
+
+    def get_user_by_surname_and_givenname(self, surname, givenname,
+                                          user_type, name=None):
+        return self.get_user_by_surname_and_givenname_page(
+            surname, givenname, user_type, name, limit=None)[0]
+
+    def get_user_by_surname_and_givenname_dict(
+            self, surname, givenname, user_type, name=None):
+        return {u['userPrincipalName']: u for u in
+                self.get_user_by_surname_and_givenname(
+                    surname, givenname, user_type, name)}
+
+    def iter_user_by_surname_and_givenname(
+            self, surname, givenname, user_type, name=None,
+            page_size=None):
+        yield from self.get_user_by_surname_and_givenname(
+            surname, givenname, user_type, name)
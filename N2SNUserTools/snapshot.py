@@ -0,0 +1,179 @@
+"""Snapshots of who holds the rights of every instrument
+
+A snapshot records, for each rights group named in the config file, the
+sorted and deduplicated logins of the users in it (including nested
+groups), and which instrument rights each group grants. A group shared
+by several rights is stored once. A group that was not found is
+recorded as missing, so its rights are left out of diffs rather than
+taken as held by nobody. The file is gzip compressed text::
+
+    n2sn-snapshot 2
+    time 2026-10-19T02:00:00+00:00
+    right tst user rights-tst-users
+    right tst admin rights-tst-admins
+    group rights-tst-users 2
+    abc
+    abd
+    missing rights-tst-admins
+
+Sorted logins share long prefixes with their neighbours, so they
+compress to a few bytes each. Two snapshots are compared a right at a
+time by merging their sorted lists, in time linear in their length.
+"""
+import datetime
+import gzip
+import io
+
+from .profiling import profiler
+
+FORMAT = 'n2sn-snapshot'
+VERSION = 2
+# Versions read, 1 had no missing groups
+VERSIONS = (1, 2)
+
+DIFF_FIELDS = ['instrument', 'right', 'change', 'user']
+DIFF_NAMES = ['Instrument', 'Right', 'Change', 'User']
+
+
+def take_snapshot(ad, instruments):
+    """Read who holds the rights of the instruments
+
+    instruments maps instrument names to their config. Returns a dict
+    with the ``time`` taken, ``rights`` mapping (instrument, right) to a
+    group name, ``groups`` mapping group names to a sorted list of the
+    lower case logins of their users and ``missing``, the set of group
+    names not found. Users without a login are recorded by their lower
+    case DN.
+    """
+    snapshot = {'time': datetime.datetime.now(datetime.timezone.utc)
+                .replace(microsecond=0).isoformat(),
+                'rights': dict(), 'groups': dict(), 'missing': set()}
+
+    for name, inst in sorted(instruments.items()):
+        for right, group in sorted(inst['rights'].items()):
+            group = str(group)
+            snapshot['rights'][(name, right)] = group
+            if group in snapshot['groups'] or group in snapshot['missing']:
+                continue
+            # iter_group_member_ids() looks the group up again, from the
+            # search memo
+            if not ad.get_group_by_samaccountname(group):
+                snapshot['missing'].add(group)
+                continue
+            with profiler.span('snapshot.group', group=group) as span:
+                members = set(
+                    str(m['sAMAccountName'] or m['distinguishedName'])
+                    .lower() for m in ad.iter_group_member_ids(group))
+                span.set(members=len(members))
+            snapshot['groups'][group] = sorted(members)
+
+    return snapshot
+
+
+def write_snapshot(snapshot, stream):
+    """Write a snapshot to a binary stream"""
+    lines = ['{} {}'.format(FORMAT, VERSION),
+             'time {}'.format(snapshot['time'])]
+    for (name, right), group in sorted(snapshot['rights'].items()):
+        lines.append('right {} {} {}'.format(name, right, group))
+    for group, members in sorted(snapshot['groups'].items()):
+        lines.append('group {} {}'.format(group, len(members)))
+        lines.extend(members)
+    for group in sorted(snapshot.get('missing', ())):
+        lines.append('missing {}'.format(group))
+
+    # mtime=0 so that equal snapshots give equal files
+    with gzip.GzipFile(fileobj=stream, mode='wb', mtime=0) as f:
+        f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def read_snapshot(stream):
+    """Read a snapshot written by write_snapshot() from a binary stream"""
+    with gzip.GzipFile(fileobj=stream, mode='rb') as f:
+        lines = io.TextIOWrapper(f, encoding='utf-8').read().splitlines()
+
+    if not lines or lines[0] not in ['{} {}'.format(FORMAT, version)
+                                     for version in VERSIONS]:
+        raise RuntimeError("Not a rights snapshot, or an unknown version")
+
+    snapshot = {'time': None, 'rights': dict(), 'groups': dict(),
+                'missing': set()}
+    n = 1
+    while n < len(lines):
+        kind, _, value = lines[n].partition(' ')
+        n += 1
+        if kind == 'time':
+            snapshot['time'] = value
+        elif kind == 'right':
+            name, right, group = value.split(' ', 2)
+            snapshot['rights'][(name, right)] = group
+        elif kind == 'group':
+            group, count = value.rsplit(' ', 1)
+            snapshot['groups'][group] = lines[n:n + int(count)]
+            n += int(count)
+        elif kind == 'missing':
+            snapshot['missing'].add(value)
+        else:
+            raise RuntimeError("Unable to read snapshot line {}".format(n))
+
+    return snapshot
+
+
+def merge_diff(old, new):
+    """Compare two sorted lists, yielding ('removed', value) for values
+    only in old and ('added', value) for values only in new"""
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            yield 'removed', old[i]
+            i += 1
+        else:
+            yield 'added', new[j]
+            j += 1
+    for value in old[i:]:
+        yield 'removed', value
+    for value in new[j:]:
+        yield 'added', value
+
+
+def diff_snapshots(old, new, instruments=None):
+    """List who gained or lost each right between two snapshots
+
+    Returns a list of dicts of DIFF_FIELDS, limited to the given
+    instruments if any. A right missing from one snapshot is taken as
+    held by nobody in it. A right whose group was not found when either
+    snapshot was taken is left out, see missing_rights().
+    """
+    changes = list()
+    # Rights granted by the same groups have the same changes
+    diffs = dict()
+    with profiler.span('snapshot.diff'):
+        for key in sorted(set(old['rights']) | set(new['rights'])):
+            if instruments is not None and key[0] not in instruments:
+                continue
+            groups = (old['rights'].get(key), new['rights'].get(key))
+            if groups[0] in old.get('missing', ()) or \
+               groups[1] in new.get('missing', ()):
+                continue
+            if groups not in diffs:
+                diffs[groups] = list(merge_diff(
+                    old['groups'].get(groups[0], []),
+                    new['groups'].get(groups[1], [])))
+            for change, user in diffs[groups]:
+                changes.append({'instrument': key[0], 'right': key[1],
+                                'change': change, 'user': user})
+
+    return changes
+
+
+def missing_rights(old, new, instruments=None):
+    """List the (instrument, right) pairs left out of a diff as their
+    group was not found when either snapshot was taken"""
+    return sorted(
+        key for key in set(old['rights']) | set(new['rights'])
+        if (instruments is None or key[0] in instruments) and
+        (old['rights'].get(key) in old.get('missing', ()) or
+         new['rights'].get(key) in new.get('missing', ())))
@@ -0,0 +1,148 @@
+"""Make rights groups hold exactly the users of a desired state
+
+The desired state of each right is a roster of the users who should
+hold it. The current direct members of the right's group are read with
+a paged search returning only their identifiers. Desired users are
+matched against them by login or life/guest number, and only the
+desired users who are not members yet are looked up. The users to add
+and remove are the differences of the two sets. They are changed with
+one modify per chunk of users, so the work done grows with the size of
+the change rather than with the number of users holding the right.
+
+Only user members are managed; groups nested in a rights group are left
+alone.
+"""
+from .profiling import profiler
+from .roster import CHUNK_SIZE, change_members, find_users, row_key, \
+    row_user
+
+RESULT_FIELDS = ['right', 'action', 'user', 'result', 'message']
+RESULT_NAMES = ['Right', 'Action', 'User', 'Result', 'Message']
+
+_DONE = {'add': 'added', 'remove': 'removed'}
+
+
+def plan_sync(ad, desired, groups, chunk_size=CHUNK_SIZE):
+    """Find the changes making each group hold its desired users
+
+    desired maps rights to the roster rows of the users who should hold
+    them and groups maps rights to group names. Returns a dict mapping
+    each right to a dict with:
+
+    * ``group``, the group
+    * ``add`` and ``remove``, dicts mapping the DNs of the users to add
+      and remove to their login
+    * ``errors``, a list of (user, message) for desired users who were
+      not found
+    """
+    plan = dict()
+    missing = list()
+    for right, rows in desired.items():
+        group = ad.get_group_by_samaccountname(groups[right])
+        if len(group) != 1:
+            raise RuntimeError("Unable to find correct group for users")
+        group = group[0]
+
+        current = dict()
+        ids = dict()
+        with profiler.span('sync.members', right=right) as span:
+            for member in ad.iter_direct_member_ids(
+                    group['distinguishedName']):
+                dn = member['distinguishedName']
+                current[dn.lower()] = member
+                for kind, attribute in (('login', 'sAMAccountName'),
+                                        ('life_number', 'employeeID')):
+                    if member[attribute] is not None:
+                        ids[(kind, str(member[attribute]).lower())] = dn
+            span.set(members=len(current))
+
+        keep = set()
+        errors = list()
+        for row in rows:
+            if row_user(row) is None:
+                errors.append((None, "No user given"))
+            elif row_key(row) in ids:
+                keep.add(ids[row_key(row)].lower())
+            else:
+                missing.append((right, row))
+
+        plan[right] = {'group': group, 'current': current, 'keep': keep,
+                       'errors': errors, 'add': dict()}
+
+    # Look up the desired users who are not members, for all rights at
+    # once
+    users = find_users(ad, [row for _, row in missing], chunk_size)
+    for right, row in missing:
+        user = users[row_key(row)]
+        if not isinstance(user, dict):
+            plan[right]['errors'].append((row_user(row), user))
+        elif user['distinguishedName'].lower() in plan[right]['current']:
+            plan[right]['keep'].add(user['distinguishedName'].lower())
+        else:
+            plan[right]['add'][user['distinguishedName']] = \
+                user['sAMAccountName']
+
+    for change in plan.values():
+        current = change.pop('current')
+        keep = change.pop('keep')
+        change['remove'] = {m['distinguishedName']: m['sAMAccountName']
+                            for dn, m in current.items() if dn not in keep}
+
+    return plan
+
+
+def _sync_changes(plan, result):
+    """Iterate over the errors and changes of a plan as results, with
+    (right, action, DN) for each change and None for each error"""
+    for right, change in plan.items():
+        for user, message in change['errors']:
+            yield None, {'right': right, 'action': 'add', 'user': user,
+                         'result': 'error', 'message': message}
+        for action in ('add', 'remove'):
+            for dn, login in sorted(change[action].items(),
+                                    key=lambda i: (i[1] or i[0]).lower()):
+                yield (right, action, dn), {
+                    'right': right, 'action': action, 'user': login or dn,
+                    'result': result, 'message': None}
+
+
+def sync_results(plan, result='planned'):
+    """List the changes of a plan as results, without making them"""
+    return [record for _, record in _sync_changes(plan, result)]
+
+
+def apply_sync(ad, plan, chunk_size=CHUNK_SIZE, progress=None):
+    """Make the changes of a plan, returning a result for each
+
+    Users are added before others are removed, the modifies of each
+    pipelined across the rights. progress(done, total) is called after
+    each modify with the number of users changed so far.
+    """
+    from ldap3 import MODIFY_ADD, MODIFY_DELETE
+
+    results = list()
+    by_change = dict()
+    for key, record in _sync_changes(plan, None):
+        results.append(record)
+        if key is not None:
+            by_change[key] = record
+
+    total = len(by_change)
+    done = 0
+    with profiler.span('sync.apply', changes=total):
+        rights = list(plan)
+        for action, modify in (('add', MODIFY_ADD),
+                               ('remove', MODIFY_DELETE)):
+            for n, outcome in change_members(
+                    ad, [(plan[right]['group']['distinguishedName'],
+                          list(plan[right][action]), modify)
+                         for right in rights], chunk_size):
+                for dn, error in outcome.items():
+                    result = by_change[(rights[n], action, dn)]
+                    result['result'] = 'error' if error else _DONE[action]
+                    result['message'] = error
+                done += len(outcome)
+                if progress is not None:
+                    progress(done, total)
+
+    return results
@@ -0,0 +1,124 @@
+"""Pace bulk directory writes and back off when the server is loaded
+
+A Throttle decides when ADObjects.iter_modify() may send the next
+request and how many may be in flight. It adapts both as TCP's
+congestion control does:
+
+* A reply saying the server is busy, unavailable or out of time halves
+  the window and the rate, and the request is sent again after a pause
+  which doubles each time this happens again before a request succeeds.
+* A reply taking more than ``slow`` times the quickest seen, plus
+  ``jitter`` seconds, means requests are queueing at the server, so the
+  window is halved too.
+* Each window's worth of quick successful replies grows the window by
+  one and the rate by a quarter, back up to the configured limits.
+
+Losing the connection cuts too. Only one cut is made per round trip,
+so the replies to requests sent before a cut do not cut again. Cuts and
+retries are counted by the profiler as ``throttle.cut`` and
+``throttle.retry``.
+"""
+import time
+
+from .profiling import profiler
+
+# timeLimitExceeded, busy, unavailable
+BACKOFF_RESULTS = {3, 51, 52}
+
+
+class Throttle(object):
+    """Keep at most window writes in flight and start at most rate a
+    second (None for no limit)
+
+    A request answered with one of BACKOFF_RESULTS is retried up to
+    retries times, after backoff seconds doubling each time up to
+    max_backoff.
+    """
+    def __init__(self, window=8, rate=None, min_window=1, slow=4.0,
+                 jitter=0.005, retries=6, backoff=0.5, max_backoff=30,
+                 clock=time.monotonic):
+        self.max_window = window
+        self.max_rate = rate
+        self.min_window = min(min_window, window)
+        self.slow = slow
+        self.jitter = jitter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+
+        self.window = window
+        self.rate = rate
+        self.fastest = None
+        self._next_send = 0
+        self._paused_until = 0
+        self._overloads = 0
+        self._quick = 0
+        # Requests are numbered as they are sent, replies to requests
+        # sent before the last cut do not cut again
+        self._sent = 0
+        self._cut_at = 0
+
+    def delay(self, in_flight):
+        """Get the seconds to wait before sending another request, or
+        None if the window is full"""
+        if in_flight >= self.window:
+            return None
+        return max(0, max(self._next_send, self._paused_until) -
+                   self.clock())
+
+    def sent(self):
+        """Note a request sent, returning its ticket for done()"""
+        now = self.clock()
+        if self.rate:
+            self._next_send = max(now, self._next_send) + 1 / self.rate
+        self._sent += 1
+        return (self._sent, now)
+
+    def done(self, ticket, result, attempt):
+        """Note the reply to a request, returning True if it should be
+        sent again"""
+        seq, started = ticket
+        latency = self.clock() - started
+
+        if result.get('result') in BACKOFF_RESULTS:
+            if seq > self._cut_at:
+                # The first busy reply since the last cut
+                self._overloads += 1
+                self._paused_until = self.clock() + min(
+                    self.max_backoff,
+                    self.backoff * 2 ** (self._overloads - 1))
+                self._cut(seq)
+            if attempt < self.retries:
+                profiler.count('throttle.retry')
+                return True
+            return False
+
+        self._overloads = 0
+        if self.fastest is None or latency < self.fastest:
+            self.fastest = latency
+        if latency > self.slow * self.fastest + self.jitter:
+            self._cut(seq)
+        else:
+            self._quick += 1
+            if self._quick >= self.window:
+                self._quick = 0
+                self.window = min(self.max_window, self.window + 1)
+                if self.rate:
+                    self.rate = min(self.max_rate, self.rate * 1.25)
+        return False
+
+    def lost(self):
+        """Note the connection lost, with the requests in flight to be
+        sent again, which cuts as a busy reply does"""
+        self._cut(self._sent)
+
+    def _cut(self, seq):
+        if seq <= self._cut_at:
+            return
+        self._cut_at = self._sent
+        self._quick = 0
+        self.window = max(self.min_window, self.window // 2)
+        if self.rate:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+        profiler.count('throttle.cut')
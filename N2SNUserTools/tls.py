@@ -0,0 +1,95 @@
+"""TLS for directory connections, prepared once and resumed
+
+ldap3's Tls makes a new SSLContext, reading the CA file again, for every
+connection it wraps, and each connection does a full handshake.
+shared_tls() returns one SharedTls per CA file, whose context is made
+once, and which offers the next connection to a server the TLS session
+of the last one so the handshake is abbreviated (a session ID or ticket
+is resumed). Handshakes are counted by the profiler as ``tls.full`` and
+``tls.resumed``.
+"""
+import socket
+import ssl
+import threading
+import weakref
+
+from ldap3 import Tls
+from ldap3.core.tls import check_hostname
+
+from .profiling import profiler
+
+# SharedTls by CA file
+_shared = dict()
+_lock = threading.Lock()
+
+
+def shared_tls(ca_certs_file=None):
+    """Get the SharedTls for connections trusting ca_certs_file"""
+    with _lock:
+        tls = _shared.get(ca_certs_file)
+        if tls is None:
+            tls = _shared[ca_certs_file] = SharedTls(ca_certs_file)
+        return tls
+
+
+class SharedTls(Tls):
+    """An ldap3 Tls wrapping every socket with one SSLContext and
+    resuming the last TLS session with each server"""
+    def __init__(self, ca_certs_file=None, validate=ssl.CERT_REQUIRED,
+                 version=ssl.PROTOCOL_TLSv1_2):
+        super().__init__(ca_certs_file=ca_certs_file, validate=validate,
+                         version=version)
+
+        # As ldap3 makes it for each connection
+        self.context = ssl.SSLContext(version)
+        if ca_certs_file:
+            self.context.load_verify_locations(ca_certs_file)
+        elif validate != ssl.CERT_NONE:
+            self.context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+        self.context.check_hostname = False
+        self.context.verify_mode = validate
+
+        # (host, port) -> the last session and a weak reference to the
+        # socket it came from, which may hold a newer one
+        self._sessions = dict()
+        self._sockets = dict()
+        self._lock = threading.Lock()
+
+    def _session(self, key):
+        with self._lock:
+            ref = self._sockets.get(key)
+            sock = ref() if ref is not None else None
+            try:
+                # TLS 1.3 tickets arrive after the handshake
+                session = sock.session if sock is not None else None
+            except (OSError, ValueError):
+                session = None
+            if session is not None:
+                self._sessions[key] = session
+            return self._sessions.get(key)
+
+    def wrap_socket(self, connection, do_handshake=False):
+        """Add TLS to the connection socket, resuming a session"""
+        key = (connection.server.host, connection.server.port)
+        session = self._session(key)
+        # A resumed handshake ends with the client's Finished, which the
+        # bind request would otherwise wait behind for an ACK
+        connection.socket.setsockopt(socket.IPPROTO_TCP,
+                                     socket.TCP_NODELAY, 1)
+        sock = self.context.wrap_socket(
+            connection.socket, server_side=False,
+            do_handshake_on_connect=do_handshake,
+            server_hostname=self.sni, session=session)
+
+        if do_handshake:
+            profiler.count('tls.resumed' if sock.session_reused
+                           else 'tls.full')
+            if self.validate in (ssl.CERT_REQUIRED, ssl.CERT_OPTIONAL):
+                check_hostname(sock, connection.server.host,
+                               self.valid_names)
+
+        with self._lock:
+            if sock.session is not None:
+                self._sessions[key] = sock.session
+            self._sockets[key] = weakref.ref(sock)
+        connection.socket = sock
@@ -1,5 +1,7 @@
 import subprocess
 
+from .profiling import profiler
+
 adquery_cmd = '/usr/bin/adquery'
 adquery_opts = ['enabled', 'unixname', 'samname', 'uid']
 adquery_valid_tok = ['zoneEnabled', 'unixname', 'uid',
@@ -11,10 +13,12 @@ def adquery(username):
     cmd += ['--' + opt for opt in adquery_opts]
     cmd += [username]
 
-    process = subprocess.run(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
+    profiler.count('subprocess.adquery')
+    with profiler.span('adquery'):
+        process = subprocess.run(cmd,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
 
     if process.returncode != 0:
         raise OSError("adquery call failed")
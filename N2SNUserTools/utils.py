@@ -1,13 +1,44 @@
-from prettytable import PrettyTable
 from .ldap import ADObjects
 from .unix import adquery
+from .output import get_writer
+from .profiling import profiler
 
 
+# URL of a query service to ask instead of the directory, set by the
+# console scripts
+service_url = None
+
 table_order = ['displayName', 'sAMAccountName',
                'mail', 'description', 'employeeID']
 
+record_fields = ['name', 'username', 'email', 'department',
+                 'number', 'status', 'login']
+record_names = ['Name', 'Username', 'E-Mail', 'Dep.',
+                'L/G Number', 'Status', 'Login']
+
+
+def directory(server, group_search, user_search, ca_certs_file):
+    """Get an anonymous ADObjects, or a client of the query service
+
+    With reusable set in ADObjects.session_defaults every call gets the
+    same shared ADObjects for the server, bound once.
+    """
+    if service_url is not None:
+        from .service import ServiceADObjects
+        return ServiceADObjects(service_url)
+
+    if ADObjects.session_defaults.get('reusable'):
+        return ADObjects.shared(server, group_search, user_search,
+                                ca_certs_file=ca_certs_file)
+
+    return ADObjects(server, group_search, user_search,
+                     ca_certs_file=ca_certs_file,
+                     authenticate=False)
+
+
+def format_user_table(users, attributes=None, sort=True):
+    from prettytable import PrettyTable
 
-def format_user_table(users, attributes=None):
     table = PrettyTable()
     names = ['Name', 'Username', 'E-Mail', 'Dep.',
              'L/G Number', 'Status', 'Login']
@@ -17,9 +48,10 @@ def format_user_table(users, attributes=None):
 
     table.field_names = names
 
-    users = dict(sorted(
-        users.items(), key=lambda item: item[1]['displayName']
-    ))
+    if sort:
+        users = dict(sorted(
+            users.items(), key=lambda item: item[1]['displayName']
+        ))
 
     for upn, user in users.items():
         row = [user[v] for v in table_order]
@@ -66,15 +98,72 @@ def format_user_table(users, attributes=None):
     return table
 
 
+def user_record(user, attributes=None):
+    """Make an output record for a user
+
+    The status is a list of account flags (empty if the account is OK)
+    and login is None if adquery failed.
+    """
+    record = dict(zip(record_fields, [user[v] for v in table_order]))
+
+    status = list()
+    if user['locked']:
+        status += ['LOCKED {} min'.format(
+            int(user['lock_time'].seconds / 60) + 1)]
+    if user['set_passwd']:
+        status += ['SET PASSWD']
+    if user['was_locked']:
+        status += ['LOCK CLEAR']
+    record['status'] = status
+
+    try:
+        result = adquery(user['sAMAccountName'])
+    except OSError:
+        record['login'] = None
+    else:
+        record['login'] = result['zoneEnabled'] == 'true'
+
+    if attributes is not None:
+        for a in attributes:
+            record[a] = a in user
+
+    return record
+
+
+def write_users(users, attributes=None, fmt='table', stream=None,
+                sort=None):
+    """Write users to stream in the chosen format
+
+    Each user is written as soon as it is taken from users, which may be
+    a generator. By default only the table format is sorted by name.
+    """
+    fields = record_fields + list(attributes or [])
+    names = record_names + [a.upper() for a in attributes or []]
+
+    if sort is None:
+        sort = fmt == 'table'
+    if sort:
+        users = sorted(users, key=lambda u: u['displayName'] or '')
+
+    # The span includes the adquery calls made for each user, and the
+    # searches when users is a generator
+    with profiler.span('output', format=fmt) as span, \
+            get_writer(fmt, fields, names, stream) as writer:
+        rows = 0
+        for user in users:
+            writer.write(user_record(user, attributes))
+            rows += 1
+        span.set(rows=rows)
+
+
 def n2sn_list_group_users_as_table(server, group_search, user_search,
                                    ca_certs_file, groups):
     """List all users who are in the users group"""
 
     # Connect to LDAP to get group members
 
-    with ADObjects(server, group_search, user_search,
-                   ca_certs_file=ca_certs_file,
-                   authenticate=False) as ad:
+    with directory(server, group_search, user_search,
+                   ca_certs_file) as ad:
         all_users = dict()
         for name, group in groups.items():
             users = ad.get_group_members_dict(group)
@@ -90,12 +179,161 @@ def n2sn_list_group_users_as_table(server, group_search, user_search,
 
 def n2sn_list_user_search_as_table(server, group_search, user_search,
                                    surname, givenname, user_type,
-                                   ca_certs_file):
+                                   ca_certs_file, name=None):
 
-    with ADObjects(server, group_search, user_search,
-                   ca_certs_file=ca_certs_file,
-                   authenticate=False) as ad:
+    with directory(server, group_search, user_search,
+                   ca_certs_file) as ad:
         users = ad.get_user_by_surname_and_givenname_dict(
-            surname, givenname, user_type
+            surname, givenname, user_type, name
         )
     return format_user_table(users)
+
+
+def n2sn_list_user_search_pages(server, group_search, user_search,
+                                surname, givenname, user_type,
+                                ca_certs_file, name=None,
+                                offset=0, limit=25):
+    """Yield pages of users sorted by the server
+
+    Yields a tuple of the list of users, the offset of the first user in
+    the page and the total number of users found. The connection is held
+    open between pages.
+    """
+
+    with directory(server, group_search, user_search,
+                   ca_certs_file) as ad:
+        while True:
+            users, total = ad.get_user_by_surname_and_givenname_page(
+                surname, givenname, user_type, name,
+                offset=offset, limit=limit
+            )
+            yield users, offset, total
+
+            offset += limit
+            if offset >= total:
+                break
+
+
+def n2sn_write_group_users(server, group_search, user_search,
+                           ca_certs_file, groups, fmt='table', stream=None):
+    """Write all users who are in the rights groups"""
+
+    with directory(server, group_search, user_search,
+                   ca_certs_file) as ad:
+        all_users = dict()
+        for name, group in groups.items():
+            for user in ad.iter_group_members(group):
+                upn = user['userPrincipalName']
+                all_users.setdefault(upn, user)[name] = True
+
+    write_users(all_users.values(), list(groups.keys()), fmt, stream)
+
+
+def n2sn_write_user_search(server, group_search, user_search,
+                           surname, givenname, user_type,
+                           ca_certs_file, name=None,
+                           fmt='table', stream=None):
+    """Write users found by name, streaming each page as it arrives"""
+
+    with directory(server, group_search, user_search,
+                   ca_certs_file) as ad:
+        write_users(ad.iter_user_by_surname_and_givenname(
+            surname, givenname, user_type, name), fmt=fmt, stream=stream)
+
+
+def _find_users(ad, attribute, values, missing, not_unique):
+    """Look up users by attribute with one search per chunk, returning
+    one user for each of values in order"""
+    found = dict()
+    for user in ad.iter_users_by_attribute(attribute, set(values)):
+        # By DN, as a user may match in more than one chunk
+        found.setdefault(str(user[attribute]).lower(), dict())[
+            user['distinguishedName'].lower()] = user
+
+    users = list()
+    for value in values:
+        user = list(found.get(str(value).lower(), {}).values())
+        if len(user) == 0:
+            raise RuntimeError(missing.format(value))
+        if len(user) != 1:
+            raise RuntimeError(not_unique.format(value))
+        users.append(user[0])
+    return users
+
+
+def resolve_change(ad, groups, logins=None, life_numbers=None, purge=False):
+    """Find what a change of rights touches before it is made
+
+    groups maps keys, such as rights or (instrument, right) pairs, to
+    group names. Returns a dict mapping each key to a dict of the group,
+    the users to change and the lower case DNs of those users already in
+    the group. With purge the users are all the users directly in the
+    group.
+
+    The users, the groups and the memberships are each found with one
+    search, however many groups there are.
+    """
+    users = list()
+    if logins:
+        users += _find_users(
+            ad, 'sAMAccountName', logins,
+            "Unable to find user {}, please check.",
+            "Login (Username) {} is not unique. Please check.")
+    if life_numbers:
+        users += _find_users(
+            ad, 'employeeID', life_numbers,
+            "Unable to find user with life/guest number {}, please check.",
+            "Life/Guest number {} is not unique. Please check.")
+
+    found = dict()
+    for group in ad.get_groups_by_samaccountname(set(groups.values())):
+        found.setdefault(group['sAMAccountName'].lower(), []).append(group)
+
+    changes = dict()
+    for key, group_name in groups.items():
+        group = found.get(group_name.lower(), [])
+        if len(group) != 1:
+            raise RuntimeError("Unable to find correct group for users")
+        changes[key] = {'group': group[0]}
+
+    if not purge:
+        memberships = ad.get_direct_memberships(
+            [u['distinguishedName'] for u in users],
+            [c['group']['distinguishedName'] for c in changes.values()])
+
+    for change in changes.values():
+        group_dn = change['group']['distinguishedName']
+        if purge:
+            change['users'] = list(ad.iter_direct_members(group_dn))
+            change['members'] = set(
+                m['distinguishedName'].lower() for m in change['users'])
+        else:
+            change['users'] = users
+            change['members'] = set(
+                dn for dn, groups in memberships.items()
+                if group_dn.lower() in groups)
+
+    return changes
+
+
+def prefetch(server, group_search, user_search, ca_certs_file, func,
+             *args, **kwargs):
+    """Start func(ad, *args, **kwargs) on an anonymous connection
+
+    Used to make the public lookups of a change, such as
+    resolve_change(), while the user types the password for the
+    authenticated connection. Returns a concurrent.futures.Future of the
+    result.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def resolve():
+        with directory(server, group_search, user_search,
+                       ca_certs_file) as ad:
+            with profiler.span('prefetch'):
+                return func(ad, *args, **kwargs)
+
+    executor = ThreadPoolExecutor(1, thread_name_prefix='prefetch')
+    future = executor.submit(resolve)
+    executor.shutdown(wait=False)
+    return future
@@ -0,0 +1,86 @@
+"""Compare sequential lookups with concurrent AsyncADObjects lookups
+
+The mock directory answers at once, so a round trip time is simulated:
+each ADObjects search sleeps for it, and each AsyncADObjects reply is
+delivered by a timer thread after it, standing in for ldap3's receiver
+thread. On one connection the sequential lookups wait lookups x latency
+while the concurrent ones wait about one latency. Both also pay the
+mock's own search time, which is not concurrent.
+
+    python benchmarks/bench_async.py [--lookups 200] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from ldap3 import MOCK_ASYNC
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools.aio import AsyncADObjects  # noqa: E402
+
+
+def latency_async_adobjects(directory, latency):
+    class LatencyAsyncADObjects(AsyncADObjects):
+        def __init__(self, **kwargs):
+            super().__init__(directory.server, mockad.BASE,
+                             mockad.USER_BASE, client_strategy=MOCK_ASYNC,
+                             **kwargs)
+
+        def _install_wake(self):
+            super()._install_wake()
+            # Wait for the simulated receiver thread
+            self._answered_on_send = False
+
+        async def _response(self, message_id):
+            loop = self._loop
+            threading.Timer(latency, loop.call_soon_threadsafe,
+                            (self._wake, message_id)).start()
+            return await super()._response(message_id)
+
+    return LatencyAsyncADObjects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Simulated round trip time in seconds')
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(args.users, [10], 1)
+    logins = ['user{:06d}'.format(n % args.users)
+              for n in range(args.lookups)]
+
+    ADObjects = mockad.latency_adobjects(directory, args.latency)
+    with ADObjects() as ad:
+        start = time.perf_counter()
+        expected = [ad.get_user_by_samaccountname(n) for n in logins]
+        sequential = time.perf_counter() - start
+
+    AsyncAD = latency_async_adobjects(directory, args.latency)
+
+    async def lookups():
+        async with AsyncAD() as ad:
+            start = time.perf_counter()
+            users = await asyncio.gather(
+                *[ad.get_user_by_samaccountname(n) for n in logins])
+            return users, time.perf_counter() - start
+
+    users, concurrent = asyncio.run(lookups())
+    if users != expected:
+        raise RuntimeError("Async lookups returned different users")
+
+    print('{} lookups, {:.1f} ms simulated latency'.format(
+        args.lookups, args.latency * 1000))
+    print('{:<12} {:>10.1f} ms'.format('sequential', sequential * 1000))
+    print('{:<12} {:>10.1f} ms'.format('concurrent', concurrent * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Compare candidate sets for legacy and planned user search filters
+
+A simulated domain controller answers an AND filter by taking the
+smallest set it can read from an attribute index and evaluating the
+remaining terms on each candidate, or by scanning every object when no
+term can use an index.  The number of candidates, term evaluations and
+matches is reported for the filter n2sn_search_user used to send and for
+the planned one.
+
+The candidates are the same: the index read is chosen by size, and both
+filters have the same indexed terms, or none. The planned filter drops
+the presence terms and checks the object class guard last, so fewer
+terms are evaluated on the candidates, and matches no contacts, which
+the legacy filter returned as users.
+
+    python benchmarks/bench_filters.py [--users N] [--output FILE]
+"""
+import argparse
+import bisect
+import json
+import random
+import re
+import string
+
+from N2SNUserTools.filters import INDEXED_ATTRIBUTES, plan_user_search
+
+_TERM = re.compile(r'\(([A-Za-z]+)=([^()]*)\)')
+
+USER_TYPES = ['LT', 'PS', 'NC', 'XX']
+
+
+def legacy_filter(surname, givenname, user_type):
+    return '(&(sn={})(givenName={})(description={}))'.format(
+        surname or '*', givenname or '*', user_type or '*')
+
+
+def make_directory(n_users, seed=0):
+    rnd = random.Random(seed)
+    surnames = [''.join(rnd.choice(string.ascii_lowercase)
+                        for _ in range(6)).title()
+                for _ in range(max(10, n_users // 20))]
+    givennames = [''.join(rnd.choice(string.ascii_lowercase)
+                          for _ in range(5)).title()
+                  for _ in range(max(10, n_users // 50))]
+    objects = list()
+    for i in range(n_users):
+        objects.append({'objectCategory': 'person', 'objectClass': 'user',
+                        'sn': rnd.choice(surnames),
+                        'givenName': rnd.choice(givennames),
+                        'sAMAccountName': 'user{}'.format(i),
+                        'description': rnd.choice(USER_TYPES)})
+    # Groups and computers share the subtree but are never users
+    for i in range(n_users // 2):
+        objects.append({'objectCategory': 'group', 'objectClass': 'group',
+                        'sAMAccountName': 'group{}'.format(i),
+                        'description': rnd.choice(USER_TYPES)})
+    # Mail contacts are people with names but no account
+    for i in range(n_users // 10):
+        objects.append({'objectCategory': 'person',
+                        'objectClass': 'contact',
+                        'sn': rnd.choice(surnames),
+                        'givenName': rnd.choice(givennames),
+                        'description': rnd.choice(USER_TYPES)})
+    for i in range(n_users // 4):
+        objects.append({'objectCategory': 'computer',
+                        'objectClass': 'user',
+                        'sAMAccountName': 'host{}$'.format(i)})
+    return objects, surnames, givennames
+
+
+def build_indexes(objects):
+    indexes = dict()
+    for attr in INDEXED_ATTRIBUTES:
+        values = sorted((o[attr].lower(), n) for n, o in enumerate(objects)
+                        if attr in o)
+        indexes[attr] = values
+    return indexes
+
+
+def index_lookup(index, value):
+    if value == '*':
+        return len(index)
+    if '*' in value:
+        prefix = value.split('*')[0].lower()
+        lo = bisect.bisect_left(index, (prefix,))
+        hi = bisect.bisect_left(index, (prefix + '\uffff',))
+    else:
+        lo = bisect.bisect_left(index, (value.lower(),))
+        hi = bisect.bisect_right(index, (value.lower(), float('inf')))
+    return hi - lo
+
+
+def match(obj, terms):
+    """Evaluate terms in order, returning the match and terms evaluated"""
+    for n, (attr, value) in enumerate(terms, 1):
+        if attr not in obj:
+            return False, n
+        pattern = '^' + '.*'.join(re.escape(p) for p in value.split('*'))
+        if not re.match(pattern + '$', obj[attr], re.IGNORECASE):
+            return False, n
+    return True, len(terms)
+
+
+def evaluate(objects, indexes, search_filter):
+    terms = _TERM.findall(search_filter)
+    sizes = [(index_lookup(indexes[a], v), (a, v)) for a, v in terms
+             if a in indexes and (v == '*' or not v.startswith('*'))]
+    if sizes:
+        n_candidates, used = min(sizes)
+        terms.remove(used)
+        candidates = [o for o in objects if match(o, [used])[0]]
+    else:
+        candidates = objects
+
+    matched = evaluated = 0
+    for obj in candidates:
+        ok, n = match(obj, terms)
+        matched += ok
+        evaluated += n
+    return len(candidates), evaluated, matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    objects, surnames, givennames = make_directory(args.users)
+    indexes = build_indexes(objects)
+
+    queries = {
+        'guest': (None, None, 'LT'),
+        'surname': (surnames[0], None, None),
+        'surname_prefix': (surnames[0][:2] + '*', None, 'PS'),
+        'given_and_type': (None, givennames[0], 'LT'),
+        'full_name': (surnames[1], givennames[1], None),
+    }
+
+    results = dict()
+    for label, query in queries.items():
+        legacy = evaluate(objects, indexes, legacy_filter(*query))
+        planned = evaluate(objects, indexes, plan_user_search(*query).filter)
+        results[label] = {
+            name: dict(zip(('candidates', 'evaluations', 'matched'), r))
+            for name, r in (('legacy', legacy), ('planned', planned))
+        }
+        print('{:<16} candidates {:>7} -> {:>7}   evaluations {:>7} -> {:>7}'
+              '   matched {:>6} -> {:>6}'
+              .format(label, legacy[0], planned[0], legacy[1], planned[1],
+                      legacy[2], planned[2]))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'objects': len(objects), 'queries': results}, f,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
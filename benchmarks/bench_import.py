@@ -0,0 +1,63 @@
+"""Check the import cost of the console scripts
+
+Imports N2SNUserTools.cli in a fresh interpreter with -X importtime and
+fails if it takes longer than the budget or loads a module that should
+only be imported once a command runs.
+
+    python benchmarks/bench_import.py [--budget MS] [--output FILE]
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# Modules which must not be loaded before argument parsing
+DEFERRED = ['ldap3', 'yaml', 'prettytable', 'gssapi', 'ssl']
+
+
+def import_times(module):
+    """Return the cumulative import time (us) of each module loaded"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+    times = dict()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=float, default=100.0,
+                        help='Import budget in ms (default: 100)')
+    parser.add_argument('--module', default='N2SNUserTools.cli')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    times = import_times(args.module)
+    total = times[args.module] / 1000
+    loaded = [m for m in DEFERRED if m in times]
+
+    print('import {} : {:.1f} ms (budget {:.1f} ms)'.format(
+        args.module, total, args.budget))
+    for module in loaded:
+        print('deferred module imported : {} ({:.1f} ms)'.format(
+            module, times[module] / 1000))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'module': args.module, 'total_ms': total,
+                       'budget_ms': args.budget, 'deferred': loaded,
+                       'modules_us': times}, f, indent=2)
+
+    if total > args.budget or loaded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
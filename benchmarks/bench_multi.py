@@ -0,0 +1,97 @@
+"""Time adding and removing rights for a sector of instruments
+
+A config file defines --instruments instruments, each with a user and an
+admin right, and an instrument group 'sector' of them all. The first
+two instruments share their admin group. --users users are given
+rights:
+
+* with n2sn_add_user and n2sn_remove_user run once per instrument, as
+  staff managing a sector did
+* with one run given '-i sector'
+
+Each search and modify waits a simulated round trip time. The time,
+binds, searches and modifies of each are reported, and the groups are
+checked to hold the users after adding and none after removing.
+
+    python benchmarks/bench_multi.py [--instruments 6] [--users 3]
+        [--latency 0.005]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+from bench_roster import run  # noqa: E402
+
+from N2SNUserTools import ldap, utils  # noqa: E402
+from N2SNUserTools.profiling import profiler  # noqa: E402
+
+
+def counters():
+    return [profiler.counters.get('ldap.' + name, 0)
+            for name in ('bindRequest', 'searchRequest', 'modifyRequest')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instruments', type=int, default=6)
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Simulated round trip time in seconds')
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(200, [10], 1)
+    ADObjects = mockad.latency_adobjects(directory, args.latency)
+    ldap.ADObjects = utils.ADObjects = ADObjects
+
+    instruments = dict()
+    for n in range(args.instruments):
+        admin = 'sec-admin' if n < 2 else 'inst{}-admin'.format(n)
+        if admin not in directory.groups:
+            directory.add_group(admin, [])
+        directory.add_group('inst{}-user'.format(n), [])
+        instruments['inst{}'.format(n)] = {
+            'user': 'inst{}-user'.format(n), 'admin': admin}
+    group_dns = set(directory.groups[group] for rights in
+                    instruments.values() for group in rights.values())
+
+    mockad.write_config(tempfile.mkdtemp(prefix='n2sn-bench-'),
+                        instruments, {'sector': list(instruments)})
+    logins = ','.join('user{:06d}'.format(100 + n)
+                      for n in range(args.users))
+
+    def held():
+        return sum(len(directory.server.dit[dn].get('member', []))
+                   for dn in group_dns)
+
+    profiler.enable()
+    print('{} instruments, {} users, {:.1f} ms simulated latency'.format(
+        args.instruments, args.users, args.latency * 1000))
+    print('{:<36} {:>8} {:>6} {:>9} {:>9}'.format(
+        '', 'ms', 'binds', 'searches', 'modifies'))
+
+    for name, runs in (
+            ('once per instrument', [['-i', i] for i in instruments]),
+            ('-i sector', [['-i', 'sector']])):
+        for script, expected in (('n2sn_add_user', len(group_dns)),
+                                 ('n2sn_remove_user', 0)):
+            before = counters()
+            start = time.perf_counter()
+            for argv in runs:
+                out = run(script, argv + ['-l', logins, 'user,admin'])
+            elapsed = time.perf_counter() - start
+            if held() != expected * args.users:
+                raise RuntimeError("{} {} left {} members".format(
+                    script, name, held()))
+            print('{:<36} {:>8.1f} {:>6} {:>9} {:>9}'.format(
+                '{} {}'.format(script, name), elapsed * 1000,
+                *[a - b for a, b in zip(counters(), before)]))
+
+    print('\n' + out.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    main()
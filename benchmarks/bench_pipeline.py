@@ -0,0 +1,87 @@
+"""Time pipelined group membership changes for growing windows
+
+--groups groups each get --users users added, one modify per group and
+user, then removed again, as adding a few users to every right of
+several instruments does. With a window of 1 the connection is
+synchronous and each modify waits a round trip. Larger windows keep
+that many modifies in flight on one asynchronous connection, until the
+simulated server, answering one request every --service seconds, is the
+limit. Finally n2sn_add_user and n2sn_remove_user change one user's
+--groups rights of an instrument with --window 1 and the default
+window, timing the whole script including its lookups.
+
+    python benchmarks/bench_pipeline.py [--latency 0.02] [--service 0.001]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from ldap3 import ASYNC, SYNC, MODIFY_ADD, MODIFY_DELETE
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+from bench_roster import run  # noqa: E402
+
+from N2SNUserTools import ldap, utils  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--groups', type=int, default=15)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--windows', default='1,2,4,8,16,32')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Simulated round trip time in seconds')
+    parser.add_argument('--service', type=float, default=0.001,
+                        help='Simulated server time per request')
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(1000, [], 1)
+    groups = [directory.add_group('rights-{}'.format(n), [])
+              for n in range(args.groups)]
+    users = directory.users[:args.users]
+    ADObjects = mockad.latency_adobjects(directory, args.latency,
+                                         args.service)
+
+    print('{} modifies, {:.1f} ms round trip, {:.1f} ms server time'
+          .format(args.groups * args.users, args.latency * 1000,
+                  args.service * 1000))
+    print('{:>6} {:>10} {:>10} {:>10}'.format(
+        'window', 'add s', 'remove s', 'modify/s'))
+
+    for window in [int(w) for w in args.windows.split(',')]:
+        times = list()
+        with ADObjects(client_strategy=ASYNC if window > 1 else SYNC,
+                       write_window=window) as ad:
+            for operation in (MODIFY_ADD, MODIFY_DELETE):
+                changes = [(group, user, operation)
+                           for group in groups for user in users]
+                start = time.perf_counter()
+                errors = list(ad.change_group_members(changes))
+                times.append(time.perf_counter() - start)
+                if any(errors):
+                    raise RuntimeError("Changes failed: {}".format(
+                        [e for e in errors if e][0]))
+        print('{:>6} {:>10.3f} {:>10.3f} {:>10.0f}'.format(
+            window, times[0], times[1], len(changes) / min(times)))
+
+    # One user to every right of an instrument with the console script
+    ldap.ADObjects = utils.ADObjects = ADObjects
+    mockad.write_config(tempfile.mkdtemp(prefix='n2sn-bench-'),
+                        {'tst': {'r{}'.format(n): 'rights-{}'.format(n)
+                                 for n in range(args.groups)}})
+    rights = ','.join('r{}'.format(n) for n in range(args.groups))
+    print('')
+    for window in ('1', str(ldap.WRITE_WINDOW)):
+        for script in ('n2sn_add_user', 'n2sn_remove_user'):
+            start = time.perf_counter()
+            run(script, ['-i', 'tst', '-l', 'user000999', rights,
+                         '--window', window])
+            print('{:<17} --window {:<3} {:>7.3f} s'.format(
+                script, window, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
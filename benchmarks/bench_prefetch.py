@@ -0,0 +1,101 @@
+"""Time adding rights after the password is entered, with and without
+prefetch
+
+n2sn_add_user looks up the rights groups, the users and their current
+membership on an anonymous connection while the password is typed. This
+compares the time from pressing Enter to the end of the change when the
+lookups are made after the prompt on the authenticated connection, as
+before, and when they were prefetched. Each search and modify waits a
+simulated round trip time.
+
+    python benchmarks/bench_prefetch.py [--users 5] [--rights 3]
+        [--latency 0.02] [--prompt 1]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools import utils  # noqa: E402
+
+
+def add_rights(ad, changes):
+    for change in changes.values():
+        for user in change['users']:
+            if user['distinguishedName'].lower() not in change['members']:
+                ad.add_user_to_group_by_dn(
+                    change['group']['distinguishedName'],
+                    user['distinguishedName'])
+
+
+def undo(ADObjects, changes):
+    with ADObjects() as ad:
+        for change in changes.values():
+            for user in change['users']:
+                if user['distinguishedName'].lower() not in \
+                   change['members']:
+                    ad.remove_user_from_group_by_dn(
+                        change['group']['distinguishedName'],
+                        user['distinguishedName'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5,
+                        help='Users given on the command line')
+    parser.add_argument('--rights', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Simulated round trip time in seconds')
+    parser.add_argument('--prompt', type=float, default=1,
+                        help='Seconds taken to type the password')
+    args = parser.parse_args()
+
+    sizes = [10 * (n + 1) for n in range(args.rights)]
+    directory = mockad.make_directory(1000, sizes, 2)
+    ADObjects = mockad.latency_adobjects(directory, args.latency)
+    utils.ADObjects = ADObjects
+
+    groups = {'right{}'.format(n): 'rights-{}'.format(size)
+              for n, size in enumerate(sizes)}
+    logins = ['user{:06d}'.format(500 + n) for n in range(args.users)]
+
+    # Before: the lookups follow the prompt on the authenticated
+    # connection
+    time.sleep(args.prompt)
+    start = time.perf_counter()
+    with ADObjects() as ad:
+        changes = utils.resolve_change(ad, groups, logins)
+        add_rights(ad, changes)
+        after_searches = ad.searches
+    before = time.perf_counter() - start
+    undo(ADObjects, changes)
+
+    # After: the lookups run while the password is typed
+    prefetch = utils.prefetch(None, mockad.BASE, mockad.USER_BASE, None,
+                              utils.resolve_change, groups, logins)
+    time.sleep(args.prompt)
+    start = time.perf_counter()
+    with ADObjects() as ad:
+        prefetched = prefetch.result()
+        add_rights(ad, prefetched)
+        prefetch_searches = ad.searches
+    after = time.perf_counter() - start
+    undo(ADObjects, prefetched)
+
+    if prefetched != changes:
+        raise RuntimeError("Prefetched changes differ")
+
+    print('{} users, {} rights, {:.1f} ms simulated latency'.format(
+        args.users, args.rights, args.latency * 1000))
+    print('{:<24} {:>10} {:>10}'.format('', 'ms', 'searches'))
+    print('{:<24} {:>10.1f} {:>10}'.format(
+        'lookups after prompt', before * 1000, after_searches))
+    print('{:<24} {:>10.1f} {:>10}'.format(
+        'prefetched', after * 1000, prefetch_searches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Check that resilient mode carries on after losing the connection
+
+The mock connection is dropped every --every operations: the request in
+hand fails with a socket error, a modify after it was made on every
+other drop, as when the reply is lost, and every later request on that
+connection fails too. With resilient=True:
+
+* a paged search of a 1000 member group, in 4 pages, must yield every
+  member once
+* --lookups single user searches must all be answered
+* --changes single user adds and removes, made with SYNC and ASYNC
+  connections, must all succeed and leave the groups as asked
+
+Without it the first drop must raise. The reconnects and the time taken
+are reported.
+
+    python benchmarks/bench_resilient.py [--every 7] [--changes 300]
+"""
+import argparse
+import os
+import sys
+import time
+
+from ldap3 import ASYNC, SYNC, MODIFY_ADD, MODIFY_DELETE
+from ldap3.core.exceptions import (LDAPSocketReceiveError,
+                                   LDAPSocketSendError)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools.profiling import profiler  # noqa: E402
+
+
+def dropping_adobjects(directory, every):
+    """Get an ADObjects class whose connections are dropped every
+    every operations"""
+    ADObjects = mockad.mock_adobjects(directory)
+    counter = {'operations': 0, 'drops': 0}
+
+    class DroppingADObjects(ADObjects):
+        _RETRY_BACKOFF = 0.001
+
+        def _connect(self, **kwargs):
+            super()._connect(**kwargs)
+            connection = self.connection
+            state = {'lost': False}
+
+            def dropping(send, name):
+                def send_or_drop(*args, **kwargs):
+                    if state['lost']:
+                        raise LDAPSocketSendError('connection lost')
+                    counter['operations'] += 1
+                    if counter['operations'] % every:
+                        return send(*args, **kwargs)
+                    state['lost'] = True
+                    counter['drops'] += 1
+                    if name == 'modify' and counter['drops'] % 2:
+                        # Made, but the reply never arrives
+                        send(*args, **kwargs)
+                    raise LDAPSocketReceiveError('connection lost')
+                return send_or_drop
+
+            get_response = connection.get_response
+
+            def response(*args, **kwargs):
+                if state['lost']:
+                    raise LDAPSocketReceiveError('connection lost')
+                return get_response(*args, **kwargs)
+
+            connection.search = dropping(connection.search, 'search')
+            connection.modify = dropping(connection.modify, 'modify')
+            connection.get_response = response
+
+    return DroppingADObjects, counter
+
+
+def members(directory, dn):
+    return set(m.lower() for m in
+               directory.server.dit[dn].get('member', []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--every', type=int, default=7)
+    parser.add_argument('--lookups', type=int, default=100)
+    parser.add_argument('--changes', type=int, default=300)
+    parser.add_argument('--groups', type=int, default=10)
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(2000, [1000], 1)
+    groups = [directory.add_group('resilient-{}'.format(n), [])
+              for n in range(args.groups)]
+    ADObjects = mockad.mock_adobjects(directory)
+    with ADObjects() as ad:
+        group = ad.get_group_by_samaccountname('rights-1000')[0]
+        expected = sorted(m['distinguishedName'] for m in
+                          ad.iter_direct_member_ids(
+                              group['distinguishedName'], page_size=100))
+
+    Dropping, counter = dropping_adobjects(directory, args.every)
+    profiler.enable()
+    print('Connection dropped every {} operations'.format(args.every))
+
+    def report(name, start):
+        print('{:<28} {:>7.3f} s {:>5} drops {:>5} reconnects'.format(
+            name, time.perf_counter() - start, counter['drops'],
+            profiler.counters.get('ldap.retry', 0)))
+        counter['drops'] = 0
+        profiler.reset()
+
+    # Drop the connection asking for the third page
+    counter['operations'] = args.every - 3
+    start = time.perf_counter()
+    with Dropping(resilient=True) as ad:
+        found = [m['distinguishedName'] for m in ad.iter_direct_member_ids(
+            group['distinguishedName'], page_size=250)]
+    if sorted(found) != expected:
+        raise RuntimeError("Paged search gave {} members for {}".format(
+            len(found), len(expected)))
+    report('paged search, 4 pages', start)
+
+    start = time.perf_counter()
+    with Dropping(resilient=True, cache_size=0) as ad:
+        for user in directory.users[:args.lookups]:
+            login = user.split(',')[0][3:]
+            if len(ad.get_user_by_samaccountname(login)) != 1:
+                raise RuntimeError("{} not found".format(login))
+    report('{} lookups'.format(args.lookups), start)
+
+    changes = [(groups[n % args.groups], directory.users[n])
+               for n in range(args.changes)]
+    for strategy in (SYNC, ASYNC):
+        for operation in (MODIFY_ADD, MODIFY_DELETE):
+            start = time.perf_counter()
+            with Dropping(resilient=True, client_strategy=strategy) as ad:
+                errors = [e for e in ad.change_group_members(
+                    [(g, u, operation) for g, u in changes]) if e]
+            if errors:
+                raise RuntimeError("Changes failed: {}".format(errors[0]))
+            held = sum(len(members(directory, g)) for g in groups)
+            if held != (args.changes if operation == MODIFY_ADD else 0):
+                raise RuntimeError("Groups hold {} members".format(held))
+            report('{} {} {}'.format(
+                args.changes, 'adds' if operation == MODIFY_ADD
+                else 'removes', 'ASYNC' if strategy == ASYNC else 'SYNC'),
+                start)
+
+    try:
+        with Dropping(cache_size=0) as ad:
+            for user in directory.users:
+                ad.get_user_by_samaccountname(user.split(',')[0][3:])
+    except LDAPSocketReceiveError:
+        print('Without --resilient the first drop raises')
+    else:
+        raise RuntimeError("A drop did not raise without resilient")
+
+
+if __name__ == '__main__':
+    main()
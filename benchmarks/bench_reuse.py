@@ -0,0 +1,86 @@
+"""Time reusable ADObjects against a new connection per with block
+
+Each bind of the mock connection is made to take --handshake seconds,
+standing in for the TCP and TLS handshakes and the bind round trips.
+--lookups user lookups, each in its own with block as library code
+calling ADObjects from a loop does, are timed with a new ADObjects each
+time and with ADObjects.shared(). Then a reusable connection must be
+closed after idle_timeout and bind again on next use, and a connection
+closed by the server must fail the rootDSE check and be replaced.
+
+    python benchmarks/bench_reuse.py [--lookups 100] [--handshake 0.02]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools import ldap  # noqa: E402
+from N2SNUserTools.profiling import profiler  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lookups', type=int, default=100)
+    parser.add_argument('--handshake', type=float, default=0.02,
+                        help='Simulated connect and bind time in seconds')
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(args.lookups, [], 1)
+    logins = [dn.split(',')[0][3:] for dn in directory.users]
+
+    class SlowBindADObjects(mockad.mock_adobjects(directory)):
+        def _bind(self):
+            time.sleep(args.handshake)
+            super()._bind()
+
+    def lookups(make):
+        profiler.reset()
+        start = time.perf_counter()
+        for login in logins:
+            with make() as ad:
+                if len(ad.get_user_by_samaccountname(login)) != 1:
+                    raise RuntimeError("{} not found".format(login))
+        return (time.perf_counter() - start,
+                profiler.counters.get('ldap.bindRequest', 0))
+
+    profiler.enable()
+    print('{} lookups, one with block each, {:.0f} ms handshake'.format(
+        args.lookups, args.handshake * 1000))
+    for name, make in (('new ADObjects', SlowBindADObjects),
+                       ('ADObjects.shared()', lambda: SlowBindADObjects.shared(
+                           None, mockad.BASE, mockad.USER_BASE))):
+        elapsed, binds = lookups(make)
+        print('{:<20} {:>8.3f} s {:>6} binds'.format(name, elapsed, binds))
+
+    # Closed when idle, bound again on next use
+    ad = SlowBindADObjects(reusable=True, idle_timeout=0.2)
+    with ad:
+        ad.get_user_by_samaccountname(logins[0])
+    time.sleep(0.5)
+    if ad._connection is not None:
+        raise RuntimeError("The idle connection was not closed")
+    profiler.reset()
+    with ad:
+        ad.get_user_by_samaccountname(logins[1])
+    print('Idle connection closed after 0.2 s, bound again on use: {} bind'
+          .format(profiler.counters.get('ldap.bindRequest', 0)))
+
+    # Closed by the server while idle
+    ldap.CHECK_AFTER = 0
+    ad._connection.unbind()
+    profiler.reset()
+    with ad:
+        ad.get_user_by_samaccountname(logins[2])
+    if not profiler.counters.get('ldap.check_failed'):
+        raise RuntimeError("The closed connection passed the check")
+    print('Connection closed by the server failed the rootDSE check and '
+          'was replaced')
+    ad.close()
+
+
+if __name__ == '__main__':
+    main()
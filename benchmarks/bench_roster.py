@@ -0,0 +1,111 @@
+"""Time n2sn_add_user and n2sn_remove_user with a roster file
+
+Runs the console scripts against the mock directory with a generated
+roster of --rows users spread over the instrument's rights, first adding
+and then removing them. The lookups, made while the password is typed,
+and the changes, made once authenticated, are timed and their LDAP
+requests counted, and compared with running the scripts once per row.
+Each search and modify waits a simulated round trip time, overlapping
+for modifies pipelined on one connection. The mock evaluates a filter
+by testing every entry against every term, so its lookup times grow
+with the roster where a domain controller's indexed searches would not.
+
+    python benchmarks/bench_roster.py [--rows 500] [--latency 0.005]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools import cli, ldap, utils  # noqa: E402
+from N2SNUserTools.profiling import profiler  # noqa: E402
+
+RIGHTS = {'user': 'rights-10', 'admin': 'rights-100'}
+
+
+def run(script, argv):
+    """Run a console script, returning its standard output"""
+    sys.argv = [script] + argv
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), \
+            contextlib.redirect_stderr(io.StringIO()):
+        try:
+            getattr(cli, script)()
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError("{} failed".format(script))
+    return out.getvalue()
+
+
+def requests():
+    return (profiler.counters.get('ldap.searchRequest', 0),
+            profiler.counters.get('ldap.modifyRequest', 0))
+
+
+def last_span(name):
+    return [s for s in profiler.spans if s.name == name][-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Simulated round trip time in seconds')
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(args.rows + 200, [10, 100], 2)
+    ADObjects = mockad.latency_adobjects(directory, args.latency)
+    ldap.ADObjects = utils.ADObjects = ADObjects
+
+    tmp = tempfile.mkdtemp(prefix='n2sn-bench-')
+    mockad.write_config(tmp, {'tst': RIGHTS})
+
+    roster = os.path.join(tmp, 'roster.csv')
+    rows = list()
+    with open(roster, 'w') as f:
+        f.write('login,rights\n')
+        for n in range(args.rows):
+            login = 'user{:06d}'.format(200 + n)
+            right = 'user' if n % 3 else 'user;admin'
+            rows.append((login, right))
+            f.write('{},{}\n'.format(login, right))
+
+    profiler.enable()
+    print('{} rows, {:.1f} ms simulated latency'.format(
+        args.rows, args.latency * 1000))
+    print('{:<28} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+        '', 'lookup s', 'searches', 'change s', 'modifies', 'changes'))
+
+    for script in ('n2sn_add_user', 'n2sn_remove_user'):
+        searches, modifies = requests()
+        out = run(script, ['-i', 'tst', '--from-file', roster,
+                           '-f', 'csv'])
+        changed = out.count(',added,') + out.count(',removed,')
+        print('{:<28} {:>9.2f} {:>9} {:>9.2f} {:>9} {:>8}'.format(
+            script + ' --from-file', last_span('prefetch').duration,
+            requests()[0] - searches, last_span('roster.apply').duration,
+            requests()[1] - modifies, changed))
+
+    # A sample of rows made one invocation at a time, scaled up
+    sample = rows[:20]
+    searches, modifies = requests()
+    start = time.perf_counter()
+    for login, right in sample:
+        run('n2sn_add_user', ['-i', 'tst', '-l', login,
+                              right.replace(';', ',')])
+    scale = args.rows / len(sample)
+    print('\nn2sn_add_user once per row, estimated from {} rows : '
+          '{:.1f} s, {:.0f} searches, {:.0f} modifies'.format(
+              len(sample), (time.perf_counter() - start) * scale,
+              (requests()[0] - searches) * scale,
+              (requests()[1] - modifies) * scale))
+
+
+if __name__ == '__main__':
+    main()
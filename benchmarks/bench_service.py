@@ -0,0 +1,111 @@
+"""Check and time the query service against the mock directory
+
+Starts a QueryService on the mock directory and:
+
+* compares the listing and search output made through the service with
+  the output made directly
+* sends many identical requests at once and counts the LDAP searches
+  they cost (request coalescing makes it one query)
+* times cold and cached requests
+
+    python benchmarks/bench_service.py [--clients 32] [--connections 4]
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools import utils  # noqa: E402
+from N2SNUserTools.cache import Memo  # noqa: E402
+from N2SNUserTools.config import compile_config  # noqa: E402
+from N2SNUserTools.profiling import profiler  # noqa: E402
+from N2SNUserTools.service import (ConnectionPool, QueryService,  # noqa
+                                   serve)
+
+RIGHTS = {'user': 'rights-10', 'admin': 'rights-100'}
+
+
+def listing(service_url, fmt='table'):
+    utils.service_url = service_url
+    out = io.StringIO()
+    utils.n2sn_write_group_users(None, mockad.BASE, mockad.USER_BASE, None,
+                                 RIGHTS, fmt, out)
+    utils.n2sn_write_user_search(None, mockad.BASE, mockad.USER_BASE,
+                                 None, 'Ann', 'LT', None, fmt=fmt,
+                                 stream=out)
+    utils.service_url = None
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--connections', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(args.users, [10, 100, 1000], 2)
+    mockad.stub_adquery()
+    ADObjects = mockad.mock_adobjects(directory)
+    utils.ADObjects = ADObjects
+
+    # Enabled before connecting so LDAP requests are counted
+    profiler.enable()
+
+    config = compile_config({'instruments': {'tst': {
+        'name': 'tst', 'rights': RIGHTS}}})
+    pool = ConnectionPool(ADObjects, args.connections)
+    service = QueryService(pool, Memo('service', ttl=60), config)
+    server = serve(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    if listing(url) != listing(None):
+        raise RuntimeError("Output through the service differs")
+    print('Listing and search output through the service match')
+
+    with ADObjects() as ad:
+        login = ad.get_group_members('rights-10')[0]['sAMAccountName']
+    print('Rights of {} : {}'.format(login, urllib.request.urlopen(
+        url + '/users/{}/rights'.format(login)).read().decode()))
+
+    def get(path, times):
+        start = time.perf_counter()
+        urllib.request.urlopen(url + path).read()
+        times.append(time.perf_counter() - start)
+
+    before = profiler.counters.get('ldap.searchRequest', 0)
+    cold = list()
+    threads = [threading.Thread(target=get,
+                                args=('/groups/rights-1000/members', cold))
+               for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    searches = profiler.counters.get('ldap.searchRequest', 0) - before
+
+    warm = list()
+    for _ in range(args.clients):
+        get('/groups/rights-1000/members', warm)
+
+    print('{} concurrent requests for 1000 members : {} LDAP searches '
+          '(the group and its pages of members)'.format(args.clients,
+                                                        searches))
+    print('cold median {:.1f} ms, cached median {:.1f} ms'.format(
+        statistics.median(cold) * 1000, statistics.median(warm) * 1000))
+    print('stats : {}'.format(service.stats()))
+
+    server.shutdown()
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Measure rights snapshots and their diff
+
+First n2sn_snapshot_rights is run twice against the mock directory,
+with users added to and removed from a rights group in between, and
+n2sn_diff_rights must report exactly those changes, leaving out a right
+whose group does not exist. Then snapshots of a
+facility of --instruments instruments are generated, sized against the
+CSV listing of the same rights, and diffed after --churn of the
+memberships changed.
+
+    python benchmarks/bench_snapshot.py [--instruments 30] [--churn 0.01]
+"""
+import argparse
+import io
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+from bench_roster import run  # noqa: E402
+
+from N2SNUserTools import ldap, utils  # noqa: E402
+from N2SNUserTools.profiling import profiler  # noqa: E402
+from N2SNUserTools.snapshot import (read_snapshot, write_snapshot,  # noqa
+                                    diff_snapshots)
+
+RIGHTS = ('user', 'admin', 'staff')
+
+
+def mock_run(tmp):
+    directory = mockad.make_directory(2000, [10, 100, 1000], 2)
+    ldap.ADObjects = utils.ADObjects = mockad.mock_adobjects(directory)
+
+    mockad.write_config(tmp, {
+        'tst': {'user': 'rights-1000', 'admin': 'rights-10',
+                'staff': 'no-such-group'},
+        'abc': {'user': 'rights-1000', 'admin': 'rights-100'}})
+
+    old, new = (os.path.join(tmp, name) for name in ('old.gz', 'new.gz'))
+    profiler.enable()
+    searches = profiler.counters.get('ldap.searchRequest', 0)
+    run('n2sn_snapshot_rights', [old])
+    print('Mock directory: {} searches, {} byte snapshot of {} members'
+          .format(profiler.counters['ldap.searchRequest'] - searches,
+                  os.path.getsize(old),
+                  sum(len(g) for g in read_snapshot(open(old, 'rb'))
+                      ['groups'].values())))
+
+    with ldap.ADObjects() as ad:
+        dn = ad.get_group_by_samaccountname('rights-100')[0][
+            'distinguishedName']
+        members = sorted(ad.iter_direct_member_ids(dn),
+                         key=lambda m: m['sAMAccountName'])[:3]
+        ad.remove_users_from_group_by_dn(
+            dn, [m['distinguishedName'] for m in members])
+        ad.add_users_to_group_by_dn(dn, [directory.users[1990]])
+    removed = [m['sAMAccountName'] for m in members]
+
+    run('n2sn_snapshot_rights', [new])
+    out = run('n2sn_diff_rights', [old, new, '-f', 'csv'])
+    expected = ['ABC,ADMIN,removed,{}'.format(u) for u in removed] + \
+        ['ABC,ADMIN,added,user001990']
+    if sorted(out.splitlines()[1:]) != sorted(expected):
+        raise RuntimeError("Unexpected diff:\n" + out)
+    print('Diff after 4 changes to one group: correct')
+    if read_snapshot(open(new, 'rb'))['missing'] != {'no-such-group'}:
+        raise RuntimeError("The group not found was not recorded")
+    print('Group not found: recorded, left out of the diff')
+
+
+def login(rnd):
+    return ''.join(rnd.choice(string.ascii_lowercase)
+                   for _ in range(rnd.randint(3, 8))) + \
+        str(rnd.randint(0, 99) if rnd.random() < 0.3 else '')
+
+
+def facility(rnd, instruments, people):
+    pool = sorted(set(login(rnd) for _ in range(people)))
+    snapshot = {'time': '2026-10-19T02:00:00+00:00', 'rights': dict(),
+                'groups': dict()}
+    for n in range(instruments):
+        name = 'bl{:02d}'.format(n)
+        for right, size in zip(RIGHTS, (rnd.randint(50, 2000),
+                                        rnd.randint(5, 30), 200)):
+            # Every instrument grants the same staff group
+            group = 'nsls2-staff' if right == 'staff' else \
+                'n2sn-{}-{}'.format(name, right)
+            snapshot['rights'][(name, right)] = group
+            snapshot['groups'].setdefault(
+                group, sorted(rnd.sample(pool, size)))
+    return snapshot, pool
+
+
+def churn(rnd, snapshot, pool, fraction):
+    new = {'time': '2026-10-20T02:00:00+00:00',
+           'rights': dict(snapshot['rights']), 'groups': dict()}
+    for group, members in snapshot['groups'].items():
+        members = set(members)
+        n = max(1, int(len(members) * fraction))
+        removed = rnd.sample(sorted(members), n)
+        added = rnd.sample(pool, n)
+        new['groups'][group] = sorted((members - set(removed)) | set(added))
+    return new
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instruments', type=int, default=30)
+    parser.add_argument('--people', type=int, default=20000)
+    parser.add_argument('--churn', type=float, default=0.01)
+    args = parser.parse_args()
+
+    mock_run(tempfile.mkdtemp(prefix='n2sn-bench-'))
+
+    rnd = random.Random(0)
+    old, pool = facility(rnd, args.instruments, args.people)
+    new = churn(rnd, old, pool, args.churn)
+
+    listing = sum(len('{},{},{}\n'.format(name, right, user))
+                  for (name, right), group in old['rights'].items()
+                  for user in old['groups'][group])
+    files = list()
+    for snapshot in (old, new):
+        f = io.BytesIO()
+        write_snapshot(snapshot, f)
+        files.append(f.getvalue())
+    print('\n{} instruments, {} rights, {} memberships'.format(
+        args.instruments, len(old['rights']), sum(
+            len(old['groups'][g]) for g in old['rights'].values())))
+    print('CSV listing {} bytes, snapshot {} bytes'.format(
+        listing, len(files[0])))
+
+    start = time.perf_counter()
+    snapshots = [read_snapshot(io.BytesIO(f)) for f in files]
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    changes = diff_snapshots(*snapshots)
+    diff = time.perf_counter() - start
+    print('Read both {:.1f} ms, diff {:.1f} ms, {} changes'.format(
+        read * 1000, diff * 1000, len(changes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Time N2SNUserTools against a mock Active Directory
+
+Runs the directory queries, table output and add/remove flows against
+the synthetic directory from mockad.py with a stub adquery, and writes
+the timings as JSON so runs on different commits can be compared.
+
+    python benchmarks/bench_suite.py [--sizes 10,100,1000] [--depth 2]
+        [--output FILE] [--compare FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import ldap3
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools import utils  # noqa: E402
+
+
+def timeit(func, repeat):
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'median_s': statistics.median(times), 'min_s': min(times),
+            'runs': repeat}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def benchmarks(directory, sizes, table_sizes):
+    """Yield (name, function) pairs to time"""
+    ADObjects = mockad.mock_adobjects(directory)
+    # The utils functions make their own connections
+    utils.ADObjects = ADObjects
+
+    def with_ad(func):
+        def run():
+            with ADObjects() as ad:
+                func(ad)
+        return run
+
+    for size in sizes:
+        group = 'rights-{}'.format(size)
+        yield ('get_group_members[{}]'.format(size),
+               with_ad(lambda ad, g=group: ad.get_group_members(g)))
+
+    for size in table_sizes:
+        group = 'rights-{}'.format(size)
+        yield ('n2sn_list_group_users_as_table[{}]'.format(size),
+               lambda g=group: utils.n2sn_list_group_users_as_table(
+                   None, mockad.BASE, mockad.USER_BASE, None,
+                   {'user': g}).get_string())
+
+        with ADObjects() as ad:
+            users = ad.get_group_members_dict(group)
+        yield ('format_user_table[{}]'.format(size),
+               lambda u=users: utils.format_user_table(u).get_string())
+
+    yield ('n2sn_list_user_search_as_table',
+           lambda: utils.n2sn_list_user_search_as_table(
+               None, mockad.BASE, mockad.USER_BASE, None, 'Ann', 'LT',
+               None).get_string())
+
+    def add_remove(group, login):
+        def run(ad):
+            group_dn = ad.get_group_by_samaccountname(
+                group)[0]['distinguishedName']
+            user_dn = ad.get_user_by_samaccountname(
+                login)[0]['distinguishedName']
+            ad.add_user_to_group_by_dn(group_dn, user_dn)
+            ad.remove_user_from_group_by_dn(group_dn, user_dn)
+        return run
+
+    for size in sizes:
+        group = 'rights-{}'.format(size)
+        login = 'user{:06d}'.format(len(directory.users) - 1)
+        yield ('add_remove_user[{}]'.format(size),
+               with_ad(add_remove(group, login)))
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        old = json.load(f)['results']
+    print('\n{:<40} {:>10} {:>10} {:>8}'.format(
+        'benchmark', 'old (ms)', 'new (ms)', 'ratio'))
+    for name, new in results.items():
+        if name in old:
+            a, b = old[name]['median_s'], new['median_s']
+            print('{:<40} {:>10.2f} {:>10.2f} {:>8.2f}'.format(
+                name, a * 1000, b * 1000, b / a if a else float('nan')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000,
+                        help='Users in the directory (default: 2000)')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='Comma separated rights group sizes')
+    parser.add_argument('--table-sizes', default='10,100',
+                        help='Group sizes to list as tables (these run '
+                             'adquery for every member)')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='Nesting depth of the rights groups')
+    parser.add_argument('--extra-groups', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None,
+                        help='Write results to this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='Compare with results in this JSON file')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    table_sizes = [int(s) for s in args.table_sizes.split(',') if s]
+
+    start = time.perf_counter()
+    directory = mockad.make_directory(args.users, sizes, args.depth,
+                                      args.extra_groups)
+    print('Built directory with {} users in {:.2f} s'.format(
+        len(directory.users), time.perf_counter() - start))
+    mockad.stub_adquery()
+
+    results = dict()
+    for name, func in benchmarks(directory, sizes, table_sizes):
+        results[name] = timeit(func, args.repeat)
+        print('{:<40} {:>10.2f} ms'.format(
+            name, results[name]['median_s'] * 1000))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {'commit': git_commit(),
+                         'python': platform.python_version(),
+                         'ldap3': ldap3.__version__,
+                         'users': len(directory.users),
+                         'sizes': sizes, 'depth': args.depth,
+                         'extra_groups': args.extra_groups},
+                'results': results}, f, indent=2)
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
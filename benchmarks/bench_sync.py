@@ -0,0 +1,99 @@
+"""Time n2sn_sync_rights for changes of growing size to a large group
+
+The desired state is the current direct membership of a large rights
+group with --changes users swapped for others. n2sn_sync_rights is run
+with --dry-run and then for real against the mock directory, counting
+the LDAP requests and bytes of each step. Reading the membership is a
+fixed cost of a few paged searches of identifiers only; lookups and
+modifies grow with the size of the change. Each search and modify waits
+a simulated round trip time. As in bench_roster.py, the mock's time to
+answer the OR filter of a lookup grows with the number of users in the
+directory, which a domain controller's indexes avoid.
+
+    python benchmarks/bench_sync.py [--members 2000] [--changes 0,10,100]
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+from bench_roster import run  # noqa: E402
+
+from N2SNUserTools import ldap, utils  # noqa: E402
+from N2SNUserTools.profiling import profiler  # noqa: E402
+
+
+def counts():
+    return (profiler.counters.get('ldap.searchRequest', 0),
+            profiler.counters.get('ldap.modifyRequest', 0))
+
+
+def seconds(*names):
+    return sum(s.duration for s in profiler.spans if s.name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--changes', default='0,10,100',
+                        help='Comma separated numbers of users to swap')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Simulated round trip time in seconds')
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(args.members * 2, [args.members], 1)
+    ADObjects = mockad.latency_adobjects(directory, args.latency)
+    ldap.ADObjects = utils.ADObjects = ADObjects
+    group = 'rights-{}'.format(args.members)
+    tmp = tempfile.mkdtemp(prefix='n2sn-bench-')
+    mockad.write_config(tmp, {'tst': {'user': group}})
+
+    with ldap.ADObjects() as ad:
+        dn = ad.get_group_by_samaccountname(group)[0]['distinguishedName']
+        members = sorted(m['sAMAccountName']
+                         for m in ad.iter_direct_member_ids(dn))
+    others = sorted(set('user{:06d}'.format(n)
+                        for n in range(args.members * 2)) - set(members))
+
+    profiler.enable()
+    print('{} members, {:.1f} ms simulated latency'.format(
+        len(members), args.latency * 1000))
+    print('{:>8} {:<8} {:>9} {:>9} {:>10} {:>9} {:>9}'.format(
+        'changes', 'step', 'searches', 'modifies', 'bytes', 'lookup s',
+        'change s'))
+
+    for changes in [int(n) for n in args.changes.split(',')]:
+        state = members[changes:] + others[:changes]
+        roster = os.path.join(tmp, 'state-{}.txt'.format(changes))
+        with open(roster, 'w') as f:
+            f.write('\n'.join(state) + '\n')
+
+        for step, extra in (('dry-run', ['--dry-run']), ('sync', [])):
+            searches, modifies = counts()
+            profiler.spans = list()
+            run('n2sn_sync_rights', ['-i', 'tst', '-f', 'csv',
+                                     'user=' + roster] + extra)
+            print('{:>8} {:<8} {:>9} {:>9} {:>10} {:>9.2f} {:>9.2f}'.format(
+                2 * changes, step, counts()[0] - searches,
+                counts()[1] - modifies,
+                sum(s.values.get('bytes', 0) for s in profiler.spans),
+                seconds('ldap.search'),
+                seconds('sync.apply')))
+
+        # Syncing again must find nothing to change
+        modifies = counts()[1]
+        out = run('n2sn_sync_rights', ['-i', 'tst', '-f', 'csv',
+                                       'user=' + roster])
+        if out.count('\n') != 1 or counts()[1] != modifies:
+            raise RuntimeError("A second sync made changes")
+
+        # Put the group back for the next run
+        with open(roster, 'w') as f:
+            f.write('\n'.join(members) + '\n')
+        run('n2sn_sync_rights', ['-i', 'tst', 'user=' + roster])
+
+
+if __name__ == '__main__':
+    main()
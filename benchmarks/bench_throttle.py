@@ -0,0 +1,131 @@
+"""Check that bulk writes back off from an overloaded server
+
+The stand-in server answers one request at a time and answers busy,
+without making the change, to a modify arriving while more than
+--queue requests wait. For the middle third of each run other load
+makes its requests take --loaded seconds instead of --service. --changes
+single user modifies are made with:
+
+* a fixed window of 32 which never backs off or retries, as a client
+  without a throttle would
+* the adaptive Throttle, starting from the same window
+* the adaptive Throttle limited to --rate changes a second
+* the adaptive Throttle on a SYNC connection, while for the middle third
+  other clients keep the server's queue full
+
+Each run must end with every change made by the adaptive throttle, and
+reports the busy replies, retries and window cuts it took. On the SYNC
+connection each busy reply must cut the window, as a request is only
+sent once the reply to the one before has been seen.
+
+    python benchmarks/bench_throttle.py [--changes 600] [--queue 8]
+"""
+import argparse
+import os
+import sys
+import time
+
+from ldap3 import ASYNC, SYNC, MODIFY_ADD, MODIFY_DELETE
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools.profiling import profiler  # noqa: E402
+from N2SNUserTools.throttle import Throttle  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--changes', type=int, default=600)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Simulated round trip time in seconds')
+    parser.add_argument('--service', type=float, default=0.002,
+                        help='Simulated server time per request')
+    parser.add_argument('--loaded', type=float, default=0.008,
+                        help='Server time per request while loaded')
+    parser.add_argument('--queue', type=int, default=8,
+                        help='Requests waiting before the server is busy')
+    parser.add_argument('--rate', type=float, default=200)
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(args.changes, [], 1)
+    groups = [directory.add_group('rights-{}'.format(n), [])
+              for n in range(args.groups)]
+    changes = [(groups[n % args.groups], directory.users[n])
+               for n in range(args.changes)]
+
+    # The server is loaded for the middle third of the time the first,
+    # unloaded, run takes
+    clock = {'start': 0, 'third': None}
+
+    def loaded():
+        if clock['third'] is None:
+            return False
+        elapsed = time.perf_counter() - clock['start']
+        return clock['third'] <= elapsed < 2 * clock['third']
+
+    def service():
+        return args.loaded if loaded() else args.service
+
+    def backlog():
+        # Other clients' requests, past the busy limit
+        return 2 * args.queue * args.loaded if loaded() else 0
+
+    ADObjects = mockad.latency_adobjects(directory, args.latency, service,
+                                         args.queue)
+    SyncADObjects = mockad.latency_adobjects(
+        directory, args.latency, service, args.queue, backlog)
+    with ADObjects(client_strategy=ASYNC, write_window=32) as ad:
+        start = time.perf_counter()
+        list(ad.change_group_members([(g, u, MODIFY_ADD)
+                                      for g, u in changes]))
+        list(ad.change_group_members([(g, u, MODIFY_DELETE)
+                                      for g, u in changes]))
+        clock['third'] = (time.perf_counter() - start) / 2 / 3
+
+    profiler.enable()
+    print('{} modifies, {:.0f} ms round trip, {:.0f} ms server time, {:.0f}'
+          ' ms while loaded, busy past {} waiting'.format(
+              args.changes, args.latency * 1000, args.service * 1000,
+              args.loaded * 1000, args.queue))
+    print('{:<24} {:>8} {:>7} {:>7} {:>7} {:>7} {:>7}'.format(
+        '', 'seconds', 'failed', 'busy', 'retries', 'cuts', 'window'))
+
+    throttles = (
+        ('fixed window 32', ADObjects,
+         lambda: Throttle(32, min_window=32, retries=0, slow=1e9)),
+        ('adaptive', ADObjects, lambda: Throttle(32)),
+        ('adaptive, {:.0f}/s'.format(args.rate), ADObjects,
+         lambda: Throttle(32, args.rate)),
+        ('adaptive, SYNC', SyncADObjects, lambda: Throttle(32)))
+    for name, factory, throttle in throttles:
+        strategy = SYNC if factory is SyncADObjects else ASYNC
+        for operation in (MODIFY_ADD, MODIFY_DELETE):
+            profiler.reset()
+            with factory(client_strategy=strategy,
+                         throttle=throttle()) as ad:
+                clock['start'] = start = time.perf_counter()
+                errors = list(ad.change_group_members(
+                    [(g, u, operation) for g, u in changes]))
+                elapsed = time.perf_counter() - start
+            failed = sum(1 for e in errors if e is not None)
+            print('{:<24} {:>8.2f} {:>7} {:>7} {:>7} {:>7} {:>7}'.format(
+                name + (' add' if operation == MODIFY_ADD else ' remove'),
+                elapsed, failed,
+                failed + profiler.counters.get('throttle.retry', 0),
+                profiler.counters.get('throttle.retry', 0),
+                profiler.counters.get('throttle.cut', 0),
+                ad.throttle.window))
+            if failed and name != 'fixed window 32':
+                raise RuntimeError("The throttle gave up on {} changes"
+                                   .format(failed))
+            if strategy == SYNC and profiler.counters.get(
+                    'throttle.retry', 0) > profiler.counters.get(
+                        'throttle.cut', 0):
+                raise RuntimeError("A write was sent before the busy "
+                                   "reply to the one before was seen")
+
+
+if __name__ == '__main__':
+    main()
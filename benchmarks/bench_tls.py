@@ -0,0 +1,202 @@
+"""Time connecting to a local TLS LDAP stand-in
+
+The stand-in answers binds and searches with success and no entries,
+behind a proxy delaying traffic by --latency seconds each round trip. A
+self-signed certificate is made with the openssl command. --connections
+anonymous ADObjects are opened and closed one after another:
+
+* with ldap3's Tls for each, as ADObjects did, making an SSL context
+  and doing a full handshake every time
+* with shared_tls(), which makes one context per CA file and resumes
+  the TLS session of the last connection
+
+The median time to connect and bind, and the full and resumed
+handshakes, are reported.
+
+    python benchmarks/bench_tls.py [--connections 50] [--latency 0.005]
+"""
+import argparse
+import os
+import queue
+import socket
+import socketserver
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ldap3 import Server, Tls
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from N2SNUserTools.ldap import ADObjects  # noqa: E402
+from N2SNUserTools.profiling import profiler  # noqa: E402
+from N2SNUserTools.tls import shared_tls  # noqa: E402
+
+# resultCode success, empty matchedDN and diagnosticMessage
+SUCCESS = b'\x0a\x01\x00\x04\x00\x04\x00'
+# Request tag -> response tag
+RESPONSES = {0x60: 0x61,   # bind
+             0x63: 0x65,   # search, answered by searchResDone
+             0x77: 0x78}   # extended
+UNBIND = 0x42
+
+
+def make_certificate(path):
+    cert = os.path.join(path, 'cert.pem')
+    key = os.path.join(path, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-keyout', key, '-out', cert, '-days', '1',
+                    '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost'],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def read_message(sock):
+    """Read an LDAPMessage, returning its message ID and request tag"""
+    tag, length = recv_exact(sock, 2)
+    if length & 0x80:
+        length = int.from_bytes(recv_exact(sock, length & 0x7f), 'big')
+    body = recv_exact(sock, length)
+    id_length = body[1]
+    return int.from_bytes(body[2:2 + id_length], 'big'), body[2 + id_length]
+
+
+def message(message_id, tag, content):
+    mid = message_id.to_bytes(message_id.bit_length() // 8 + 1, 'big')
+    inner = bytes([0x02, len(mid)]) + mid + bytes([tag, len(content)]) + \
+        content
+    return bytes([0x30, len(inner)]) + inner
+
+
+def ldap_stand_in(cert, key):
+    """Start the stand-in, returning its port"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            try:
+                sock = context.wrap_socket(self.request, server_side=True)
+            except (ssl.SSLError, OSError):
+                return
+            try:
+                while True:
+                    message_id, tag = read_message(sock)
+                    if tag == UNBIND:
+                        break
+                    sock.sendall(message(message_id, RESPONSES[tag],
+                                         SUCCESS))
+            except (EOFError, OSError):
+                pass
+            finally:
+                sock.close()
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def latency_proxy(port, latency):
+    """Start a proxy to port delaying each direction by latency / 2"""
+    def pump(source, target):
+        due = queue.Queue()
+
+        def send():
+            while True:
+                at, data = due.get()
+                delay = at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if not data:
+                    target.close()
+                    return
+                try:
+                    target.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=send, daemon=True).start()
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            due.put((time.perf_counter() + latency / 2, data))
+            if not data:
+                return
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            upstream = socket.create_connection(('127.0.0.1', port))
+            for sock in (self.request, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=pump, args=(upstream, self.request),
+                             daemon=True).start()
+            pump(self.request, upstream)
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Simulated round trip time in seconds')
+    args = parser.parse_args()
+
+    cert, key = make_certificate(tempfile.mkdtemp(prefix='n2sn-bench-'))
+    port = latency_proxy(ldap_stand_in(cert, key), args.latency)
+    url = 'localhost:{}'.format(port)
+
+    def per_connection_tls():
+        return ADObjects(Server(url, use_ssl=True, tls=Tls(
+            ca_certs_file=cert, validate=ssl.CERT_REQUIRED,
+            version=ssl.PROTOCOL_TLSv1_2)), cache_size=0)
+
+    def shared():
+        return ADObjects(url, ca_certs_file=cert, cache_size=0)
+
+    profiler.enable()
+    print('{} connections, {:.1f} ms round trip'.format(
+        args.connections, args.latency * 1000))
+    print('{:<22} {:>10} {:>10} {:>6} {:>8}'.format(
+        '', 'median ms', 'first ms', 'full', 'resumed'))
+    for name, make in (('Tls per connection', per_connection_tls),
+                       ('shared_tls()', shared)):
+        profiler.reset()
+        times = list()
+        for _ in range(args.connections):
+            start = time.perf_counter()
+            with make():
+                times.append(time.perf_counter() - start)
+        print('{:<22} {:>10.2f} {:>10.2f} {:>6} {:>8}'.format(
+            name, statistics.median(times) * 1000, times[0] * 1000,
+            profiler.counters.get('tls.full', args.connections),
+            profiler.counters.get('tls.resumed', 0)))
+
+    # The context is made once per CA file
+    if shared_tls(cert) is not shared().server.tls:
+        raise RuntimeError("The TLS context is not shared")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Check that AsyncADObjects offers every ADObjects method, awaitably
+
+Every public method of ADObjects is called on an ADObjects and on an
+AsyncADObjects, each for its own copy of the mock directory. The async
+method must be a coroutine or an asynchronous iterator and give the same
+answer, and the groups of the two directories must end the same. A
+method with no call in make_calls(), as one added to ADObjects later,
+fails the check.
+
+    python benchmarks/check_async.py
+"""
+import asyncio
+import inspect
+import os
+import sys
+
+from ldap3 import ASYNC, MODIFY_ADD, MODIFY_DELETE
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+from N2SNUserTools.aio import AsyncADObjects  # noqa: E402
+from N2SNUserTools.controls import permissive_modify_control  # noqa: E402
+from N2SNUserTools.ldap import ADObjects  # noqa: E402
+
+# Not offered by AsyncADObjects
+EXCLUDED = {'shared'}
+
+
+def make_calls(directory):
+    """Get the arguments of each method, in the order to call them"""
+    users = directory.users
+    group = directory.groups['rights-10']
+    empty = directory.groups['empty']
+    member = next(dn for dn in users if directory.server.dit[dn]['memberOf'])
+    return [
+        ('get_user_by_id', ('100003',)),
+        ('get_user_by_samaccountname', ('user000004',)),
+        ('get_user_by_dn', (users[5],)),
+        ('iter_users_by_attribute',
+         ('sAMAccountName', ['user000001', 'user000002', 'nobody'], 2)),
+        ('get_user_by_surname_and_givenname', (None, 'Ann', 'LT')),
+        ('get_user_by_surname_and_givenname_dict', (None, 'Bob', None)),
+        ('iter_user_by_surname_and_givenname', (None, 'Cat', None)),
+        ('get_user_by_surname_and_givenname_page',
+         (None, None, None, None, 5, 10)),
+        ('get_group_by_samaccountname', ('rights-10',)),
+        ('get_groups_by_samaccountname', (['rights-10', 'empty', 'x'],)),
+        ('get_groups_by_member_dn', (member,)),
+        ('iter_group_members', ('rights-10',)),
+        ('get_group_members', ('rights-10',)),
+        ('get_group_members_dict', ('rights-10',)),
+        ('iter_direct_members', (group,)),
+        ('get_direct_memberships', (users, [group, empty], 20)),
+        ('iter_direct_member_ids', (group,)),
+        ('iter_group_member_ids', ('rights-10',)),
+        ('add_user_to_group_by_dn', (empty, users[0])),
+        ('remove_user_from_group_by_dn', (empty, users[0])),
+        ('add_users_to_group_by_dn', (empty, users[:5])),
+        ('remove_users_from_group_by_dn', (empty, users[:3])),
+        ('change_group_members',
+         ([(empty, users[10], MODIFY_ADD), (empty, users[:2],
+                                            MODIFY_DELETE),
+           (empty, [users[11], users[12]], MODIFY_ADD)],)),
+        ('iter_modify',
+         ([(empty, {'member': [(MODIFY_DELETE, [users[12]])]},
+            [permissive_modify_control()])],)),
+        ('close', ()),
+        ('open', ()),
+    ]
+
+
+def answer(value):
+    """Make an answer comparable, LDAP errors by their description"""
+    if isinstance(value, list):
+        return [answer(v) for v in value]
+    if isinstance(value, Exception):
+        return type(value).__name__
+    return value
+
+
+async def call_async(ad, name, args):
+    value = getattr(ad, name)(*args)
+    if inspect.isasyncgen(value):
+        return [v async for v in value]
+    if inspect.iscoroutine(value):
+        return await value
+    raise RuntimeError("AsyncADObjects.{} is not awaitable".format(name))
+
+
+def call_sync(ad, name, args):
+    value = getattr(ad, name)(*args)
+    if inspect.isgenerator(value):
+        return list(value)
+    return value
+
+
+def members(directory):
+    return {name: sorted(m.lower() for m in
+                         directory.server.dit[dn].get('member', []))
+            for name, dn in directory.groups.items()}
+
+
+def main():
+    directory = mockad.make_directory(200, [10, 50], 2)
+    async_directory = mockad.make_directory(200, [10, 50], 2)
+    calls = make_calls(directory)
+
+    public = set(name for name, value in vars(ADObjects).items()
+                 if not name.startswith('_') and
+                 inspect.isfunction(value)) - EXCLUDED
+    missing = public - set(name for name, _ in calls)
+    if missing:
+        raise RuntimeError("No check for {}".format(', '.join(
+            sorted(missing))))
+
+    SyncAD = mockad.mock_adobjects(directory)
+
+    class MockAsyncADObjects(AsyncADObjects):
+        _ADOBJECTS = mockad.mock_adobjects(async_directory)
+
+    async def run():
+        ad = SyncAD(cache_size=0)
+        ad.open()
+        async with MockAsyncADObjects(None, mockad.BASE, mockad.USER_BASE,
+                                      client_strategy=ASYNC) as aad:
+            for name, args in calls:
+                expected = answer(call_sync(ad, name, args))
+                found = answer(await call_async(aad, name, args))
+                if found != expected:
+                    raise RuntimeError("{} answered {!r}, not {!r}".format(
+                        name, found, expected))
+                if members(async_directory) != members(directory):
+                    raise RuntimeError("{} left other members".format(name))
+                print('{:<42} ok'.format(name))
+        ad.close()
+
+    asyncio.run(run())
+    print('{} methods checked'.format(len(calls)))
+
+
+if __name__ == '__main__':
+    main()
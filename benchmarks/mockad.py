@@ -0,0 +1,403 @@
+"""A synthetic Active Directory served by ldap3's MOCK_SYNC strategy
+
+make_directory() builds users and rights groups of the requested sizes,
+each group nested to the requested depth, in an offline ldap3 Server.
+mock_adobjects() returns an ADObjects subclass which connects to that
+server instead of a domain controller. Asking it for the SAFE_SYNC
+strategy gives a mock connection returning copies of each result as
+SAFE_SYNC does, and asking for ASYNC gives one with MOCK_ASYNC, which
+answers each request as it is sent. The mock can not evaluate
+extensible matches, so LDAP_MATCHING_RULE_IN_CHAIN
+(1.2.840.113556.1.4.1941) on memberOf is rewritten to an OR of direct
+memberOf terms over the group and the groups nested in it, and on member
+to an OR of the groups holding the member directly or through nesting.
+
+latency_adobjects() returns an ADObjects subclass whose replies take a
+simulated round trip and server time.
+
+write_config() writes a config file of instruments for the directory,
+and stub_adquery() an executable standing in for /usr/bin/adquery.
+"""
+import os
+import random
+import re
+import stat
+import string
+import tempfile
+import time
+
+from ldap3 import Server, Connection, MOCK_SYNC, MOCK_ASYNC, SAFE_SYNC, \
+    ASYNC, OFFLINE_AD_2012_R2, MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE
+
+from N2SNUserTools.controls import PERMISSIVE_MODIFY_OID
+from N2SNUserTools.ldap import ADObjects
+from N2SNUserTools import unix
+
+IN_CHAIN = re.compile(r'\(memberOf:1\.2\.840\.113556\.1\.4\.1941:=([^)]*)\)',
+                      re.IGNORECASE)
+MEMBER_IN_CHAIN = re.compile(
+    r'\(member:1\.2\.840\.113556\.1\.4\.1941:=([^)]*)\)', re.IGNORECASE)
+
+USER_TYPES = ['LT', 'PS', 'NC', 'XX']
+
+BASE = 'DC=bnl,DC=test'
+USER_BASE = 'OU=Users,' + BASE
+GROUP_BASE = 'OU=Groups,' + BASE
+
+
+class MockDirectory(object):
+    def __init__(self):
+        self.server = Server('mock-dc', get_info=OFFLINE_AD_2012_R2)
+        self.connection = Connection(self.server, client_strategy=MOCK_SYNC)
+        self.users = list()
+        self.groups = dict()
+        # lower case group DN -> DNs of the group and groups nested in it
+        self.nested = dict()
+
+    def add_user(self, n, rnd):
+        login = 'user{:06d}'.format(n)
+        dn = 'CN={},{}'.format(login, USER_BASE)
+        self.connection.strategy.add_entry(dn, {
+            'objectClass': ['top', 'person', 'organizationalPerson',
+                            'user'],
+            'objectCategory': 'person',
+            'distinguishedName': dn,
+            'sAMAccountName': login,
+            'userPrincipalName': login + '@bnl.test',
+            'sn': ''.join(rnd.choice(string.ascii_lowercase)
+                          for _ in range(6)).title(),
+            'givenName': rnd.choice(['Ann', 'Bob', 'Cat', 'Dan', 'Eve']),
+            'displayName': 'User {:06d}'.format(n),
+            'mail': login + '@bnl.test',
+            'employeeID': str(100000 + n),
+            'description': rnd.choice(USER_TYPES),
+            'pwdLastSet': str(132000000000000000 + n),
+            'userAccountControl': '512',
+            'lockoutTime': '0',
+            'memberOf': [],
+        })
+        self.users.append(dn)
+        return dn
+
+    def add_group(self, name, members):
+        dn = 'CN={},{}'.format(name, GROUP_BASE)
+        self.connection.strategy.add_entry(dn, {
+            'objectClass': ['top', 'group'],
+            'objectCategory': 'group',
+            'distinguishedName': dn,
+            'sAMAccountName': name,
+            'member': list(members),
+        })
+        for member in members:
+            entry = self.server.dit.get(member)
+            if entry is not None and 'memberOf' in entry:
+                entry['memberOf'].append(dn.encode())
+        self.groups[name] = dn
+        return dn
+
+    def update_member_of(self, group_dn, changes):
+        """Keep memberOf in step with a modify of a group's member
+
+        The mock does not maintain back links as a domain controller
+        does.
+        """
+        for operation, values in _changes(changes.get('member', [])):
+            for member in values:
+                entry = self.server.dit.get(member)
+                if entry is None or 'memberOf' not in entry:
+                    continue
+                member_of = [g for g in entry['memberOf']
+                             if g.decode().lower() != group_dn.lower()]
+                if operation == MODIFY_ADD:
+                    member_of.append(group_dn.encode())
+                entry['memberOf'] = member_of
+
+    def permissive_changes(self, dn, changes):
+        """Emulate Permissive Modify of member, which the mock lacks
+
+        The change becomes a replace of member by the values it should
+        end with, so adding a member or removing a non member succeeds.
+        """
+        if 'member' not in changes:
+            return changes
+        entry = self.server.dit.get(dn) or {}
+        members = [m.decode() if isinstance(m, bytes) else m
+                   for m in entry.get('member', [])]
+        for operation, values in _changes(changes['member']):
+            lower = [m.lower() for m in members]
+            if operation == MODIFY_ADD:
+                members += [v for v in values if v.lower() not in lower]
+            elif operation == MODIFY_DELETE:
+                values = set(v.lower() for v in values)
+                members = [m for m in members if m.lower() not in values]
+        return {**changes, 'member': [(MODIFY_REPLACE, members)]}
+
+    def add_nested_group(self, name, users, depth):
+        """Add a group whose users are split over depth nested groups"""
+        chunks = [users[i::depth] for i in range(depth)]
+        inner = None
+        chain = list()
+        for level in reversed(range(depth)):
+            members = list(chunks[level])
+            if inner is not None:
+                members.append(inner)
+            group = name if level == 0 else '{}-l{}'.format(name, level)
+            inner = self.add_group(group, members)
+            chain.append(inner)
+            self.nested[inner.lower()] = list(chain)
+        return inner
+
+    def rewrite_filter(self, search_filter):
+        """Replace in chain memberOf matches with direct memberOf terms"""
+        def direct(match):
+            groups = self.nested.get(match.group(1).lower(),
+                                     [match.group(1)])
+            return '(|' + ''.join('(memberOf={})'.format(g)
+                                  for g in groups) + ')'
+
+        def containing(match):
+            dn = match.group(1).lower()
+            entry = self.server.dit.get(match.group(1)) or {}
+            groups = set(g.decode().lower() if isinstance(g, bytes)
+                         else g.lower() for g in entry.get('memberOf', []))
+            groups |= set(outer for outer, chain in self.nested.items()
+                          if (groups & set(c.lower() for c in chain)) or
+                          (outer != dn and dn in [c.lower() for c in chain]))
+            if not groups:
+                return '(!(objectClass=*))'
+            return '(|' + ''.join('(distinguishedName={})'.format(g)
+                                  for g in sorted(groups)) + ')'
+        search_filter = MEMBER_IN_CHAIN.sub(containing, search_filter)
+        return IN_CHAIN.sub(direct, search_filter)
+
+
+def _changes(change):
+    """Get (operation, values) pairs from a change of a modify"""
+    if change and not isinstance(change[0], (list, tuple)):
+        change = [change]
+    return [(operation, values if isinstance(values, (list, tuple))
+             else [values]) for operation, values in change]
+
+
+def make_directory(users=1000, group_sizes=(10, 100, 1000), depth=1,
+                   extra_groups=0, seed=0):
+    """Make a mock directory
+
+    One rights group 'rights-<size>' is made for each size, its members
+    spread over depth nested groups. extra_groups unrelated groups are
+    added to make the group search base larger.
+    """
+    rnd = random.Random(seed)
+    directory = MockDirectory()
+    for n in range(max(users, max(group_sizes or [0]))):
+        directory.add_user(n, rnd)
+
+    for size in group_sizes:
+        directory.add_nested_group('rights-{}'.format(size),
+                                   rnd.sample(directory.users, size),
+                                   depth)
+    for n in range(extra_groups):
+        directory.add_group('other-{}'.format(n), [])
+
+    directory.add_group('empty', [])
+    return directory
+
+
+def mock_adobjects(directory):
+    """Return an ADObjects class connecting to the mock directory"""
+    class MockADObjects(ADObjects):
+        def __init__(self, server=None, group_search=BASE,
+                     user_search=USER_BASE, **kwargs):
+            strategy = kwargs.get('client_strategy')
+            self._thread_safe = strategy == SAFE_SYNC
+            kwargs['client_strategy'] = MOCK_ASYNC \
+                if strategy in (ASYNC, MOCK_ASYNC) else MOCK_SYNC
+            kwargs['authenticate'] = False
+            kwargs.pop('ca_certs_file', None)
+            # Record the mock's answers, not the rewritten filters
+            self._record = kwargs.pop('record', None)
+            super().__init__(directory.server, group_search, user_search,
+                             **kwargs)
+
+        def _connect(self, **kwargs):
+            # Every connection, including those made on reconnecting,
+            # answers from the directory
+            super()._connect(**kwargs)
+            self.connection.strategy.thread_safe = self._thread_safe
+
+            search = self.connection.search
+
+            def mock_search(search_base, search_filter, *args, **kwargs):
+                return search(search_base,
+                              directory.rewrite_filter(search_filter),
+                              *args, **kwargs)
+
+            self.connection.search = mock_search
+
+            modify = self.connection.modify
+
+            def mock_modify(dn, changes, controls=None):
+                request = changes
+                if any(str(c['controlType']) == PERMISSIVE_MODIFY_OID
+                       for c in controls or []):
+                    request = directory.permissive_changes(dn, changes)
+                status = modify(dn, request, controls=controls)
+                if isinstance(status, tuple):
+                    result = status[1]
+                elif not self.connection.strategy.sync:
+                    # MOCK_ASYNC answers as the request is sent
+                    result = self.connection.strategy._responses[status][1]
+                else:
+                    result = self.connection.result
+                if result['result'] == 0:
+                    directory.update_member_of(dn, changes)
+                return status
+
+            self.connection.modify = mock_modify
+
+        def __enter__(self):
+            super().__enter__()
+            if self._record is not None:
+                from N2SNUserTools.replay import RecordingConnection
+                self.connection = RecordingConnection(self.connection,
+                                                      self._record)
+            return self
+
+    return MockADObjects
+
+
+# The reply of a server too busy for a request
+BUSY = {'result': 51, 'description': 'busy', 'dn': '', 'message': '',
+        'referrals': None, 'type': 'modifyResponse'}
+
+
+def latency_adobjects(directory, latency, service=0, busy_queue=None,
+                      backlog=None):
+    """Get an ADObjects class for the mock directory whose replies
+    arrive after a simulated round trip time
+
+    The server is taken to answer one request at a time, each taking
+    service seconds (or service() seconds, if it is callable), so
+    requests pipelined on an asynchronous connection overlap their round
+    trips but not their service. A modify arriving with more than
+    busy_queue requests waiting is answered busy, and not made. backlog(),
+    if given, is the seconds of other clients' requests also waiting.
+    Each instance counts the searches and modifies it sent.
+    """
+    ADObjects = mock_adobjects(directory)
+
+    class LatencyADObjects(ADObjects):
+        searches = 0
+        modifies = 0
+
+        def _connect(self, **kwargs):
+            super()._connect(**kwargs)
+            connection = self.connection
+            server = {'free': 0.0, 'busy': -1}
+            due = dict()
+            busy = set()
+
+            def service_time():
+                return service() if callable(service) else service
+
+            def reply_time():
+                arrive = time.perf_counter() + latency / 2
+                start = max(arrive, server['free'])
+                server['free'] = start + service_time()
+                return server['free'] + latency / 2
+
+            def overloaded():
+                if busy_queue is None:
+                    return False
+                arrive = time.perf_counter() + latency / 2
+                waiting = server['free'] - arrive + \
+                    (backlog() if backlog is not None else 0)
+                return waiting > busy_queue * service_time()
+
+            def wait(until):
+                delay = until - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            def delayed(send, name):
+                def send_and_wait(*args, **kwargs):
+                    if name == 'modify':
+                        self.modifies += 1
+                    else:
+                        self.searches += 1
+                    if name == 'modify' and overloaded():
+                        until = time.perf_counter() + latency
+                        if connection.strategy.sync:
+                            wait(until)
+                            connection.result = dict(BUSY)
+                            return False
+                        server['busy'] -= 1
+                        busy.add(server['busy'])
+                        due[server['busy']] = until
+                        return server['busy']
+
+                    status = send(*args, **kwargs)
+                    if connection.strategy.sync:
+                        wait(reply_time())
+                    else:
+                        due[status] = reply_time()
+                    return status
+                return send_and_wait
+
+            def delayed_response(message_id, *args, **kwargs):
+                wait(due.pop(message_id, 0))
+                if message_id in busy:
+                    busy.discard(message_id)
+                    return [], dict(BUSY)
+                return get_response(message_id, *args, **kwargs)
+
+            connection.search = delayed(connection.search, 'search')
+            connection.modify = delayed(connection.modify, 'modify')
+            get_response = connection.get_response
+            connection.get_response = delayed_response
+
+    return LatencyADObjects
+
+
+def write_config(directory, instruments, instrument_groups=None):
+    """Write a config file for the mock directory and point the tools at
+    it
+
+    instruments maps instrument names to their rights, a dict of right
+    to group name, and instrument_groups names lists of them.
+    """
+    from N2SNUserTools import cli
+    cli.config_files = [os.path.join(directory, 'n2sn_tools.yml')]
+    with open(cli.config_files[0], 'w') as f:
+        f.write("common:\n  server: mock-dc\n"
+                "  group_search: '{}'\n  user_search: '{}'\n"
+                "instruments:\n".format(BASE, USER_BASE))
+        for name, rights in instruments.items():
+            f.write("  {0}:\n    name: {0}\n    rights:\n".format(name))
+            for right, group in rights.items():
+                f.write("      {}: {}\n".format(right, group))
+        if instrument_groups:
+            f.write("instrument_groups:\n")
+            for name, members in instrument_groups.items():
+                f.write("  {}: {}\n".format(name, ','.join(members)))
+
+
+_ADQUERY = """#!/bin/sh
+for login; do :; done
+echo "zoneEnabled:true"
+echo "unixname:$login"
+echo "uid:10000"
+echo "samAccountName:$login"
+"""
+
+
+def stub_adquery(path=None):
+    """Write a stand in for adquery and point N2SNUserTools at it"""
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='n2sn-bench-'),
+                            'adquery')
+    with open(path, 'w') as f:
+        f.write(_ADQUERY)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    unix.adquery_cmd = path
+    return path
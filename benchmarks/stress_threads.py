@@ -0,0 +1,87 @@
+"""Share one ADObjects between threads and check every result
+
+Threads look up random users and group members on a single bound
+instance of the mock directory and compare each answer with the one
+found beforehand. With the default SYNC strategy results are read from
+the shared connection after each search, so threads see each other's
+answers. With SAFE_SYNC each search returns its own copy and every
+answer must match.
+
+    python benchmarks/stress_threads.py [--threads 16] [--lookups 200]
+        [--strategy SAFE_SYNC|SYNC]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+from ldap3 import SYNC, SAFE_SYNC
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mockad  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--lookups', type=int, default=200,
+                        help='Lookups made by each thread')
+    parser.add_argument('--strategy', choices=['SAFE_SYNC', 'SYNC'],
+                        default='SAFE_SYNC')
+    args = parser.parse_args()
+
+    directory = mockad.make_directory(args.users, [10, 50], 2)
+    ADObjects = mockad.mock_adobjects(directory)
+    logins = ['user{:06d}'.format(n) for n in range(args.users)]
+    groups = ['rights-10', 'rights-50', 'empty']
+
+    with ADObjects() as ad:
+        users = {n: ad.get_user_by_samaccountname(n) for n in logins}
+        members = {g: ad.get_group_members(g) for g in groups}
+
+    strategy = SAFE_SYNC if args.strategy == 'SAFE_SYNC' else SYNC
+    # Switch threads often to widen any race
+    sys.setswitchinterval(1e-6)
+    errors = list()
+    barrier = threading.Barrier(args.threads)
+
+    def worker(ad, seed):
+        rnd = random.Random(seed)
+        barrier.wait()
+        for _ in range(args.lookups):
+            try:
+                if rnd.random() < 0.9:
+                    login = rnd.choice(logins)
+                    if ad.get_user_by_samaccountname(login) != users[login]:
+                        errors.append(login)
+                else:
+                    group = rnd.choice(groups)
+                    if ad.get_group_members(group) != members[group]:
+                        errors.append(group)
+            except Exception as e:
+                errors.append(repr(e))
+
+    # Without the search memo every lookup goes to the connection
+    with ADObjects(client_strategy=strategy, cache_size=0) as ad:
+        threads = [threading.Thread(target=worker, args=(ad, n))
+                   for n in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    total = args.threads * args.lookups
+    print('{}: {} threads, {} lookups in {:.2f} s, {} wrong'.format(
+        args.strategy, args.threads, total, elapsed, len(errors)))
+    if errors:
+        print('First wrong answers : {}'.format(errors[:5]))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from os import path
 from setuptools import setup, find_packages
+from setuptools.command.egg_info import egg_info
 import sys
 import versioneer
 
@@ -7,7 +8,7 @@ import versioneer
 # NOTE: This file must remain Python 2 compatible for the foreseeable future,
 # to ensure that we error out properly for people with outdated setuptools
 # and/or pip.
-min_version = (3, 6)
+min_version = (3, 7)
 if sys.version_info < min_version:
     error = """
 N2SNUserTools does not support Python {0}.{1}.
@@ -32,11 +33,30 @@ with open(path.join(here, 'requirements.txt')) as requirements_file:
     requirements = [line for line in requirements_file.read().splitlines()
                     if not line.startswith('#')]
 
+static_version_file = path.join(here, 'N2SNUserTools', '_static_version.py')
+
+
+class cmd_egg_info(egg_info):
+    """Write the version to a static module
+
+    egg_info runs for builds, installs and editable installs so the
+    package never has to run git to find its version at import.
+    """
+    def run(self):
+        with open(static_version_file, 'w') as f:
+            f.write("# Written by setup.py, do not edit or commit\n")
+            f.write("version = {!r}\n".format(versioneer.get_version()))
+        egg_info.run(self)
+
+
+cmdclass = versioneer.get_cmdclass()
+cmdclass['egg_info'] = cmd_egg_info
+
 
 setup(
     name='N2SNUserTools',
     version=versioneer.get_version(),
-    cmdclass=versioneer.get_cmdclass(),
+    cmdclass=cmdclass,
     description="User Manipulation Tools for Python",
     long_description=readme,
     author="Brookhaven National Laboratory",
@@ -50,6 +70,10 @@ setup(
             'n2sn_search_user = N2SNUserTools.cli:n2sn_search_user',
             'n2sn_add_user = N2SNUserTools.cli:n2sn_add_user',
             'n2sn_remove_user = N2SNUserTools.cli:n2sn_remove_user',
+            'n2sn_query_service = N2SNUserTools.cli:n2sn_query_service',
+            'n2sn_sync_rights = N2SNUserTools.cli:n2sn_sync_rights',
+            'n2sn_snapshot_rights = N2SNUserTools.cli:n2sn_snapshot_rights',
+            'n2sn_diff_rights = N2SNUserTools.cli:n2sn_diff_rights',
         ],
     },
     include_package_data=True,